@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+bench_embedding_batching.py
+Embedding 服务组批策略评估：在长短混合的负载上比较
+  - fifo   : 旧策略，按到达顺序每 --fifo-size 条一批，pad 到批内最长
+  - bucket : 新策略，服务端 _select_batch()（按 token 长度就近分组，按 BATCH_MAX_TOKENS 限制 padded tokens）
+报告每种策略的批次数、真实 / padded token 数、padding 比例、tokens/sec 与 items/sec。
+
+直接加载服务模块（model/Qwen3-Embedding-4B_API.py，会按其环境变量加载模型并等待 wait_ready()），
+绕过 HTTP 与排队，预先分词后只测 pad/stack + 前向，模拟队列积压时（饱和负载）的组批效果。
+
+负载来源（二选一）：
+  --texts corpus.txt       每行一段文本（建议本身就是长短混合，如查询 + 文档块）
+  默认                     合成负载：--short-frac 比例的短查询（3~12 词）+ 长段落（80~200 词）
+
+用法示例：
+  python bench_embedding_batching.py --items 2000
+  BATCH_MAX_TOKENS=4096 python bench_embedding_batching.py --texts mixed.txt --json result.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import importlib.util
+from typing import List, Dict, Any
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model", "Qwen3-Embedding-4B_API.py")
+
+
+# -------------------------------
+# Workload
+# -------------------------------
+def synthetic_workload(n: int, short_frac: float, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(5000)]
+    texts = []
+    for _ in range(n):
+        words = rng.randint(3, 12) if rng.random() < short_frac else rng.randint(80, 200)
+        texts.append(" ".join(rng.choice(vocab) for _ in range(words)))
+    return texts
+
+def load_texts(path: str, n: int, seed: int = 0) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        texts = [line.strip() for line in f if line.strip()][:n]
+    random.Random(seed).shuffle(texts)
+    return texts
+
+
+# -------------------------------
+# Batch planning
+# -------------------------------
+def plan_fifo(items: List[Dict[str, Any]], size: int) -> List[List[Dict[str, Any]]]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def plan_bucket(srv, items: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    pending, batches = list(items), []
+    while pending:
+        window = pending[:srv.BATCH_SCAN_SIZE]
+        picked = set(srv._select_batch(window, srv.BATCH_MAX_SIZE, srv.BATCH_MAX_TOKENS))
+        batches.append([it for i, it in enumerate(window) if i in picked])
+        pending = [it for i, it in enumerate(window) if i not in picked] + pending[len(window):]
+    return batches
+
+
+# -------------------------------
+# Run
+# -------------------------------
+def _sync(srv):
+    if srv.CUDA_AVAILABLE:
+        srv.torch.cuda.synchronize()
+
+def run_plan(srv, batches: List[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    tokens = sum(it["n_tokens"] for b in batches for it in b)
+    padded = sum(len(b) * max(it["n_tokens"] for it in b) for b in batches)
+    items = sum(len(b) for b in batches)
+    _sync(srv)
+    t0 = time.perf_counter()
+    for b in batches:
+        srv._forward_ids(*srv._collate([it["input_ids"] for it in b]))
+    _sync(srv)
+    wall = time.perf_counter() - t0
+    return {
+        "batches": len(batches),
+        "items": items,
+        "tokens": tokens,
+        "padded_tokens": padded,
+        "padding_ratio": round(1.0 - tokens / padded, 4) if padded else 0.0,
+        "max_padded_tokens_per_batch": max(len(b) * max(it["n_tokens"] for it in b) for b in batches),
+        "wall_s": round(wall, 3),
+        "tokens_per_s": round(tokens / wall, 1) if wall else 0.0,
+        "items_per_s": round(items / wall, 1) if wall else 0.0,
+    }
+
+def print_report(report: Dict[str, Any]):
+    print(f"items={report['items']} budget={report['batch_max_tokens']} tokens "
+          f"row_cap={report['batch_max_size']} fifo_size={report['fifo_size']}")
+    print(f"{'policy':<10}{'batches':>9}{'padding':>9}{'max pad tok':>13}{'wall s':>9}{'tok/s':>12}{'items/s':>10}")
+    for name in ("fifo", "bucket"):
+        r = report[name]
+        print(f"{name:<10}{r['batches']:>9}{r['padding_ratio']:>9.3f}{r['max_padded_tokens_per_batch']:>13}"
+              f"{r['wall_s']:>9.3f}{r['tokens_per_s']:>12.1f}{r['items_per_s']:>10.1f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Compare FIFO vs length-bucketed token-budget batching.")
+    ap.add_argument("--server", default=SERVER_PATH, help="path to the embedding server module")
+    ap.add_argument("--texts", help="text file, one passage per line (default: synthetic workload)")
+    ap.add_argument("--items", type=int, default=1000)
+    ap.add_argument("--short-frac", type=float, default=0.5, help="share of short queries in the synthetic workload")
+    ap.add_argument("--fifo-size", type=int, default=16, help="batch size of the old FIFO policy")
+    ap.add_argument("--warmup", type=int, default=2, help="warmup forwards before timing")
+    ap.add_argument("--json", help="also write the report to this path")
+    args = ap.parse_args()
+
+    spec = importlib.util.spec_from_file_location("embedding_server", args.server)
+    srv = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(srv)
+    if not srv.wait_ready():
+        print(f"[ERROR] embedding server failed to start: {srv._startup['error']}", file=sys.stderr)
+        sys.exit(1)
+
+    texts = load_texts(args.texts, args.items) if args.texts else synthetic_workload(args.items, args.short_frac)
+    if not texts:
+        print("[ERROR] empty workload", file=sys.stderr)
+        sys.exit(1)
+    items = [{"input_ids": ids, "n_tokens": len(ids)} for ids in srv._tokenize(texts)]
+
+    for _ in range(args.warmup):
+        srv._forward_last_hidden(texts[:args.fifo_size])
+
+    report = {
+        "items": len(items),
+        "batch_max_tokens": srv.BATCH_MAX_TOKENS,
+        "batch_max_size": srv.BATCH_MAX_SIZE,
+        "fifo_size": args.fifo_size,
+        "fifo": run_plan(srv, plan_fifo(items, args.fifo_size)),
+        "bucket": run_plan(srv, plan_bucket(srv, items)),
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
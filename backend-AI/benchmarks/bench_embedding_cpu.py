@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+bench_embedding_cpu.py
+CPU 推理方案评估：在同一批文本上比较 Embedding 服务的不同 CPU profile，报告
+  - 单条延迟（p50 / p95）
+  - 批量吞吐（items/sec、tokens/sec）
+  - 与 fp32 PyTorch 基线的余弦一致性（mean / min）
+
+profile（逗号分隔，对应服务端环境变量）：
+  fp32       RUNTIME=torch CPU_QUANT=none（基线，总是运行）
+  int8       RUNTIME=torch CPU_QUANT=int8（Linear 动态 int8 量化）
+  onnx       RUNTIME=onnx  CPU_QUANT=none
+  onnx-int8  RUNTIME=onnx  CPU_QUANT=int8
+
+每个 profile 在独立子进程中加载服务模块（model/Qwen3-Embedding-4B_API.py，强制 CUDA_VISIBLE_DEVICES=""），
+通过 embed_texts() 计算向量（与 HTTP 请求同走服务端调度器组批），避免不同 profile 的线程池与量化状态互相影响；
+子进程关闭 Embedding 缓存（EMB_CACHE_MAX_BYTES=0），重复文本不会命中缓存而低估耗时。
+
+用法示例：
+  python bench_embedding_cpu.py --profiles int8,onnx --threads 16 --items 256
+  python bench_embedding_cpu.py --texts corpus.txt --batch 16 --json cpu.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+import tempfile
+import importlib.util
+from typing import List, Dict, Any
+
+import numpy as np
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model", "Qwen3-Embedding-4B_API.py")
+PROFILES = {
+    "fp32": {"RUNTIME": "torch", "CPU_QUANT": "none"},
+    "int8": {"RUNTIME": "torch", "CPU_QUANT": "int8"},
+    "onnx": {"RUNTIME": "onnx", "CPU_QUANT": "none"},
+    "onnx-int8": {"RUNTIME": "onnx", "CPU_QUANT": "int8"},
+}
+
+
+# -------------------------------
+# Workload
+# -------------------------------
+def make_texts(path: str, n: int, seed: int = 0) -> List[str]:
+    if path:
+        with open(path, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()][:n]
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(5000)]
+    return [" ".join(rng.choice(vocab) for _ in range(rng.randint(5, 120))) for _ in range(n)]
+
+
+# -------------------------------
+# Worker (one profile per process)
+# -------------------------------
+def run_worker(args):
+    spec = importlib.util.spec_from_file_location("embedding_server", args.server)
+    srv = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(srv)
+    if not srv.wait_ready():
+        print(f"[ERROR] embedding server failed to start: {srv._startup['error']}", file=sys.stderr)
+        sys.exit(1)
+
+    texts = make_texts(args.texts, args.items)
+    n_tokens = sum(len(ids) for ids in srv._tokenize(texts))
+    for _ in range(args.warmup):
+        srv.embed_texts(texts[:args.batch])
+
+    lat = []
+    for t in texts[:args.latency_n]:
+        t0 = time.perf_counter()
+        srv.embed_texts([t])
+        lat.append(time.perf_counter() - t0)
+
+    vecs = []
+    t0 = time.perf_counter()
+    for i in range(0, len(texts), args.batch):
+        vecs.append(srv.embed_texts(texts[i:i + args.batch]).float().cpu().numpy())
+    wall = time.perf_counter() - t0
+
+    np.save(args.out, np.concatenate(vecs))
+    stats = {
+        "runtime": srv.RUNTIME,
+        "cpu_quant": srv.CPU_QUANT,
+        "threads": srv.torch.get_num_threads(),
+        "latency_ms_p50": float(np.percentile(np.asarray(lat) * 1000, 50)) if lat else 0.0,
+        "latency_ms_p95": float(np.percentile(np.asarray(lat) * 1000, 95)) if lat else 0.0,
+        "items_per_s": round(len(texts) / wall, 2),
+        "tokens_per_s": round(n_tokens / wall, 1),
+    }
+    with open(args.out + ".json", "w", encoding="utf-8") as f:
+        json.dump(stats, f)
+
+
+def spawn(profile: str, args, workdir: str) -> Dict[str, Any]:
+    out = os.path.join(workdir, f"{profile}.npy")
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES="", EMB_CACHE_MAX_BYTES="0", **PROFILES[profile])
+    if args.threads:
+        env["CPU_THREADS"] = str(args.threads)
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", "--out", out,
+           "--server", args.server, "--items", str(args.items), "--batch", str(args.batch),
+           "--latency-n", str(args.latency_n), "--warmup", str(args.warmup)]
+    if args.texts:
+        cmd += ["--texts", args.texts]
+    subprocess.run(cmd, env=env, check=True)
+    with open(out + ".json", encoding="utf-8") as f:
+        stats = json.load(f)
+    stats["vectors"] = np.load(out)
+    return stats
+
+
+def cosine_agreement(a: np.ndarray, b: np.ndarray) -> Dict[str, float]:
+    a = a / np.clip(np.linalg.norm(a, axis=1, keepdims=True), 1e-12, None)
+    b = b / np.clip(np.linalg.norm(b, axis=1, keepdims=True), 1e-12, None)
+    cos = (a * b).sum(axis=1)
+    return {"cos_mean": float(cos.mean()), "cos_min": float(cos.min())}
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"items={report['items']} batch={report['batch']}")
+    print(f"{'profile':<11}{'runtime':>8}{'threads':>8}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'items/s':>10}{'tok/s':>11}{'cos mean':>10}{'cos min':>10}")
+    for name, r in report["profiles"].items():
+        print(f"{name:<11}{r['runtime']:>8}{r['threads']:>8}{r['latency_ms_p50']:>10.2f}{r['latency_ms_p95']:>10.2f}"
+              f"{r['items_per_s']:>10.2f}{r['tokens_per_s']:>11.1f}{r['cos_mean']:>10.5f}{r['cos_min']:>10.5f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark CPU inference profiles of the embedding server.")
+    ap.add_argument("--server", default=SERVER_PATH, help="path to the embedding server module")
+    ap.add_argument("--profiles", default="int8", help=f"comma-separated, from {list(PROFILES)} (fp32 always runs)")
+    ap.add_argument("--texts", help="text file, one passage per line (default: synthetic)")
+    ap.add_argument("--items", type=int, default=128)
+    ap.add_argument("--batch", type=int, default=16)
+    ap.add_argument("--latency-n", type=int, default=32, help="single-text requests timed for latency")
+    ap.add_argument("--warmup", type=int, default=2)
+    ap.add_argument("--threads", type=int, default=0, help="CPU_THREADS for every profile (0 = default)")
+    ap.add_argument("--json", help="also write the report to this path")
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    ap.add_argument("--out", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    names = ["fp32"] + [p.strip() for p in args.profiles.split(",") if p.strip() and p.strip() != "fp32"]
+    unknown = [p for p in names if p not in PROFILES]
+    if unknown:
+        print(f"[ERROR] unknown profiles: {unknown}", file=sys.stderr)
+        sys.exit(1)
+
+    report = {"items": args.items, "batch": args.batch, "profiles": {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        base = None
+        for name in names:
+            stats = spawn(name, args, workdir)
+            vecs = stats.pop("vectors")
+            base = vecs if base is None else base
+            stats.update(cosine_agreement(vecs, base))
+            report["profiles"][name] = stats
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
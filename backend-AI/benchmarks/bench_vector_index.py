@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+bench_vector_index.py
+向量索引方案评估：以全维暴力检索为基准，报告 recall@k、内存占用与单查询延迟。
+
+当前支持：
+  - full : 全维向量（基准）
+  - mrl  : Matryoshka 两阶段（低维截断向量召回 top_k * factor → 全维重打分）
+  - int8 / binary : 量化向量召回 top_k * oversampling → 原始 float32 向量重打分
+                    （模拟 Qdrant scalar int8 quantile=0.99 与 binary quantization）
+
+向量来源（三选一）：
+  --npy vectors.npy                 N x D 浮点矩阵
+  --qdrant                          从 QDRANT_URL / QDRANT_COLLECTION 滚动读取（无名向量或 "full"）
+  --texts corpus.txt                每行一段文本，调用 EMB_BASE 的 Embedding 服务生成
+
+用法示例：
+  python bench_vector_index.py --qdrant --limit 20000 --dims 128,256,512 --factors 1,4,8
+  python bench_vector_index.py --npy vecs.npy --queries 500 --json result.json
+  python bench_vector_index.py --qdrant --quant int8,binary --oversampling 1,2,4
+
+说明：
+  - 取末尾 --queries 条作为查询（从语料中移除），ground truth 为全维余弦 top_k；
+  - 延迟为 numpy 暴力检索的单查询耗时，只用于比较不同维度的相对代价，
+    与 Qdrant HNSW 的绝对延迟不同；
+  - 内存按 float32 估算：mrl 模式下常驻内存为低维向量，全维向量放磁盘（on_disk）；
+    量化模式下常驻内存为量化向量（int8 每维 1 字节，binary 每维 1 bit），原始向量放磁盘。
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from typing import List, Dict, Any
+
+import numpy as np
+import requests
+
+QDRANT_URL = os.getenv("QDRANT_URL", "http://127.0.0.1:6333")
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", None)
+QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "web_chunks")
+EMB_URL = os.getenv("EMB_BASE", "http://127.0.0.1:7202").rstrip("/") + os.getenv("EMB_PATH", "/Qwen3-Embedding-4B")
+
+
+# -------------------------------
+# Load vectors
+# -------------------------------
+def load_from_qdrant(limit: int) -> np.ndarray:
+    headers = {"api-key": QDRANT_API_KEY} if QDRANT_API_KEY else {}
+    url = f"{QDRANT_URL}/collections/{QDRANT_COLLECTION}/points/scroll"
+    rows, offset = [], None
+    while len(rows) < limit:
+        body = {"limit": min(1000, limit - len(rows)), "with_payload": False, "with_vector": True}
+        if offset is not None:
+            body["offset"] = offset
+        r = requests.post(url, json=body, headers=headers, timeout=60)
+        r.raise_for_status()
+        res = r.json()["result"]
+        for p in res["points"]:
+            vec = p["vector"]
+            rows.append(vec["full"] if isinstance(vec, dict) else vec)
+        offset = res.get("next_page_offset")
+        if offset is None:
+            break
+    return np.asarray(rows, dtype=np.float32)
+
+def load_from_texts(path: str, limit: int, batch: int = 64) -> np.ndarray:
+    with open(path, encoding="utf-8") as f:
+        texts = [line.strip() for line in f if line.strip()][:limit]
+    rows = []
+    for i in range(0, len(texts), batch):
+        r = requests.post(EMB_URL, json={"texts": texts[i:i + batch]}, timeout=300)
+        r.raise_for_status()
+        rows.extend(r.json()["vectors"])
+    return np.asarray(rows, dtype=np.float32)
+
+def l2_normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.clip(np.linalg.norm(x, axis=1, keepdims=True), 1e-12, None)
+
+
+# -------------------------------
+# Search primitives
+# -------------------------------
+def topk_ids(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, scores.shape[0])
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+def quantize_int8(corpus: np.ndarray, quantile: float = 0.99):
+    """按分位数截断到 [lo, hi] 后线性映射到 int8；返回 (codes, lo, scale) 供反量化"""
+    lo = float(np.quantile(corpus, 1.0 - quantile))
+    hi = float(np.quantile(corpus, quantile))
+    scale = max(hi - lo, 1e-12) / 255.0
+    codes = np.clip(np.round((corpus - lo) / scale) - 128, -128, 127).astype(np.int8)
+    return codes, lo, scale
+
+def quantize_binary(x: np.ndarray) -> np.ndarray:
+    return np.where(x > 0, 1.0, -1.0).astype(np.float32)
+
+def recall_at_k(found: List[np.ndarray], truth: List[np.ndarray]) -> float:
+    hits = sum(len(set(f.tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+    return hits / max(1, sum(len(t) for t in truth))
+
+def percentile_ms(samples: List[float], q: float) -> float:
+    return float(np.percentile(np.asarray(samples) * 1000.0, q)) if samples else 0.0
+
+
+def run(corpus: np.ndarray, queries: np.ndarray, dims: List[int], factors: List[int], k: int,
+        quant: List[str] = (), oversampling: List[float] = (1.0,)) -> Dict[str, Any]:
+    n, full_dim = corpus.shape
+    corpus = l2_normalize(corpus)
+    queries = l2_normalize(queries)
+
+    # Baseline: full-dimension brute force
+    truth, lat_full = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        truth.append(topk_ids(corpus @ q, k))
+        lat_full.append(time.perf_counter() - t0)
+
+    report: Dict[str, Any] = {
+        "corpus": n,
+        "queries": len(queries),
+        "full_dim": full_dim,
+        "k": k,
+        "full": {
+            "recall": 1.0,
+            "ram_bytes": n * full_dim * 4,
+            "disk_bytes": 0,
+            "latency_ms_mean": float(np.mean(lat_full) * 1000),
+            "latency_ms_p95": percentile_ms(lat_full, 95),
+        },
+        "mrl": [],
+        "quant": [],
+    }
+
+    for d in dims:
+        if not 0 < d < full_dim:
+            continue
+        low = l2_normalize(corpus[:, :d])
+        low_q = l2_normalize(queries[:, :d])
+        for factor in factors:
+            found, lat = [], []
+            for q_full, q_low in zip(queries, low_q):
+                t0 = time.perf_counter()
+                cand = topk_ids(low @ q_low, k * factor)
+                if factor > 1:
+                    cand = cand[topk_ids(corpus[cand] @ q_full, k)]
+                found.append(cand[:k])
+                lat.append(time.perf_counter() - t0)
+            report["mrl"].append({
+                "dim": d,
+                "rescore_factor": factor,
+                "recall": recall_at_k(found, truth),
+                "ram_bytes": n * d * 4,
+                "disk_bytes": n * full_dim * 4,
+                "latency_ms_mean": float(np.mean(lat) * 1000),
+                "latency_ms_p95": percentile_ms(lat, 95),
+            })
+
+    for mode in quant:
+        if mode == "int8":
+            codes, lo, scale = quantize_int8(corpus)
+            # 内积对整体平移/缩放保持单调，直接用 int8 码字（转 float32 计算）打分
+            approx = codes.astype(np.float32) * scale + (lo + 128 * scale)
+            ram = n * full_dim
+        elif mode == "binary":
+            approx = quantize_binary(corpus)
+            ram = n * ((full_dim + 7) // 8)
+        else:
+            continue
+        for os_ in oversampling:
+            found, lat = [], []
+            for q in queries:
+                t0 = time.perf_counter()
+                q_approx = quantize_binary(q[None, :])[0] if mode == "binary" else q
+                cand = topk_ids(approx @ q_approx, max(k, int(round(k * os_))))
+                cand = cand[topk_ids(corpus[cand] @ q, k)]
+                found.append(cand[:k])
+                lat.append(time.perf_counter() - t0)
+            report["quant"].append({
+                "quantization": mode,
+                "oversampling": os_,
+                "recall": recall_at_k(found, truth),
+                "ram_bytes": ram,
+                "disk_bytes": n * full_dim * 4,
+                "latency_ms_mean": float(np.mean(lat) * 1000),
+                "latency_ms_p95": percentile_ms(lat, 95),
+            })
+    return report
+
+
+def print_report(report: Dict[str, Any]):
+    k = report["k"]
+    print(f"corpus={report['corpus']} queries={report['queries']} full_dim={report['full_dim']}")
+    print(f"{'config':<24}{'recall@' + str(k):>10}{'RAM MB':>10}{'disk MB':>10}{'mean ms':>10}{'p95 ms':>10}")
+    rows = [("full", report["full"])]
+    rows += [(f"mrl d={r['dim']} x{r['rescore_factor']}", r) for r in report["mrl"]]
+    rows += [(f"{r['quantization']} os={r['oversampling']:g}", r) for r in report.get("quant", [])]
+    for name, r in rows:
+        print(f"{name:<24}{r['recall']:>10.4f}{r['ram_bytes'] / 2**20:>10.1f}{r['disk_bytes'] / 2**20:>10.1f}"
+              f"{r['latency_ms_mean']:>10.3f}{r['latency_ms_p95']:>10.3f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark vector index modes against full-dimension search.")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--npy", help="N x D float matrix (.npy)")
+    src.add_argument("--qdrant", action="store_true", help="scroll vectors from the Qdrant collection")
+    src.add_argument("--texts", help="text file, one passage per line, embedded via EMB_BASE")
+    ap.add_argument("--limit", type=int, default=20000, help="max corpus vectors to load")
+    ap.add_argument("--queries", type=int, default=200, help="held-out query vectors taken from the tail")
+    ap.add_argument("--dims", default="128,256,512", help="comma-separated first-stage dimensions")
+    ap.add_argument("--factors", default="1,4,8", help="comma-separated rescore factors (1 = no rescoring)")
+    ap.add_argument("--quant", default="", help="comma-separated quantization modes to evaluate: int8,binary")
+    ap.add_argument("--oversampling", default="1,2,4", help="comma-separated oversampling factors for --quant")
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--json", help="also write the report to this path")
+    args = ap.parse_args()
+
+    if args.npy:
+        vecs = np.load(args.npy).astype(np.float32)[:args.limit]
+    elif args.qdrant:
+        vecs = load_from_qdrant(args.limit)
+    else:
+        vecs = load_from_texts(args.texts, args.limit)
+    if vecs.ndim != 2 or vecs.shape[0] <= args.queries:
+        print(f"[ERROR] need more than {args.queries} vectors, got shape {vecs.shape}", file=sys.stderr)
+        sys.exit(1)
+
+    corpus, queries = vecs[:-args.queries], vecs[-args.queries:]
+    report = run(
+        corpus, queries,
+        dims=[int(x) for x in args.dims.split(",") if x.strip()],
+        factors=[max(1, int(x)) for x in args.factors.split(",") if x.strip()],
+        k=args.k,
+        quant=[x.strip() for x in args.quant.split(",") if x.strip()],
+        oversampling=[max(1.0, float(x)) for x in args.oversampling.split(",") if x.strip()],
+    )
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
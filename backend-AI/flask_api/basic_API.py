@@ -18,26 +18,37 @@ pip install flask flask-cors pyjwt werkzeug pymysql psycopg2-binary requests tra
 import os
 import re
 import json
+import math
+import base64
+import struct
+import time
+import threading
 import hashlib
 import datetime as dt
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import wraps
 from typing import List, Dict, Any, Optional
 from urllib.parse import urlparse
 from datetime import datetime
 
+import numpy as np
 import requests
 import trafilatura
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json
 from bs4 import BeautifulSoup
-from flask import Flask, Blueprint, request, jsonify, g
+from flask import Flask, Blueprint, Response, request, jsonify, g, stream_with_context
 from flask_cors import CORS
 import pymysql
 from pymysql.cursors import DictCursor
 import jwt
 from werkzeug.security import generate_password_hash, check_password_hash
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import PointStruct
+from qdrant_client.http.models import (
+    PointStruct, Filter, FieldCondition, MatchAny, MatchValue, Range, Prefetch, SearchParams,
+    QuantizationSearchParams, IsEmptyCondition, PayloadField,
+)
 
 # =========================
 # 全局配置（可用环境变量覆盖）
@@ -49,13 +60,43 @@ WEB_CONFIG = {
     "EMBEDDING_API_PATH": os.getenv("EMB_PATH", "/Qwen3-Embedding-4B"),
     "EMB_POOLING": os.getenv("EMB_POOLING", "last"),
     "EMB_NORMALIZE": bool(int(os.getenv("EMB_NORMALIZE", "1"))),
+    # Embedding 响应格式：raw（二进制，零拷贝解析）| base64 | json；dtype 仅对 raw/base64 生效
+    "EMB_FORMAT": os.getenv("EMB_FORMAT", "raw").lower(),
+    "EMB_DTYPE": os.getenv("EMB_DTYPE", "float32").lower(),
+    # Embedding 服务队列满时返回 429 + Retry-After：按其建议等待后重试的次数
+    "EMB_MAX_RETRIES": int(os.getenv("EMB_MAX_RETRIES", "2")),
     "QDRANT_URL": os.getenv("QDRANT_URL", "http://127.0.0.1:6333"),
     "QDRANT_API_KEY": os.getenv("QDRANT_API_KEY", None),
     "QDRANT_COLLECTION": os.getenv("QDRANT_COLLECTION", "web_chunks"),
+    # 向量索引：full = 单一全维向量；mrl = 低维截断向量（Matryoshka）做 ANN + 全维向量重打分
+    "VECTOR_INDEX_MODE": os.getenv("VECTOR_INDEX_MODE", "full").lower(),
+    "MRL_DIM": int(os.getenv("MRL_DIM", "256")),
+    "MRL_RESCORE_FACTOR": int(os.getenv("MRL_RESCORE_FACTOR", "4")),
+    # 向量量化：none | int8（标量）| binary；量化向量常驻内存，原始向量放磁盘，查询时用原始向量重打分
+    "QDRANT_QUANTIZATION": os.getenv("QDRANT_QUANTIZATION", "none").lower(),
+    "QDRANT_OVERSAMPLING": float(os.getenv("QDRANT_OVERSAMPLING", "2.0")),
+    # 已有 collection 的维度 / 索引模式与配置不符时：默认报错；=1 时删除重建并从 PG chunks 表重新向量化
+    "QDRANT_RECREATE_ON_MISMATCH": bool(int(os.getenv("QDRANT_RECREATE_ON_MISMATCH", "0"))),
     "CHUNK_SIZE": int(os.getenv("CHUNK_SIZE", "800")),
     "CHUNK_OVERLAP": int(os.getenv("CHUNK_OVERLAP", "200")),
     "HTTP_TIMEOUT": int(os.getenv("HTTP_TIMEOUT", "15")),
     "HTTP_UA": os.getenv("HTTP_UA", "Mozilla/5.0 (compatible; mini-websearch/0.1)"),
+    # hybrid 融合：rrf | wrrf | alpha；每路召回深度按两路重叠率自适应
+    "SEARCH_FUSION": os.getenv("SEARCH_FUSION", "rrf").lower(),
+    "RRF_K": int(os.getenv("RRF_K", "60")),
+    "SEARCH_DEPTH_MARGIN": float(os.getenv("SEARCH_DEPTH_MARGIN", "1.2")),
+    # 二阶段重排（Embedding 服务 /rerank）：默认关闭，超出时间预算则回退融合顺序
+    "RERANK_API_PATH": os.getenv("RERANK_PATH", "/rerank"),
+    "SEARCH_RERANK": bool(int(os.getenv("SEARCH_RERANK", "0"))),
+    "RERANK_TOP_N": int(os.getenv("RERANK_TOP_N", "20")),
+    "RERANK_BUDGET_MS": int(os.getenv("RERANK_BUDGET_MS", "300")),
+    "SNIPPET_CHARS": int(os.getenv("SNIPPET_CHARS", "400")),
+    "PAGE_META_CACHE_SIZE": int(os.getenv("PAGE_META_CACHE_SIZE", "4096")),
+    # 两路召回并发执行的线程池大小
+    "SEARCH_WORKERS": int(os.getenv("SEARCH_WORKERS", "8")),
+    # 游标分页：首次检索最多冻结的结果数与游标有效期
+    "SEARCH_MAX_RESULTS": int(os.getenv("SEARCH_MAX_RESULTS", "500")),
+    "SEARCH_CURSOR_TTL_MIN": int(os.getenv("SEARCH_CURSOR_TTL_MIN", "30")),
 }
 
 # --- MySQL (chat/core 共用) ---
@@ -218,6 +259,8 @@ def ensure_pg_schema():
         """,
         "CREATE INDEX IF NOT EXISTS idx_pages_fetched_at ON pages(fetched_at DESC);",
         "CREATE INDEX IF NOT EXISTS idx_pages_published_at ON pages(published_at DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_pages_site ON pages(site);",
+        "CREATE INDEX IF NOT EXISTS idx_pages_lang ON pages(lang);",
         "CREATE INDEX IF NOT EXISTS idx_pages_title_trgm ON pages USING gin (title gin_trgm_ops);",
         "CREATE INDEX IF NOT EXISTS idx_pages_content_trgm ON pages USING gin (content gin_trgm_ops);",
         """
@@ -230,7 +273,19 @@ def ensure_pg_schema():
         );
         """,
         "CREATE INDEX IF NOT EXISTS idx_chunks_page_id ON chunks(page_id);",
+        "CREATE INDEX IF NOT EXISTS idx_chunks_page_chunk_index ON chunks(page_id, chunk_index);",
         "CREATE INDEX IF NOT EXISTS idx_chunks_content_trgm ON chunks USING gin (content gin_trgm_ops);",
+        """
+        CREATE TABLE IF NOT EXISTS search_cursors (
+            id TEXT PRIMARY KEY,
+            scope TEXT NOT NULL,
+            q TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            results JSONB NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_search_cursors_expires_at ON search_cursors(expires_at);",
     ]
     with get_pg_conn() as conn, conn.cursor() as cur:
         for s in sqls:
@@ -253,21 +308,138 @@ def get_qdrant() -> QdrantClient:
         )
     return _qdrant_client
 
+def _qdrant_headers() -> Dict[str, str]:
+    # 直接走 REST 的 Qdrant 调用同样要带 api-key（与 QdrantClient 一致）
+    headers = {"Content-Type": "application/json"}
+    if WEB_CONFIG["QDRANT_API_KEY"]:
+        headers["api-key"] = WEB_CONFIG["QDRANT_API_KEY"]
+    return headers
+
+# 过滤字段的 payload 索引（时间字段存为 UTC 秒级时间戳）
+QDRANT_PAYLOAD_INDEXES = {
+    "page_id": "integer",
+    "site": "keyword",
+    "lang": "keyword",
+    "published_at": "integer",
+    "fetched_at": "integer",
+}
+
+def ensure_qdrant_payload_indexes(existing: Optional[Dict[str, Any]] = None):
+    url = f"{WEB_CONFIG['QDRANT_URL']}/collections/{WEB_CONFIG['QDRANT_COLLECTION']}/index"
+    existing = existing or {}
+    for field, schema in QDRANT_PAYLOAD_INDEXES.items():
+        if field in existing:
+            continue
+        payload = {"field_name": field, "field_schema": schema}
+        requests.put(url, headers=_qdrant_headers(), data=json.dumps(payload), timeout=15)
+
+# Matryoshka 两阶段：命名向量 "mrl"（低维，建 HNSW）+ "full"（全维，仅重打分，不建图）
+MRL_VECTOR, FULL_VECTOR = "mrl", "full"
+
+def mrl_enabled(dim: int) -> bool:
+    return WEB_CONFIG["VECTOR_INDEX_MODE"] == "mrl" and 0 < WEB_CONFIG["MRL_DIM"] < dim
+
+def mrl_truncate(vec: List[float]) -> List[float]:
+    # 与 Embedding 服务 dim 截断一致：先截断再 L2 归一化
+    head = list(vec[:WEB_CONFIG["MRL_DIM"]])
+    norm = math.sqrt(sum(x * x for x in head)) or 1.0
+    return [x / norm for x in head]
+
+def quantization_enabled() -> bool:
+    return WEB_CONFIG["QDRANT_QUANTIZATION"] in ("int8", "binary")
+
+def _qdrant_quantization_config() -> Optional[Dict[str, Any]]:
+    mode = WEB_CONFIG["QDRANT_QUANTIZATION"]
+    if mode == "int8":
+        return {"scalar": {"type": "int8", "quantile": 0.99, "always_ram": True}}
+    if mode == "binary":
+        return {"binary": {"always_ram": True}}
+    return None
+
+def _qdrant_vectors_config(dim: int) -> Dict[str, Any]:
+    on_disk = quantization_enabled()
+    if mrl_enabled(dim):
+        return {
+            FULL_VECTOR: {"size": dim, "distance": "Cosine", "on_disk": True, "hnsw_config": {"m": 0}},
+            MRL_VECTOR: {"size": WEB_CONFIG["MRL_DIM"], "distance": "Cosine", "on_disk": on_disk},
+        }
+    return {"size": dim, "distance": "Cosine", "on_disk": on_disk}
+
+def _qdrant_collection_config(dim: int) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {"vectors": _qdrant_vectors_config(dim)}
+    quant = _qdrant_quantization_config()
+    if quant:
+        payload["quantization_config"] = quant
+    return payload
+
+def _ensure_qdrant_quantization(url: str, current: Optional[Dict[str, Any]]):
+    # 量化配置可在线修改（PATCH），无需重建 collection
+    wanted = _qdrant_quantization_config()
+    if set(current or {}) == set(wanted or {}):
+        return
+    payload = {"quantization_config": wanted or "Disabled"}
+    requests.patch(url, headers=_qdrant_headers(), data=json.dumps(payload), timeout=15)
+
+def _ensure_qdrant_on_disk(url: str, current: Dict[str, Any], dim: int):
+    """
+    原始向量的 on_disk 同样在线 PATCH（无名向量的名字为 ""），使已有 collection 开启量化后
+    原始向量也移出内存；Qdrant 拒绝时打印警告（需重建 collection 才能生效）
+    """
+    wanted = _qdrant_vectors_config(dim)
+    pairs = {"": (current, wanted)} if "size" in wanted else {k: (current[k], wanted[k]) for k in wanted}
+    diff = {name: {"on_disk": w.get("on_disk", False)} for name, (c, w) in pairs.items()
+            if bool(c.get("on_disk", False)) != bool(w.get("on_disk", False))}
+    if not diff:
+        return
+    r = requests.patch(url, headers=_qdrant_headers(), data=json.dumps({"vectors": diff}),
+                       timeout=15)
+    if not r.ok:
+        print(f"[WARN] Qdrant 未能在线修改向量 on_disk={diff}（{r.status_code} {r.text[:200]}），"
+              f"原始向量仍按旧配置存放；需重建 collection {WEB_CONFIG['QDRANT_COLLECTION']} 才能生效")
+
+def _qdrant_search_params(oversampling: Optional[float] = None) -> Optional[SearchParams]:
+    if not quantization_enabled():
+        return None
+    return SearchParams(quantization=QuantizationSearchParams(
+        ignore=False,
+        rescore=True,
+        oversampling=max(1.0, float(oversampling or WEB_CONFIG["QDRANT_OVERSAMPLING"])),
+    ))
+
+def _qdrant_vectors_match(current: Dict[str, Any], dim: int) -> bool:
+    wanted = _qdrant_vectors_config(dim)
+    if "size" in wanted:
+        return current.get("size") == dim
+    return set(current) == set(wanted) and all(current[k].get("size") == wanted[k]["size"] for k in wanted)
+
 def ensure_qdrant_collection(dim: int):
     url = f"{WEB_CONFIG['QDRANT_URL']}/collections/{WEB_CONFIG['QDRANT_COLLECTION']}"
-    r = requests.get(url, timeout=10)
+    r = requests.get(url, headers=_qdrant_headers(), timeout=10)
     if r.status_code == 200:
         info = r.json()
-        current_dim = info["result"]["config"]["params"]["vectors"]["size"]
-        if current_dim != dim:
-            # 维度不一致 → 直接删重建（也可改为报错）
-            requests.delete(url, timeout=10)
-            payload = {"vectors": {"size": dim, "distance": "Cosine"}}
-            requests.put(url, headers={"Content-Type": "application/json"}, data=json.dumps(payload), timeout=15)
+        current = info["result"]["config"]["params"]["vectors"]
+        if not _qdrant_vectors_match(current, dim):
+            # 维度或索引模式不一致：删除会丢掉全部向量，只在显式开启时重建并从 chunks 表重新向量化
+            mismatch = (f"collection {WEB_CONFIG['QDRANT_COLLECTION']} 的向量配置 {current} 与期望 "
+                        f"{_qdrant_vectors_config(dim)} 不一致（VECTOR_INDEX_MODE / MRL_DIM / 维度）")
+            if not WEB_CONFIG["QDRANT_RECREATE_ON_MISMATCH"]:
+                raise RuntimeError(mismatch + "；设置 QDRANT_RECREATE_ON_MISMATCH=1 以删除重建并重新向量化")
+            print(f"[WARN] {mismatch}，删除重建并从 chunks 表重新向量化")
+            requests.delete(url, headers=_qdrant_headers(), timeout=10)
+            payload = _qdrant_collection_config(dim)
+            requests.put(url, headers=_qdrant_headers(), data=json.dumps(payload), timeout=15)
+            ensure_qdrant_payload_indexes()
+            n = reembed_chunks(dim)
+            print(f"[INFO] 已重新向量化 {n} 个 chunk")
+            return
+        _ensure_qdrant_quantization(url, info["result"]["config"].get("quantization_config"))
+        _ensure_qdrant_on_disk(url, current, dim)
+        ensure_qdrant_payload_indexes(info["result"].get("payload_schema"))
         return
     elif r.status_code == 404:
-        payload = {"vectors": {"size": dim, "distance": "Cosine"}}
-        requests.put(url, headers={"Content-Type": "application/json"}, data=json.dumps(payload), timeout=15)
+        payload = _qdrant_collection_config(dim)
+        requests.put(url, headers=_qdrant_headers(), data=json.dumps(payload), timeout=15)
+        ensure_qdrant_payload_indexes()
     else:
         raise RuntimeError(f"访问 Qdrant 出错: {r.status_code}, {r.text}")
 
@@ -275,25 +447,56 @@ def ensure_qdrant_collection(dim: int):
 def _embed_api_url() -> str:
     return f"{WEB_CONFIG['EMBEDDING_API_BASE']}{WEB_CONFIG['EMBEDDING_API_PATH']}"
 
+# 二进制响应头（与 Embedding 服务一致）："<4sBxxxII" = magic b"EMB1", dtype 码, 行数, 维度
+_EMB_RAW_HEADER = struct.Struct("<4sBxxxII")
+_EMB_RAW_DTYPES = {1: "<f4", 2: "<f2"}
+_EMB_ACCEPT = {"raw": "application/octet-stream", "base64": "application/json", "json": "application/json"}
+
+def _decode_embedding_response(r: requests.Response) -> Dict[str, Any]:
+    """解析 Embedding 响应；vectors 统一为 (n, dim) 的 numpy 数组（二进制格式为 frombuffer 零拷贝只读视图）"""
+    if r.headers.get("Content-Type", "").startswith("application/octet-stream"):
+        buf = r.content
+        magic, code, rows, dim = _EMB_RAW_HEADER.unpack_from(buf, 0)
+        if magic != b"EMB1" or code not in _EMB_RAW_DTYPES:
+            raise ValueError("invalid embedding response header")
+        vecs = np.frombuffer(buf, dtype=_EMB_RAW_DTYPES[code], count=rows * dim,
+                             offset=_EMB_RAW_HEADER.size).reshape(rows, dim)
+        return {"model": r.headers.get("X-Embedding-Model"), "count": rows, "dim": dim, "vectors": vecs}
+    data = r.json()
+    if "vectors_b64" in data:
+        dtype = "<f2" if data.get("dtype") == "float16" else "<f4"
+        data["vectors"] = np.frombuffer(base64.b64decode(data.pop("vectors_b64")), dtype=dtype).reshape(data["shape"])
+    else:
+        data["vectors"] = np.asarray(data.get("vectors") or [], dtype=np.float32)
+    return data
+
 def embed_batch(texts: List[str], pooling=None, normalize=None, dim=None,
-                instruction=None, prefix=None) -> Dict[str, Any]:
+                instruction=None, prefix=None, priority=None) -> Dict[str, Any]:
+    """priority: "interactive"（查询，优先组批）| "bulk"（入库切块）；None 时使用服务端默认"""
     url = _embed_api_url()
-    payload = {"texts": [str(t or "").strip() for t in texts]}
+    fmt = WEB_CONFIG["EMB_FORMAT"] if WEB_CONFIG["EMB_FORMAT"] in _EMB_ACCEPT else "json"
+    payload = {"texts": [str(t or "").strip() for t in texts], "format": fmt}
+    if fmt != "json":         payload["dtype"] = WEB_CONFIG["EMB_DTYPE"]
     if pooling is not None:   payload["pooling"] = pooling
     if normalize is not None: payload["normalize"] = bool(normalize)
     if dim is not None:       payload["dim"] = int(dim)
     if instruction:           payload["instruction"] = instruction
     if prefix:                payload["prefix"] = prefix
-    r = requests.post(url, json=payload, timeout=WEB_CONFIG["HTTP_TIMEOUT"])
+    if priority:              payload["priority"] = priority
+    for attempt in range(WEB_CONFIG["EMB_MAX_RETRIES"] + 1):
+        r = requests.post(url, json=payload, headers={"Accept": _EMB_ACCEPT[fmt]}, timeout=WEB_CONFIG["HTTP_TIMEOUT"])
+        if r.status_code != 429 or attempt == WEB_CONFIG["EMB_MAX_RETRIES"]:
+            break
+        time.sleep(min(float(r.headers.get("Retry-After") or 1), WEB_CONFIG["HTTP_TIMEOUT"]))
     r.raise_for_status()
-    return r.json()
+    return _decode_embedding_response(r)
 
 def probe_embedding_dim() -> int:
     global EMB_DIM
     if EMB_DIM:
         return EMB_DIM
     data = embed_batch(["__dim_probe__"], pooling=WEB_CONFIG["EMB_POOLING"], normalize=WEB_CONFIG["EMB_NORMALIZE"])
-    EMB_DIM = int(data.get("dim") or len(data["vectors"][0]))
+    EMB_DIM = int(data.get("dim") or data["vectors"].shape[1])
     return EMB_DIM
 
 # 抓取解析与切块
@@ -332,8 +535,44 @@ def chunk_text(text: str, size: int, overlap: int) -> List[str]:
         start = max(0, end - overlap)
     return chunks
 
+# 页面元数据 LRU（进程内；检索结果补全用，页面更新时失效）
+class _PageMetaCache:
+    def __init__(self, capacity: int):
+        self._lock = threading.Lock()
+        self._capacity = max(0, capacity)
+        self._data: "OrderedDict[int, dict]" = OrderedDict()
+
+    def get_many(self, page_ids: List[int]) -> Dict[int, dict]:
+        found = {}
+        with self._lock:
+            for pid in page_ids:
+                meta = self._data.get(pid)
+                if meta is not None:
+                    self._data.move_to_end(pid)
+                    found[pid] = meta
+        return found
+
+    def put(self, page_id: int, meta: dict):
+        if not self._capacity:
+            return
+        with self._lock:
+            self._data[page_id] = meta
+            self._data.move_to_end(page_id)
+            while len(self._data) > self._capacity:
+                self._data.popitem(last=False)
+
+    def invalidate(self, page_id: int):
+        with self._lock:
+            self._data.pop(page_id, None)
+
+_page_meta_cache = _PageMetaCache(WEB_CONFIG["PAGE_META_CACHE_SIZE"])
+
 # 入库
-def upsert_page(url: str, html: str, parsed: Dict[str, Any]) -> int:
+# Qdrant payload 中的页面字段取自 pages 行本身，保证两路检索按同样的 site / lang / 时间过滤
+PAGE_ROW_RETURNING = "id, url, site, title, published_at, fetched_at, lang"
+
+def upsert_page(url: str, html: str, parsed: Dict[str, Any]) -> Dict[str, Any]:
+    """写入/刷新 pages 行，返回入库后的行（PAGE_ROW_RETURNING 各列）；内容未变时仅刷新 fetched_at / site / lang"""
     now = datetime.utcnow()
     content = parsed["content"] or ""
     chksum = checksum_text(content or html)
@@ -342,23 +581,40 @@ def upsert_page(url: str, html: str, parsed: Dict[str, Any]) -> int:
         row = cur.fetchone()
         if row:
             if row["checksum"] == chksum:
-                return row["id"]
+                cur.execute(f"""UPDATE pages SET site=%s, lang=%s, fetched_at=%s WHERE id=%s
+                                RETURNING {PAGE_ROW_RETURNING}""",
+                            (parsed["site"], parsed["lang"], now, row["id"]))
             else:
                 cur.execute("DELETE FROM chunks WHERE page_id=%s", (row["id"],))
-                cur.execute("""UPDATE pages SET title=%s, content=%s, checksum=%s, fetched_at=%s WHERE id=%s""",
-                            (parsed["title"], content, chksum, now, row["id"]))
-                conn.commit()
-                return row["id"]
+                cur.execute(f"""UPDATE pages SET site=%s, title=%s, published_at=%s, fetched_at=%s, lang=%s,
+                                content=%s, checksum=%s WHERE id=%s
+                                RETURNING {PAGE_ROW_RETURNING}""",
+                            (parsed["site"], parsed["title"], parsed["published_at"], now, parsed["lang"],
+                             content, chksum, row["id"]))
+            page = dict(cur.fetchone())
+            conn.commit()
+            _page_meta_cache.invalidate(page["id"])
+            return page
         else:
-            cur.execute("""INSERT INTO pages (url, site, title, published_at, fetched_at, lang, html, content, checksum)
-                           VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id""",
+            cur.execute(f"""INSERT INTO pages (url, site, title, published_at, fetched_at, lang, html, content, checksum)
+                            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING {PAGE_ROW_RETURNING}""",
                         (url, parsed["site"], parsed["title"], parsed["published_at"], now,
                          parsed["lang"], html, content, chksum))
-            pid = cur.fetchone()["id"]
+            page = dict(cur.fetchone())
             conn.commit()
-            return pid
+            return page
 
-def upsert_chunks_and_vectors(page_id: int, url: str, title: str, published_at, content: str) -> int:
+def _epoch(ts: Optional[datetime]) -> Optional[int]:
+    # PG 中的 TIMESTAMP 均为 naive UTC
+    if ts is None:
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=dt.timezone.utc)
+    return int(ts.timestamp())
+
+def upsert_chunks_and_vectors(page: Dict[str, Any], content: str) -> int:
+    """page 为 upsert_page() 返回的 pages 行；向量 payload 的过滤字段与该行一致"""
+    page_id = page["id"]
     blocks = chunk_text(content, WEB_CONFIG["CHUNK_SIZE"], WEB_CONFIG["CHUNK_OVERLAP"])
     if not blocks:
         return 0
@@ -373,79 +629,733 @@ def upsert_chunks_and_vectors(page_id: int, url: str, title: str, published_at,
             chunk_ids.append(cid)
         conn.commit()
     dim = probe_embedding_dim()
-    data = embed_batch(blocks, pooling=WEB_CONFIG["EMB_POOLING"], normalize=WEB_CONFIG["EMB_NORMALIZE"])
-    vectors = data["vectors"]
     ensure_qdrant_collection(dim)
-    client = get_qdrant()
-    points = [PointStruct(id=cid, vector=vec, payload={"page_id": page_id, "url": url, "title": title})
-              for cid, vec in zip(chunk_ids, vectors)]
-    client.upsert(collection_name=WEB_CONFIG["QDRANT_COLLECTION"], points=points)
+    return _upsert_page_vectors(page, chunk_ids, blocks, dim)
+
+def _upsert_page_vectors(page: Dict[str, Any], chunk_ids: List[int], blocks: List[str], dim: int) -> int:
+    """向量化一页的 chunk 并写入 Qdrant（collection 须已存在）；payload 取自 pages 行"""
+    data = embed_batch(blocks, pooling=WEB_CONFIG["EMB_POOLING"], normalize=WEB_CONFIG["EMB_NORMALIZE"],
+                       priority="bulk")
+    vectors = data["vectors"].tolist()
+    payload = _qdrant_page_payload(page)
+    if mrl_enabled(dim):
+        points = [PointStruct(id=cid, vector={FULL_VECTOR: vec, MRL_VECTOR: mrl_truncate(vec)}, payload=payload)
+                  for cid, vec in zip(chunk_ids, vectors)]
+    else:
+        points = [PointStruct(id=cid, vector=vec, payload=payload)
+                  for cid, vec in zip(chunk_ids, vectors)]
+    get_qdrant().upsert(collection_name=WEB_CONFIG["QDRANT_COLLECTION"], points=points)
     return len(points)
 
+def _qdrant_page_payload(page: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "page_id": page["id"],
+        "url": page["url"],
+        "title": page["title"],
+        "site": page["site"],
+        "lang": page["lang"],
+        "published_at": _epoch(page["published_at"]),
+        "fetched_at": _epoch(page["fetched_at"]),
+    }
+
+def backfill_qdrant_payloads() -> int:
+    """
+    一次性补齐旧数据：早期写入的点没有 site / lang / published_at / fetched_at，过滤检索会漏掉它们。
+    找出缺 fetched_at（每个 pages 行都有）的点所属的页，按 pages 行整页 set_payload；返回补齐的页数。
+    没有缺字段的点时只需一次 scroll，可在每次启动时调用。
+    """
+    client = get_qdrant()
+    collection = WEB_CONFIG["QDRANT_COLLECTION"]
+    missing = Filter(must=[IsEmptyCondition(is_empty=PayloadField(key="fetched_at"))])
+    page_ids, offset = set(), None
+    while True:
+        points, offset = client.scroll(collection_name=collection, scroll_filter=missing, limit=1000,
+                                       offset=offset, with_payload=["page_id"], with_vectors=False)
+        page_ids.update(p.payload["page_id"] for p in points if (p.payload or {}).get("page_id") is not None)
+        if offset is None:
+            break
+    if not page_ids:
+        return 0
+    with get_pg_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"SELECT {PAGE_ROW_RETURNING} FROM pages WHERE id = ANY(%s)", (sorted(page_ids),))
+        pages = cur.fetchall() or []
+    for page in pages:
+        client.set_payload(
+            collection_name=collection,
+            payload=_qdrant_page_payload(page),
+            points=Filter(must=[FieldCondition(key="page_id", match=MatchValue(value=page["id"]))]),
+        )
+    return len(pages)
+
+def reembed_chunks(dim: int) -> int:
+    """按 PG 中已有的 pages / chunks 重新向量化全部 chunk（collection 重建后使用），返回写入的点数"""
+    with get_pg_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"""SELECT {PAGE_ROW_RETURNING} FROM pages
+                        WHERE id IN (SELECT DISTINCT page_id FROM chunks) ORDER BY id""")
+        pages = cur.fetchall() or []
+    total = 0
+    for page in pages:
+        with get_pg_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT id, content FROM chunks WHERE page_id=%s ORDER BY chunk_index", (page["id"],))
+            rows = cur.fetchall() or []
+        if rows:
+            total += _upsert_page_vectors(dict(page), [r["id"] for r in rows], [r["content"] for r in rows], dim)
+    return total
+
 def ingest_url(url: str) -> Dict[str, Any]:
     html = fetch_html(url)
     parsed = clean_extract(url, html)
-    pid = upsert_page(url, html, parsed)
+    page = upsert_page(url, html, parsed)
     n_chunks = 0
     if parsed["content"]:
-        n_chunks = upsert_chunks_and_vectors(pid, url, parsed["title"], parsed["published_at"], parsed["content"])
-    return {"url": url, "page_id": pid, "title": parsed["title"], "chunks": n_chunks}
+        n_chunks = upsert_chunks_and_vectors(page, parsed["content"])
+    return {"url": url, "page_id": page["id"], "title": page["title"], "chunks": n_chunks}
 
 def ingest_urls(urls: List[str]) -> List[Dict[str, Any]]:
     return [ingest_url(u) for u in urls]
 # --- 辅助：查询向量 & Qdrant 搜索 ---
 def _embed_query(q: str) -> List[float]:
-    data = embed_batch([q], pooling=WEB_CONFIG["EMB_POOLING"], normalize=WEB_CONFIG["EMB_NORMALIZE"])
-    return data["vectors"][0]
+    data = embed_batch([q], pooling=WEB_CONFIG["EMB_POOLING"], normalize=WEB_CONFIG["EMB_NORMALIZE"],
+                       priority="interactive")
+    return data["vectors"][0].tolist()
 
-def _qdrant_search(qvec: List[float], top_k: int = 10):
+def _qdrant_search(qvec: List[float], top_k: int = 10, query_filter: Optional[Filter] = None,
+                   oversampling: Optional[float] = None):
     client = get_qdrant()
+    search_params = _qdrant_search_params(oversampling)
+    if mrl_enabled(len(qvec)):
+        # 第一阶段：低维向量 ANN 取 top_k * factor；第二阶段：全维向量对候选重打分
+        res = client.query_points(
+            collection_name=WEB_CONFIG["QDRANT_COLLECTION"],
+            prefetch=Prefetch(
+                query=mrl_truncate(qvec),
+                using=MRL_VECTOR,
+                filter=query_filter,
+                params=search_params,
+                limit=top_k * max(1, WEB_CONFIG["MRL_RESCORE_FACTOR"]),
+            ),
+            query=qvec,
+            using=FULL_VECTOR,
+            query_filter=query_filter,
+            search_params=search_params,
+            limit=top_k,
+            with_payload=True,
+            with_vectors=False,
+        )
+        return res.points or []
     res = client.query_points(
         collection_name=WEB_CONFIG["QDRANT_COLLECTION"],
-        query_vector=qvec,
+        query=qvec,
+        query_filter=query_filter,
+        search_params=search_params,
         limit=top_k,
         with_payload=True,
         with_vectors=False,
     )
     # 结果：[{point.id, score, payload:{page_id,url,title}}...]
-    return res
-
-# --- 辅助：PG基于 pg_trgm 的词法检索（按 content 相似度）---
-def _pg_lexical_search(q: str, limit: int = 10):
-    sql = """
-    SELECT p.id AS page_id, p.url, p.title, p.site, p.published_at, p.fetched_at,
-           substring(p.content for 400) AS snippet,
-           similarity(p.content, %s) AS score
-    FROM pages p
-    WHERE p.content ILIKE %s
+    return res.points or []
+
+# --- 辅助：检索过滤条件（site / lang / 时间范围），同时下推到 Qdrant 与 PG ---
+def _parse_ts(val) -> Optional[datetime]:
+    if val in (None, ""):
+        return None
+    if isinstance(val, (int, float)):
+        return datetime.utcfromtimestamp(val)
+    ts = datetime.fromisoformat(str(val).strip().replace("Z", "+00:00"))
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return ts
+
+def _parse_search_filters(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    支持字段（均可选）：
+      site / lang: 字符串或字符串数组（精确匹配）
+      published_after / published_before / fetched_after / fetched_before:
+        ISO8601 字符串或 UTC 秒级时间戳（闭区间）
+    非法时间格式抛 ValueError
+    """
+    filters: Dict[str, Any] = {}
+    for key in ("site", "lang"):
+        val = data.get(key)
+        if isinstance(val, str):
+            val = [val]
+        vals = [str(v).strip() for v in (val or []) if str(v or "").strip()]
+        if vals:
+            filters[key] = vals
+    for key in ("published_after", "published_before", "fetched_after", "fetched_before"):
+        try:
+            ts = _parse_ts(data.get(key))
+        except (TypeError, ValueError, OverflowError, OSError):
+            raise ValueError(f"invalid {key}")
+        if ts is not None:
+            filters[key] = ts
+    return filters
+
+def _qdrant_filter(filters: Dict[str, Any]) -> Optional[Filter]:
+    must = []
+    for key in ("site", "lang"):
+        if filters.get(key):
+            must.append(FieldCondition(key=key, match=MatchAny(any=filters[key])))
+    for field in ("published_at", "fetched_at"):
+        prefix = field.split("_")[0]
+        gte = _epoch(filters.get(f"{prefix}_after"))
+        lte = _epoch(filters.get(f"{prefix}_before"))
+        if gte is not None or lte is not None:
+            must.append(FieldCondition(key=field, range=Range(gte=gte, lte=lte)))
+    return Filter(must=must) if must else None
+
+def _pg_filter_clause(filters: Dict[str, Any], alias: str = "p"):
+    clauses, params = [], []
+    for key in ("site", "lang"):
+        if filters.get(key):
+            clauses.append(f"{alias}.{key} = ANY(%s)")
+            params.append(filters[key])
+    for field in ("published_at", "fetched_at"):
+        prefix = field.split("_")[0]
+        if filters.get(f"{prefix}_after") is not None:
+            clauses.append(f"{alias}.{field} >= %s")
+            params.append(filters[f"{prefix}_after"])
+        if filters.get(f"{prefix}_before") is not None:
+            clauses.append(f"{alias}.{field} <= %s")
+            params.append(filters[f"{prefix}_before"])
+    return "".join(f" AND {c}" for c in clauses), params
+
+# --- 辅助：PG基于 pg_trgm 的 chunk 级词法检索（按 chunk 内容相似度）---
+def _pg_lexical_search(q: str, limit: int = 10, filters: Optional[Dict[str, Any]] = None):
+    # 只取 id 与分数；页面元数据统一在补全阶段一次取回，pages 仅在有过滤时 JOIN
+    where, params = _pg_filter_clause(filters or {})
+    join = "JOIN pages p ON p.id = c.page_id" if where else ""
+    sql = f"""
+    SELECT c.id AS chunk_id, c.page_id,
+           similarity(c.content, %s) AS score
+    FROM chunks c
+    {join}
+    WHERE c.content ILIKE %s{where}
     ORDER BY score DESC
     LIMIT %s
     """
     with get_pg_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(sql, (q, f"%{q}%", limit))
+        cur.execute(sql, (q, f"%{q}%", *params, limit))
         rows = cur.fetchall() or []
     return rows
 
-# --- 辅助：按 chunk_id 批量取 chunk 内容（用于向量检索的片段预览）---
-def _get_chunks_by_ids(chunk_ids: List[int]) -> Dict[int, str]:
+# --- 辅助：候选补全（单次查询：chunk 片段 + 重排所需全文 + 未缓存页面的元数据）---
+PAGE_META_FIELDS = ("url", "title", "site", "published_at", "fetched_at")
+
+def _query_terms(q: str, max_terms: int = 8) -> List[str]:
+    """snippet 定位用的查询词：小写、去重，并去掉被其他词包含的短词（避免高亮重叠）"""
+    terms = list(dict.fromkeys(t for t in re.split(r"[\s,，。;；:：!！?？\"'()（）]+", (q or "").lower()) if t))
+    terms = [t for t in terms if not any(t != o and t in o for o in terms)]
+    return terms[:max_terms]
+
+# snippet 窗口：以命中查询词最多的位置为中心（并列取最靠前），无命中则取开头；
+# highlights 为 snippet 内每个查询词首次出现的 [offset, length]
+_HYDRATE_SQL = """
+SELECT c.id AS chunk_id, c.page_id,
+       w.start - 1 AS snippet_offset,
+       substring(c.content from w.start for %(win)s) AS snippet,
+       hl.highlights,
+       CASE WHEN c.id = ANY(%(full_ids)s) THEN c.content END AS content,
+       p.id AS meta_page_id, p.url, p.title, p.site, p.published_at, p.fetched_at
+FROM chunks c
+LEFT JOIN pages p ON p.id = c.page_id AND NOT (p.id = ANY(%(cached_ids)s))
+CROSS JOIN LATERAL (
+    SELECT greatest(1, least(
+               coalesce((
+                   SELECT m.pos
+                   FROM (SELECT strpos(lower(c.content), t.term) AS pos
+                         FROM unnest(%(terms)s::text[]) AS t(term)) m
+                   WHERE m.pos > 0
+                   ORDER BY (SELECT count(*)
+                             FROM unnest(%(terms)s::text[]) AS u(term)
+                             WHERE strpos(lower(substring(c.content from greatest(1, m.pos - %(half)s) for %(win)s)),
+                                          u.term) > 0) DESC,
+                            m.pos
+                   LIMIT 1), 1) - %(half)s,
+               char_length(c.content) - %(win)s + 1)) AS start
+) w
+CROSS JOIN LATERAL (
+    SELECT coalesce(json_agg(json_build_array(h.pos - 1, char_length(h.term)) ORDER BY h.pos), '[]'::json) AS highlights
+    FROM (SELECT u.term, strpos(lower(substring(c.content from w.start for %(win)s)), u.term) AS pos
+          FROM unnest(%(terms)s::text[]) AS u(term)) h
+    WHERE h.pos > 0
+) hl
+WHERE c.id = ANY(%(ids)s)
+"""
+
+def _hydrate_candidates(cands: List[dict], q: str = "", full_text_ids=()) -> Dict[int, dict]:
+    """
+    cands: 含 chunk_id / page_id 的候选；full_text_ids: 需要返回完整 content 的 chunk（重排用）
+    返回 {chunk_id: {"page_id", "snippet", "snippet_offset", "highlights", "content", "meta"}}；
+    snippet 按查询词在库内截取，页面元数据命中 LRU 时不再回传
+    """
+    chunk_ids = list(dict.fromkeys(int(c["chunk_id"]) for c in cands))
     if not chunk_ids:
         return {}
-    sql = "SELECT id, content FROM chunks WHERE id = ANY(%s)"
-    with get_pg_conn() as conn, conn.cursor() as cur:
-        cur.execute(sql, (chunk_ids,))
+    page_ids = list(dict.fromkeys(int(c["page_id"]) for c in cands))
+    cached = _page_meta_cache.get_many(page_ids)
+    win = max(1, WEB_CONFIG["SNIPPET_CHARS"])
+    params = {
+        "win": win,
+        "half": win // 2,
+        "terms": _query_terms(q),
+        "full_ids": [int(i) for i in full_text_ids],
+        "cached_ids": list(cached),
+        "ids": chunk_ids,
+    }
+    with get_pg_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(_HYDRATE_SQL, params)
         rows = cur.fetchall() or []
-    return {rid: rcontent for (rid, rcontent) in rows}
 
-# --- 辅助：取页面基本信息 ---
-def _get_pages_by_ids(page_ids: List[int]) -> Dict[int, dict]:
-    if not page_ids:
+    out: Dict[int, dict] = {}
+    for row in rows:
+        pid = row["page_id"]
+        if row["meta_page_id"] is not None and pid not in cached:
+            cached[pid] = {k: row[k] for k in PAGE_META_FIELDS}
+            _page_meta_cache.put(pid, cached[pid])
+        out[row["chunk_id"]] = {
+            "page_id": pid,
+            "snippet": row["snippet"] or "",
+            "snippet_offset": int(row["snippet_offset"] or 0),
+            "highlights": row["highlights"] or [],
+            "content": row["content"],
+            "meta": cached.get(pid) or {},
+        }
+    return out
+
+def _hydration_targets(fused: List[dict], top_k: int, rerank_top_n: int = 0) -> List[dict]:
+    """重排前 N 个 chunk + 融合顺序下前 top_k 个 page 的最佳 chunk：重排后结果必在其中"""
+    targets = {rec["chunk_id"]: rec for rec in fused[:rerank_top_n]}
+    for page in _group_pages(fused, top_k):
+        targets.setdefault(page["chunk_id"], page)
+    return list(targets.values())
+
+# --- 检索两路：统一输出 chunk 粒度的命中 ---
+def _vector_leg(q: str, depth: int, filters: Optional[Dict[str, Any]] = None,
+                oversampling: Optional[float] = None) -> List[dict]:
+    qvec = _embed_query(q)
+    hits = []
+    for h in _qdrant_search(qvec, top_k=depth, query_filter=_qdrant_filter(filters or {}),
+                            oversampling=oversampling):
+        try:
+            pid = int(h.payload.get("page_id"))
+        except Exception:
+            continue
+        hits.append({
+            "chunk_id": int(h.id),
+            "page_id": pid,
+            "url": h.payload.get("url"),
+            "title": h.payload.get("title"),
+            "score": float(h.score or 0.0),
+        })
+    return hits
+
+def _lexical_leg(q: str, depth: int, filters: Optional[Dict[str, Any]] = None) -> List[dict]:
+    return [
+        {
+            "chunk_id": int(r["chunk_id"]),
+            "page_id": int(r["page_id"]),
+            "score": float(r["score"] or 0.0),
+        }
+        for r in _pg_lexical_search(q, limit=depth, filters=filters)
+    ]
+
+# --- 融合：先在 chunk 级融合，再按 page 聚合 ---
+FUSION_METHODS = ("rrf", "wrrf", "alpha")
+
+def _minmax(hits: List[dict]) -> Dict[int, float]:
+    if not hits:
         return {}
-    sql = """SELECT id AS page_id, url, title, site, published_at, fetched_at
-             FROM pages WHERE id = ANY(%s)"""
+    scores = [h["score"] for h in hits]
+    mn, mx = min(scores), max(scores)
+    if mx <= mn:
+        return {h["chunk_id"]: 1.0 for h in hits}
+    return {h["chunk_id"]: (h["score"] - mn) / (mx - mn) for h in hits}
+
+def _fuse_chunks(vec_hits: List[dict], lex_hits: List[dict], method: str,
+                 alpha: float, rrf_k: int) -> List[dict]:
+    """
+    method:
+      - rrf   : 1/(k+rank_v) + 1/(k+rank_l)
+      - wrrf  : alpha/(k+rank_v) + (1-alpha)/(k+rank_l)
+      - alpha : alpha*minmax(score_v) + (1-alpha)*minmax(score_l)（归一化范围为整路候选）
+      - 其他  : 单路模式，保留原始分数
+    某路未命中的 chunk 在该路贡献为 0。
+    """
+    by_cid: Dict[int, dict] = {}
+    for leg, hits in (("vector", vec_hits), ("lexical", lex_hits)):
+        for rank, h in enumerate(hits, 1):
+            rec = by_cid.get(h["chunk_id"])
+            if rec is None:
+                rec = {
+                    "chunk_id": h["chunk_id"], "page_id": h["page_id"],
+                    "url": h.get("url"), "title": h.get("title"),
+                    "score_vector": 0.0, "score_lexical": 0.0,
+                    "rank_vector": None, "rank_lexical": None,
+                }
+                by_cid[h["chunk_id"]] = rec
+            rec[f"score_{leg}"] = h["score"]
+            rec[f"rank_{leg}"] = rank
+            if not rec.get("url"):
+                rec["url"], rec["title"] = h.get("url"), h.get("title")
+
+    if method == "alpha":
+        v_norm, l_norm = _minmax(vec_hits), _minmax(lex_hits)
+        for cid, rec in by_cid.items():
+            rec["score"] = alpha * v_norm.get(cid, 0.0) + (1 - alpha) * l_norm.get(cid, 0.0)
+    elif method in ("rrf", "wrrf"):
+        wv, wl = (alpha, 1 - alpha) if method == "wrrf" else (1.0, 1.0)
+        for rec in by_cid.values():
+            s = 0.0
+            if rec["rank_vector"]:
+                s += wv / (rrf_k + rec["rank_vector"])
+            if rec["rank_lexical"]:
+                s += wl / (rrf_k + rec["rank_lexical"])
+            rec["score"] = s
+    else:
+        for rec in by_cid.values():
+            rec["score"] = rec["score_vector"] if rec["rank_vector"] else rec["score_lexical"]
+
+    return sorted(by_cid.values(), key=lambda x: x["score"], reverse=True)
+
+def _group_pages(fused: List[dict], limit: int) -> List[dict]:
+    """按 page 聚合：page 分数取其最佳 chunk，snippet 也取自该 chunk"""
+    pages: Dict[int, dict] = {}
+    for rec in fused:
+        page = pages.get(rec["page_id"])
+        if page is None:
+            pages[rec["page_id"]] = {
+                "page_id": rec["page_id"],
+                "url": rec.get("url"),
+                "title": rec.get("title"),
+                "chunk_id": rec["chunk_id"],
+                "score": rec["score"],
+                "score_vector": rec["score_vector"],
+                "score_lexical": rec["score_lexical"],
+            }
+            if "score_rerank" in rec:
+                pages[rec["page_id"]]["score_rerank"] = rec["score_rerank"]
+            continue
+        page["score_vector"] = max(page["score_vector"], rec["score_vector"])
+        page["score_lexical"] = max(page["score_lexical"], rec["score_lexical"])
+    return list(pages.values())[:limit]
+
+# --- 召回深度：按两路重叠率与 chunk→page 折叠率自适应（替代固定的 top_k * 3）---
+# 只用无过滤的 hybrid 检索更新统计：单路检索没有重叠率，过滤检索的候选集偏小，
+# 混入会把全站共享的估计拉偏；其它检索沿用这份估计但不改变它
+class _LegDepthTuner:
+    def __init__(self, decay: float = 0.1):
+        self._lock = threading.Lock()
+        self._decay = decay
+        # 初值对应旧行为（约 top_k * 3），随观测逐步收紧
+        self.overlap = 0.0      # |V∩L| / min(|V|, |L|)
+        self.page_ratio = 0.2   # 去重后 page 数 / chunk 数
+
+    def depth(self, top_k: int, mode: str) -> int:
+        with self._lock:
+            overlap, page_ratio = self.overlap, self.page_ratio
+        legs = (2.0 - overlap) if mode == "hybrid" else 1.0
+        need = math.ceil(top_k * WEB_CONFIG["SEARCH_DEPTH_MARGIN"] / (legs * max(page_ratio, 1e-3)))
+        return max(top_k, min(top_k * 3, need))
+
+    def observe(self, vec_hits: List[dict], lex_hits: List[dict], fused: List[dict]):
+        if not fused:
+            return
+        d = self._decay
+        page_ratio = len({r["page_id"] for r in fused}) / len(fused)
+        with self._lock:
+            self.page_ratio = (1 - d) * self.page_ratio + d * page_ratio
+            if vec_hits and lex_hits:
+                shared = {h["chunk_id"] for h in vec_hits} & {h["chunk_id"] for h in lex_hits}
+                overlap = len(shared) / min(len(vec_hits), len(lex_hits))
+                self.overlap = (1 - d) * self.overlap + d * overlap
+
+_depth_tuner = _LegDepthTuner()
+
+# --- 二阶段重排：融合后的前 N 个 chunk 一次性送 /rerank，超预算回退融合顺序 ---
+def _rerank_chunks(q: str, fused: List[dict], top_n: int, budget_ms: int, id2chunk: Dict[int, str],
+                   started: Optional[float] = None):
+    """
+    返回 (新顺序, 状态)；仅重排前 top_n 个，其余保持融合顺序；id2chunk 为补全阶段取回的全文。
+    started 为重排阶段开始时刻（perf_counter，取全文的补全之前），预算从此刻起算。
+    """
+    t0 = started if started is not None else time.perf_counter()
+    head = [r for r in fused[:top_n] if id2chunk.get(r["chunk_id"])]
+    if len(head) < 2:
+        return fused, {"applied": False, "reason": "too_few_candidates"}
+    try:
+        remaining = budget_ms / 1000.0 - (time.perf_counter() - t0)
+        if remaining <= 0:
+            return fused, {"applied": False, "reason": "budget_exceeded"}
+        r = requests.post(
+            f"{WEB_CONFIG['EMBEDDING_API_BASE']}{WEB_CONFIG['RERANK_API_PATH']}",
+            # id 带内容摘要：chunk 内容更新后不会命中服务端按 id 缓存的旧向量
+            json={"query": q, "priority": "interactive",
+                  "candidates": [{"id": f"{h['chunk_id']}:{checksum_text(id2chunk[h['chunk_id']])[:16]}",
+                                  "text": id2chunk[h["chunk_id"]]} for h in head]},
+            timeout=remaining,
+        )
+        r.raise_for_status()
+        results = r.json().get("results") or []
+    except requests.Timeout:
+        return fused, {"applied": False, "reason": "budget_exceeded"}
+    except Exception as e:
+        print("Rerank 失败，回退融合顺序:", e)
+        return fused, {"applied": False, "reason": "error"}
+    if (time.perf_counter() - t0) * 1000 > budget_ms:
+        return fused, {"applied": False, "reason": "budget_exceeded"}
+
+    reranked, seen = [], set()
+    for item in results:
+        idx = int(item.get("index", -1))
+        if 0 <= idx < len(head) and idx not in seen:
+            seen.add(idx)
+            rec = dict(head[idx])
+            rec["score_rerank"] = float(item.get("score") or 0.0)
+            reranked.append(rec)
+    reranked_ids = {rec["chunk_id"] for rec in reranked}
+    tail = [rec for rec in fused if rec["chunk_id"] not in reranked_ids]
+    return reranked + tail, {"applied": True, "candidates": len(reranked)}
+
+# --- /web/search 公共流程：参数解析 → 两路并发召回 → 融合 → 补全 → 重排 ---
+_search_pool = ThreadPoolExecutor(max_workers=WEB_CONFIG["SEARCH_WORKERS"], thread_name_prefix="search-leg")
+
+def _as_bool(val, default: bool = False) -> bool:
+    if val is None:
+        return default
+    if isinstance(val, str):
+        return val.strip().lower() in ("1", "true", "yes", "y", "on")
+    return bool(val)
+
+def _parse_search_params(data: Dict[str, Any]) -> Dict[str, Any]:
+    """校验并归一化检索参数；非法时抛 ValueError"""
+    q = (data.get("q") or "").strip()
+    if not q:
+        raise ValueError("missing q")
+    fusion = (data.get("fusion") or WEB_CONFIG["SEARCH_FUSION"]).lower()
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"fusion must be one of {list(FUSION_METHODS)}")
+    try:
+        return {
+            "q": q,
+            "top_k": max(1, min(50, int(data.get("top_k") or 10))),
+            "mode": (data.get("mode") or "hybrid").lower(),
+            # alpha=0 是合法取值（纯词法权重），不能当作缺省
+            "alpha": min(1.0, max(0.0, float(data["alpha"]) if data.get("alpha") not in (None, "") else 0.6)),
+            "fusion": fusion,
+            "rrf_k": max(1, int(data.get("rrf_k") or WEB_CONFIG["RRF_K"])),
+            "rerank": _as_bool(data.get("rerank"), WEB_CONFIG["SEARCH_RERANK"]),
+            "rerank_top_n": max(2, min(100, int(data.get("rerank_top_n") or WEB_CONFIG["RERANK_TOP_N"]))),
+            "rerank_budget_ms": max(1, int(data.get("rerank_budget_ms") or WEB_CONFIG["RERANK_BUDGET_MS"])),
+            "max_results": max(1, min(WEB_CONFIG["SEARCH_MAX_RESULTS"], int(data.get("max_results") or 0))),
+            "oversampling": float(data["oversampling"]) if data.get("oversampling") else None,
+            "filters": _parse_search_filters(data),
+        }
+    except (TypeError, ValueError) as e:
+        raise ValueError(str(e) or "invalid parameter")
+
+def _render_pages(pages: List[dict], hydrated: Dict[int, dict], source: str) -> List[dict]:
+    for m in pages:
+        h = hydrated.get(m["chunk_id"]) or {}
+        meta = h.get("meta") or {}
+        m["snippet"] = h.get("snippet") or ""
+        m["snippet_offset"] = h.get("snippet_offset", 0)
+        m["highlights"] = h.get("highlights") or []
+        m["source"] = source
+        m["url"] = meta.get("url") or m.get("url")
+        m["title"] = meta.get("title") or m.get("title")
+        m["site"] = meta.get("site")
+        m["published_at"] = (
+            meta.get("published_at").isoformat() if meta.get("published_at") else None
+        )
+        m["fetched_at"] = (
+            meta.get("fetched_at").isoformat() if meta.get("fetched_at") else None
+        )
+    return pages
+
+# --- 搜索游标：冻结首次检索的候选（page_id, chunk_id, 分数），后续翻页不再重新召回 ---
+# 候选存于 PG 表 search_cursors（多进程部署共享）；游标为签名 JWT，只携带
+# 游标 id、偏移、每页条数与 (q, mode, filters) 的摘要，翻页请求带查询参数时须与之一致
+SEARCH_CURSOR_TYPE = "search_cursor"
+
+def _search_scope(params: Dict[str, Any]) -> str:
+    filters = {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in (params.get("filters") or {}).items()}
+    raw = json.dumps([params["q"], params["mode"], filters], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+def _cursor_token(cursor_id: str, offset: int, top_k: int, scope: str) -> str:
+    token, _ = make_jwt("search", WEB_CONFIG["SEARCH_CURSOR_TTL_MIN"], token_type=SEARCH_CURSOR_TYPE,
+                        extra_claims={"c": cursor_id, "o": offset, "k": top_k, "s": scope})
+    return token
+
+def _make_search_cursor(params: Dict[str, Any], rest: List[dict]) -> Optional[str]:
+    if not rest:
+        return None
+    frozen = [
+        [m["page_id"], m["chunk_id"], round(m["score"], 6), round(m["score_vector"], 6),
+         round(m["score_lexical"], 6), m.get("score_rerank")]
+        for m in rest
+    ]
+    cursor_id = os.urandom(16).hex()
+    scope = _search_scope(params)
+    now = datetime.utcnow()
+    with get_pg_conn() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM search_cursors WHERE expires_at < %s", (now,))
+        cur.execute("""INSERT INTO search_cursors (id, scope, q, mode, results, expires_at)
+                       VALUES (%s,%s,%s,%s,%s,%s)""",
+                    (cursor_id, scope, params["q"], params["mode"], Json(frozen),
+                     now + dt.timedelta(minutes=WEB_CONFIG["SEARCH_CURSOR_TTL_MIN"])))
+        conn.commit()
+    return _cursor_token(cursor_id, 0, params["top_k"], scope)
+
+def _search_from_cursor(cursor: str, request_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    按游标取下一页：只做补全，不重新检索。request_params 为翻页请求自带的检索参数
+    （可选），其 q / mode / filters 须与首次检索一致；游标无效、过期或不匹配抛 ValueError
+    """
+    try:
+        claims = decode_jwt(cursor)
+    except jwt.InvalidTokenError:
+        raise ValueError("invalid or expired cursor")
+    if claims.get("type") != SEARCH_CURSOR_TYPE:
+        raise ValueError("invalid cursor")
+    if request_params is not None and _search_scope(request_params) != claims["s"]:
+        raise ValueError("cursor does not match this query / mode / filters")
+    t_start = time.perf_counter()
     with get_pg_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(sql, (page_ids,))
-        rows = cur.fetchall() or []
-    return {row["page_id"]: row for row in rows}
+        cur.execute("SELECT scope, q, mode, results FROM search_cursors WHERE id=%s AND expires_at >= %s",
+                    (claims["c"], datetime.utcnow()))
+        row = cur.fetchone()
+    if not row or row["scope"] != claims["s"]:
+        raise ValueError("invalid or expired cursor")
+    params = {"q": row["q"], "mode": row["mode"], "top_k": int(claims["k"])}
+    offset = int(claims["o"])
+    pages = []
+    for pid, cid, score, sv, sl, srr in row["results"][offset:offset + params["top_k"]]:
+        page = {"page_id": pid, "chunk_id": cid, "score": score, "score_vector": sv, "score_lexical": sl}
+        if srr is not None:
+            page["score_rerank"] = srr
+        pages.append(page)
+    next_offset = offset + params["top_k"]
+    hydrated = _hydrate_candidates(pages, q=params["q"])
+    source = params["mode"] if params["mode"] in ("vector", "lexical") else "hybrid"
+    return {
+        "success": True,
+        "q": params["q"],
+        "mode": params["mode"],
+        "top_k": params["top_k"],
+        "results": _render_pages(pages, hydrated, source),
+        "next_cursor": (_cursor_token(claims["c"], next_offset, params["top_k"], claims["s"])
+                        if next_offset < len(row["results"]) else None),
+        "elapsed_ms": round((time.perf_counter() - t_start) * 1000, 2),
+    }
+
+def _search_events(params: Dict[str, Any], progressive: bool = False):
+    """
+    生成 (event, payload)：
+      progressive=True 时每路召回返回即产出 "lexical" / "vector"（该路单独的 page 结果），
+      最后总是产出 "final"（融合 + 可选重排后的结果，含 timings_ms）。
+    两路在线程池中并发执行；已补全的 chunk 在各事件间复用，不重复查询。
+    """
+    q, top_k, mode = params["q"], params["top_k"], params["mode"]
+    filters = params["filters"]
+    t_start = time.perf_counter()
+    timings: Dict[str, float] = {}
+
+    def _lap(stage: str, t0: float):
+        timings[stage] = round((time.perf_counter() - t0) * 1000, 2)
+
+    def _elapsed_ms() -> float:
+        return round((time.perf_counter() - t_start) * 1000, 2)
+
+    hydrated: Dict[int, dict] = {}
+
+    def _hydrate(cands: List[dict], full_ids=()):
+        full_ids = set(full_ids)
+        missing = [c for c in cands
+                   if c["chunk_id"] not in hydrated
+                   or (c["chunk_id"] in full_ids and hydrated[c["chunk_id"]]["content"] is None)]
+        if missing:
+            hydrated.update(_hydrate_candidates(missing, q=q, full_text_ids=full_ids))
+
+    def _run_leg(leg: str):
+        t0 = time.perf_counter()
+        try:
+            if leg == "vector":
+                hits = _vector_leg(q, depth, filters, params.get("oversampling"))
+            else:
+                hits = _lexical_leg(q, depth, filters)
+            error = None
+        except Exception as e:
+            print("Qdrant 查询失败:" if leg == "vector" else "Postgres 词法检索失败:", e)
+            hits, error = [], str(e)
+        return leg, hits, error, round((time.perf_counter() - t0) * 1000, 2)
+
+    # 分页时按可翻阅的结果总数决定召回深度，候选一次冻结进游标
+    max_results = max(top_k, params.get("max_results") or top_k)
+    depth = _depth_tuner.depth(max_results, mode)
+    legs = [leg for leg in ("lexical", "vector") if mode in (leg, "hybrid")]
+    leg_hits: Dict[str, List[dict]] = {"vector": [], "lexical": []}
+
+    # 1) 两路并发召回（vector 含 query embedding）；每路完成即可推送
+    futures = [_search_pool.submit(_run_leg, leg) for leg in legs]
+    for fut in as_completed(futures):
+        leg, hits, error, took = fut.result()
+        leg_hits[leg] = hits
+        timings[leg] = took
+        if progressive:
+            t0 = time.perf_counter()
+            pages = _group_pages(_fuse_chunks(*((hits, []) if leg == "vector" else ([], hits)),
+                                              "raw", params["alpha"], params["rrf_k"]), top_k)
+            _hydrate(pages)
+            _lap(f"hydrate_{leg}", t0)
+            yield leg, {"results": _render_pages(pages, hydrated, leg), "error": error,
+                        "took_ms": took, "elapsed_ms": _elapsed_ms()}
+
+    # 2) chunk 级融合
+    vec_hits, lex_hits = leg_hits["vector"], leg_hits["lexical"]
+    t0 = time.perf_counter()
+    fused = _fuse_chunks(vec_hits, lex_hits, params["fusion"] if mode == "hybrid" else "raw",
+                         params["alpha"], params["rrf_k"])
+    if mode == "hybrid" and not filters:
+        _depth_tuner.observe(vec_hits, lex_hits, fused)
+    _lap("fusion", t0)
+
+    # 3) 候选补全：一次查询取回 snippet、重排全文与页面元数据（重排预算含这一步）
+    t0 = t_rerank = time.perf_counter()
+    rerank_n = params["rerank_top_n"] if params["rerank"] else 0
+    if fused:
+        _hydrate(_hydration_targets(fused, top_k, rerank_n), [rec["chunk_id"] for rec in fused[:rerank_n]])
+    _lap("hydrate", t0)
+
+    # 4) 可选二阶段重排 → page 聚合
+    rerank_info = {"applied": False, "reason": "disabled"}
+    if params["rerank"] and fused:
+        t0 = time.perf_counter()
+        id2text = {cid: h["content"] for cid, h in hydrated.items() if h["content"]}
+        fused, rerank_info = _rerank_chunks(q, fused, params["rerank_top_n"], params["rerank_budget_ms"], id2text,
+                                            started=t_rerank)
+        _lap("rerank", t0)
+    grouped = _group_pages(fused, max_results)
+    merged = _render_pages(grouped[:top_k], hydrated, mode if mode in ("vector", "lexical") else "hybrid")
+    _lap("total", t_start)
+
+    yield "final", {
+        "success": True,
+        "q": q,
+        "mode": mode,
+        "fusion": params["fusion"],
+        "rerank": rerank_info,
+        "timings_ms": timings,
+        "alpha": params["alpha"],
+        "top_k": top_k,
+        "depth": depth,
+        "filters": {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in filters.items()},
+        "results": merged or [],
+        "max_results": max_results,
+        "next_cursor": _make_search_cursor(params, grouped[top_k:]),
+        "elapsed_ms": _elapsed_ms(),
+    }
 
 # --- /web/search：支持 vector / lexical / hybrid ---
 @web_bp.post("/search")
@@ -457,140 +1367,96 @@ def web_search():
         "q": "query string",
         "top_k": 10,
         "mode": "hybrid",   # "vector" | "lexical" | "hybrid"
-        "alpha": 0.6
+        "fusion": "rrf",    # "rrf" | "wrrf" | "alpha"（仅 hybrid）
+        "alpha": 0.6,       # wrrf / alpha 融合中向量路的权重
+        "rrf_k": 60,
+        # 可选过滤（同时下推到 Qdrant payload 索引与 PG WHERE）：
+        "site": "www.python.org",          # 或数组
+        "lang": ["zh", "zh-cn"],           # 或字符串
+        "published_after": "2024-01-01T00:00:00Z",
+        "fetched_before": 1735689600,      # ISO8601 或 UTC 秒级时间戳
+        # 可选二阶段重排：
+        "rerank": true,
+        "rerank_top_n": 20,
+        "rerank_budget_ms": 300,           # 超时回退融合顺序
+        # 可选游标分页：top_k 为每页条数，max_results 为可翻阅总数（冻结于 next_cursor）
+        "max_results": 200,
+        # 向量量化时的过采样倍数（量化分数取 top_k * oversampling，再用原始向量重打分）
+        "oversampling": 2.0
       }
-    输出：统一为 page 粒度，含 snippet
+    翻页：{"cursor": "<上一页的 next_cursor>"}（不重新检索，其余参数沿用首次请求；
+          若同时带 q，则 q / mode / 过滤条件须与首次请求一致，否则 400）
+    输出：统一为 page 粒度；snippet 为最佳 chunk 中围绕查询词的窗口（snippet_offset 为其在 chunk 内的偏移，
+          highlights 为 snippet 内的 [offset, length]）；timings_ms 为各阶段耗时
     """
     data = request.get_json(force=True) or {}
-    q = (data.get("q") or "").strip()
-    if not q:
-        return jsonify({"success": False, "error": "missing q"}), 400
+    if data.get("cursor"):
+        try:
+            request_params = _parse_search_params(data) if data.get("q") else None
+            return jsonify(_search_from_cursor(str(data["cursor"]), request_params))
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+    try:
+        params = _parse_search_params(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
 
-    top_k = int(data.get("top_k") or 10)
-    mode = (data.get("mode") or "hybrid").lower()
-    alpha = float(data.get("alpha") or 0.6)
-    top_k = max(1, min(50, top_k))
-    alpha = min(1.0, max(0.0, alpha))
+    final = {}
+    for _, payload in _search_events(params):
+        final = payload
+    return jsonify(final)
 
-    vec_res, lex_res = [], []
+# --- /web/search/stream：SSE 渐进返回（lexical / vector 各自先到先推，最后推 final）---
+def _sse(event: str, payload: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
 
-    # 1) 向量检索
-    if mode in ("vector", "hybrid"):
-        try:
-            qvec = _embed_query(q)
-            # ⚠️ 用 query_points 替代 search
-            vec_hits = client.query_points(
-                collection_name=QDRANT_COLLECTION,
-                query=qvec,
-                limit=top_k * 3,
-                with_payload=True,
-            ).points or []
-        except Exception as e:
-            print("Qdrant 查询失败:", e)
-            vec_hits = []
-
-        page_best = {}
-        if vec_hits:
-            chunk_ids = [int(h.id) for h in vec_hits]
-            id2chunk = _get_chunks_by_ids(chunk_ids)
-
-            for h in vec_hits:
-                try:
-                    pid = int(h.payload.get("page_id"))
-                except Exception:
-                    continue
-                score = float(h.score or 0.0)
-                if (pid not in page_best) or (score > page_best[pid]["score"]):
-                    chunk_text = (id2chunk.get(int(h.id)) or "")[:400]
-                    page_best[pid] = {
-                        "page_id": pid,
-                        "url": h.payload.get("url"),
-                        "title": h.payload.get("title"),
-                        "score": score,
-                        "snippet": chunk_text,
-                        "source": "vector",
-                    }
-        vec_res = sorted(page_best.values(), key=lambda x: x["score"], reverse=True)[:top_k]
-
-    # 2) 词法检索
-    if mode in ("lexical", "hybrid"):
+@web_bp.route("/search/stream", methods=["GET", "POST"])
+def web_search_stream():
+    """
+    参数同 /web/search（POST JSON，或 GET 查询串，site/lang 可重复）。
+    事件：
+      lexical / vector : 单路结果（含 took_ms / elapsed_ms），按返回先后推送
+      final            : 融合与重排后的最终结果（同 /web/search 响应）
+      error            : 处理失败
+    """
+    if request.method == "POST":
+        data = request.get_json(force=True, silent=True) or {}
+    else:
+        data = request.args.to_dict()
+        for key in ("site", "lang"):
+            if len(request.args.getlist(key)) > 1:
+                data[key] = request.args.getlist(key)
+    try:
+        params = _parse_search_params(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    def generate():
         try:
-            lex_rows = _pg_lexical_search(q, limit=top_k * 3) or []
+            for event, payload in _search_events(params, progressive=True):
+                yield _sse(event, payload)
         except Exception as e:
-            print("Postgres 词法检索失败:", e)
-            lex_rows = []
-
-        for r in lex_rows:
-            r["source"] = "lexical"
-        lex_res = lex_rows[:top_k]
-
-    # 3) 融合
-    if mode == "vector":
-        merged = vec_res
-    elif mode == "lexical":
-        merged = lex_res
-    else:
-        # hybrid 融合
-        def _norm(scores):
-            if not scores:
-                return {}
-            mn, mx = min(scores), max(scores)
-            if mx <= mn:
-                return {i: 1.0 for i in range(len(scores))}
-            return {i: (s - mn) / (mx - mn) for i, s in enumerate(scores)}
-
-        v_scores = _norm([x["score"] for x in vec_res]) if vec_res else {}
-        l_scores = _norm([x["score"] for x in lex_res]) if lex_res else {}
-
-        pid2vec = {x["page_id"]: (i, x) for i, x in enumerate(vec_res)}
-        pid2lex = {x["page_id"]: (i, x) for i, x in enumerate(lex_res)}
-        all_pids = set(pid2vec) | set(pid2lex)
-
-        by_pid = {}
-        for pid in all_pids:
-            v_i, v_item = pid2vec.get(pid, (None, None))
-            l_i, l_item = pid2lex.get(pid, (None, None))
-            vnorm = v_scores.get(v_i, 0.0) if v_item else 0.0
-            lnorm = l_scores.get(l_i, 0.0) if l_item else 0.0
-            fused = alpha * vnorm + (1 - alpha) * lnorm
-
-            base = v_item or l_item
-            rec = {
-                "page_id": pid,
-                "url": base.get("url"),
-                "title": base.get("title"),
-                "snippet": base.get("snippet"),
-                "score_vector": v_item["score"] if v_item else 0.0,
-                "score_lexical": l_item["score"] if l_item else 0.0,
-                "score": fused,
-                "source": "hybrid",
-            }
-            by_pid[pid] = rec
+            yield _sse("error", {"success": False, "error": str(e)})
 
-        merged = sorted(by_pid.values(), key=lambda x: x["score"], reverse=True)[:top_k]
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    # 4) 补充页面元数据
-    pages = _get_pages_by_ids([m["page_id"] for m in merged]) if merged else {}
-    for m in merged:
-        meta = pages.get(m["page_id"]) or {}
-        m["site"] = meta.get("site")
-        m["published_at"] = (
-            meta.get("published_at").isoformat() if meta.get("published_at") else None
-        )
-        m["fetched_at"] = (
-            meta.get("fetched_at").isoformat() if meta.get("fetched_at") else None
-        )
+# --- /web/page：返回 page 详情与其 chunks（可分页）---
+def _encode_chunk_cursor(page_id: int, chunk_index: int) -> str:
+    raw = json.dumps({"p": page_id, "i": chunk_index}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
 
-    return jsonify({
-        "success": True,
-        "q": q,
-        "mode": mode,
-        "alpha": alpha,
-        "top_k": top_k,
-        "results": merged or []
-    })
+def _decode_chunk_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return int(data["p"]), int(data["i"])
+    except Exception:
+        raise ValueError("invalid cursor")
 
-# --- /web/page：返回 page 详情与其 chunks（可分页）---
 @web_bp.get("/page")
 def web_page():
     """
@@ -598,7 +1464,8 @@ def web_page():
       - page_id: 必填
       - with_chunks: 0/1（默认1）
       - limit: 返回 chunk 数量（默认 50）
-      - offset: 偏移（默认 0）
+      - cursor: 上一页返回的 next_cursor（按 (page_id, chunk_index) keyset 翻页）
+      - offset: 偏移（兼容旧参数；未传 cursor 时生效，深翻页请改用 cursor）
     """
     try:
         page_id = int(request.args.get("page_id", "0"))
@@ -612,6 +1479,15 @@ def web_page():
     offset = int(request.args.get("offset", "0"))
     limit = max(1, min(200, limit))
     offset = max(0, offset)
+    after_index = -1
+    if request.args.get("cursor"):
+        try:
+            cur_pid, after_index = _decode_chunk_cursor(request.args["cursor"])
+        except ValueError:
+            return jsonify({"error": "invalid cursor"}), 400
+        if cur_pid != page_id:
+            return jsonify({"error": "cursor does not belong to page_id"}), 400
+        offset = 0
 
     # 取 page
     with get_pg_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
@@ -627,13 +1503,18 @@ def web_page():
         resp = {"page": page, "chunks": []}
 
         if with_chunks:
+            # 多取一条判断是否还有下一页
             cur.execute("""SELECT id AS chunk_id, chunk_index, substring(content for 1200) AS content
                            FROM chunks
-                           WHERE page_id=%s
+                           WHERE page_id=%s AND chunk_index > %s
                            ORDER BY chunk_index ASC
                            LIMIT %s OFFSET %s
-                        """, (page_id, limit, offset))
-            resp["chunks"] = cur.fetchall() or []
+                        """, (page_id, after_index, limit + 1, offset))
+            rows = cur.fetchall() or []
+            resp["chunks"] = rows[:limit]
+            resp["next_cursor"] = (
+                _encode_chunk_cursor(page_id, rows[limit - 1]["chunk_index"]) if len(rows) > limit else None
+            )
 
     return jsonify(resp)
 # 路由（web）
@@ -1248,6 +2129,9 @@ def initialize_startup():
     ensure_pg_schema()
     dim = probe_embedding_dim()
     ensure_qdrant_collection(dim)
+    n = backfill_qdrant_payloads()
+    if n:
+        print(f"[INFO] 已为 {n} 个页面的向量补齐过滤字段 payload")
 
 if __name__ == "__main__":
     initialize_startup()
@@ -8,40 +8,87 @@ Requirements:
   - transformers>=4.51.0
   - modelscope
   - flask
+  - numpy
 
 Optional:
+  - accelerate (low_cpu_mem_usage load: memory-mapped safetensors straight to the device)
   - flash-attn (FlashAttention-2)
   - bitsandbytes (4/8-bit quantization)
+  - onnxruntime (RUNTIME=onnx, CPU nodes)
 
 Features:
+  - Fast cold start: the HTTP listener answers at once (/health reports the startup phase,
+    /ready turns 200 when serving); tokenizer / model load, CPU profile, replicas and a
+    warmup over WARMUP_BATCH_SIZES x WARMUP_SEQ_LENS run on a background thread, with
+    per-phase timings
   - Embedding API (GET/POST), cosine similarity, rerank
+  - N x M similarity matrix (/similarity/matrix) and rerank with on-device top-k; operands may be
+    {"id", "text"} objects whose vectors are cached by id (CANDIDATE_CACHE_MAX_BYTES)
+  - Event-driven micro-batcher: idle model runs a request immediately; under load,
+    requests gather until the batch budget is full or BATCH_TIMEOUT_MS (queue-wait / fill metrics)
+  - Length-bucketed batches capped by padded tokens (BATCH_MAX_TOKENS), not item count
+  - Tokenization runs on request threads; the batch thread only pads, stacks and runs the model
+  - Opt-in sliding windows for over-length inputs (long_text=window): overlapping windows
+    are batched like any other item and combined by mean / token-weighted mean
+  - Multiple model replicas (REPLICAS / REPLICA_DEVICES / REPLICA_CPU_CORES), each with its
+    own batch worker pulling from the shared queue; per-replica health and metrics.
+    CPU replicas are pinned to their core sets, but torch's intra-op thread count is
+    process-wide: one value (CPU_THREADS / replicas, or the smallest core set) for all
+  - Prometheus text metrics (GET /metrics?format=prometheus or Accept: text/plain): histograms
+    for queue wait / tokenize / forward / serialize / request latency, batch size and tokens
+  - Admission control: bounded queue (QUEUE_MAX_ITEMS / QUEUE_MAX_TOKENS) answers 429 + Retry-After
+    when full; per-request deadlines (deadline_ms / X-Request-Deadline-Ms, default REQUEST_TIMEOUT_MS)
+    drop expired items before the forward; work of disconnected clients is cancelled
+  - Priority lanes (priority=interactive|bulk or X-Priority): interactive work is batched first
+    within INTERACTIVE_SHARE of batch capacity, bulk fills the rest; bulk items older than
+    BULK_MAX_WAIT_MS go first; queue bounds and depth metrics are per lane
+  - Streaming bulk endpoint (POST /Qwen3-Embedding-4B/stream): NDJSON or text lines in,
+    NDJSON vectors out; texts are fed to the batcher as they arrive and vectors written as
+    chunks finish, with at most STREAM_MAX_INFLIGHT chunks of STREAM_CHUNK_ITEMS in memory
+  - Bounded LRU embedding cache (fp16) checked before the batch queue; hits skip the model
+  - Vector response formats via ?format= or Accept: json | base64 | raw (LE float32/16 + header) | npy
+  - Single scheduler owns the model: GET/POST/similarity/rerank all submit per-text
+    work items; large requests are split and small ones merged into shared batches
   - Optional quantization: QUANT=none|bnb8|bnb4
+  - CPU profile: CPU_QUANT=int8 (dynamic int8 Linear), CPU_THREADS / CPU_INTEROP_THREADS,
+    optional ONNX Runtime execution (RUNTIME=onnx) behind the same embed_texts interface;
+    with ONNX the PyTorch weights are loaded only to export (then freed) or as the fallback
   - Optional attention impl: ATTN_IMPL=flash_attention_2|sdpa|eager
   - Version-safe torch.set_float32_matmul_precision for torch>=2.9.0
   - Environment overrides for max length, micro-batch size, etc.
 """
 
+import io
 import os
+import gc
+import json
+import queue
 import sys
 import time
 import math
+import base64
+import select
+import socket
+import bisect
+import struct
+import hashlib
 import threading
-from collections import deque
+import importlib.util
+from collections import OrderedDict, deque
 from urllib.parse import unquote_plus
 from typing import List, Dict, Any, Optional
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import Tensor
-from flask import Flask, jsonify, request
-from modelscope import AutoTokenizer, AutoModel
+from flask import Flask, Response, g, has_request_context, jsonify, request, stream_with_context
 
-# Optional dependency: bitsandbytes (via Transformers integration)
-try:
-    from transformers import BitsAndBytesConfig
-    _HAS_BNB = True
-except Exception:
-    _HAS_BNB = False
+# modelscope / transformers are imported by the startup thread (see "Startup" below), so
+# importing this module -- and starting the HTTP listener -- does not wait for them.
+# Optional dependencies: bitsandbytes (via Transformers integration), accelerate
+_HAS_BNB = importlib.util.find_spec("bitsandbytes") is not None
+_HAS_ACCELERATE = importlib.util.find_spec("accelerate") is not None
 
 # -------------------------------
 # Numeric / CUDA settings
@@ -87,9 +134,55 @@ MODEL_NAME = os.getenv("MODEL_NAME", "Qwen/Qwen3-Embedding-4B")
 # Token truncation length
 MAX_LENGTH = int(os.getenv("MAX_LENGTH", "160"))
 
-# Micro-batching
-BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "16"))
+# Micro-batching: a forward is capped by padded tokens (rows * longest row), with
+# BATCH_MAX_SIZE as a hard row cap. The default token budget equals the old worst
+# case of 16 full-length rows, so short queries can batch far wider in the same memory.
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "64"))
+BATCH_MAX_TOKENS = int(os.getenv("BATCH_MAX_TOKENS", str(16 * MAX_LENGTH)))
+# Max time the oldest queued request waits for companions while the model is busy
+# (an idle model never waits)
 BATCH_TIMEOUT_MS = int(os.getenv("BATCH_TIMEOUT_MS", "8"))
+# How many queued items the scheduler looks at when grouping by length
+BATCH_SCAN_SIZE = int(os.getenv("BATCH_SCAN_SIZE", "256"))
+
+# Admission control: queue bounds (0 = unbounded) and the default per-request deadline (0 = none)
+QUEUE_MAX_ITEMS = int(os.getenv("QUEUE_MAX_ITEMS", "4096"))
+QUEUE_MAX_TOKENS = int(os.getenv("QUEUE_MAX_TOKENS", str(64 * BATCH_MAX_TOKENS)))
+REQUEST_TIMEOUT_MS = int(os.getenv("REQUEST_TIMEOUT_MS", "60000"))
+# How often a waiting request checks whether its client has disconnected
+DISCONNECT_POLL_MS = int(os.getenv("DISCONNECT_POLL_MS", "100"))
+
+# Startup warmup: one forward per (batch size, sequence length) that fits BATCH_MAX_TOKENS,
+# on every replica, before the server reports ready (WARMUP=false skips it)
+WARMUP = os.getenv("WARMUP", "true").lower() in ("1", "true", "yes", "y", "on")
+WARMUP_BATCH_SIZES = [int(x) for x in os.getenv("WARMUP_BATCH_SIZES", "1,8,32").split(",") if x.strip()]
+WARMUP_SEQ_LENS = [int(x) for x in os.getenv("WARMUP_SEQ_LENS", "16,64,160").split(",") if x.strip()]
+
+# Priority lanes: each request is "interactive" (e.g. search queries) or "bulk" (ingest).
+# While bulk work is waiting, interactive items take at most INTERACTIVE_SHARE of a batch's
+# rows / token budget; a bulk item that has waited BULK_MAX_WAIT_MS anchors the next batch.
+PRIORITY_LANES = ("interactive", "bulk")
+DEFAULT_PRIORITY = os.getenv("DEFAULT_PRIORITY", "interactive").strip().lower()
+INTERACTIVE_SHARE = min(1.0, max(0.0, float(os.getenv("INTERACTIVE_SHARE", "0.75"))))
+BULK_MAX_WAIT_MS = int(os.getenv("BULK_MAX_WAIT_MS", "2000"))
+
+# Streaming endpoint: texts per batcher submission, submissions in flight per stream,
+# and the longest accepted input line
+STREAM_CHUNK_ITEMS = int(os.getenv("STREAM_CHUNK_ITEMS", "64"))
+STREAM_MAX_INFLIGHT = int(os.getenv("STREAM_MAX_INFLIGHT", "4"))
+STREAM_MAX_LINE_BYTES = int(os.getenv("STREAM_MAX_LINE_BYTES", str(1024 * 1024)))
+
+# Over-length inputs: "truncate" (default, first MAX_LENGTH tokens) or "window"
+# (overlapping MAX_LENGTH windows, combined per text). Requests may override via long_text.
+LONG_TEXT_MODE = os.getenv("LONG_TEXT_MODE", "truncate").strip().lower()
+LONG_WINDOW_OVERLAP = int(os.getenv("LONG_WINDOW_OVERLAP", str(MAX_LENGTH // 4)))
+LONG_MAX_WINDOWS = int(os.getenv("LONG_MAX_WINDOWS", "16"))
+LONG_WINDOW_COMBINE = os.getenv("LONG_WINDOW_COMBINE", "mean").strip().lower()  # mean | weighted
+
+# Embedding cache budget in bytes of stored fp16 vectors (0 disables)
+EMB_CACHE_MAX_BYTES = int(os.getenv("EMB_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Id-keyed vectors for similarity / rerank candidates sent as {"id", "text"} (0 disables)
+CANDIDATE_CACHE_MAX_BYTES = int(os.getenv("CANDIDATE_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
 
 # Defaults for embedding postprocess
 DEFAULT_POOLING = os.getenv("DEFAULT_POOLING", "last")  # last | mean | cls
@@ -102,9 +195,33 @@ REQUIRE_FLASH_ATTN = os.getenv("REQUIRE_FLASH_ATTN", "false").lower() in ("1", "
 QUANT_MODE = os.getenv("QUANT", "none").strip().lower()  # none | bnb8 | bnb4
 DTYPE_ENV = os.getenv("DTYPE", "auto").strip().lower()   # auto | bf16 | fp16 | fp32
 
+# CPU inference profile (CPU-only nodes; ignored on CUDA)
+CPU_QUANT = os.getenv("CPU_QUANT", "none").strip().lower()      # none | int8
+RUNTIME = os.getenv("RUNTIME", "torch").strip().lower()          # torch | onnx
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "").strip()       # exported on first start if missing
+CPU_THREADS = int(os.getenv("CPU_THREADS", "0"))                 # 0 = torch / ORT default
+CPU_INTEROP_THREADS = int(os.getenv("CPU_INTEROP_THREADS", "1"))
+
+# Model replicas: each has its own batch worker. Devices default to all visible GPUs
+# (round-robin) or the CPU; CPU core sets look like "0-15;16-31" (one set per replica).
+REPLICAS = max(1, int(os.getenv("REPLICAS", "1")))
+REPLICA_DEVICES = [d.strip() for d in os.getenv("REPLICA_DEVICES", "").split(",") if d.strip()]
+REPLICA_CPU_CORES = os.getenv("REPLICA_CPU_CORES", "").strip()
+
 CUDA_AVAILABLE = torch.cuda.is_available()
 MODEL_MAIN_DEVICE = torch.device("cuda" if CUDA_AVAILABLE else "cpu")
 
+# Thread pools must be sized before any parallel work runs. Intra-op threads do the
+# matmuls; one inter-op thread avoids oversubscription since forwards are serialized.
+if not CUDA_AVAILABLE:
+    try:
+        if CPU_THREADS > 0:
+            torch.set_num_threads(CPU_THREADS)
+        if CPU_INTEROP_THREADS > 0:
+            torch.set_num_interop_threads(CPU_INTEROP_THREADS)
+    except RuntimeError as e:
+        print(f"[WARN] Could not set CPU thread counts: {e}", file=sys.stderr)
+
 app = Flask(__name__)
 
 # -------------------------------
@@ -156,19 +273,20 @@ def _cls_pool(last_hidden_states: Tensor, attention_mask: Tensor) -> Tensor:
         return last_hidden_states[:, 0]
     return _last_token_pool(last_hidden_states, attention_mask)
 
-def _pool_single(p: str, lhs_row: Tensor, attn_row: Tensor) -> Tensor:
+def _pool_rows(p: str, last_hidden_states: Tensor, attention_mask: Tensor) -> Tensor:
+    """Pool a group of rows sharing one pooling mode, without host syncs (any padding side)."""
     p = (p or DEFAULT_POOLING).lower()
     if p == "mean":
-        mask = attn_row.unsqueeze(-1).type_as(lhs_row)
-        s = (lhs_row * mask).sum(dim=0)
-        c = mask.sum(dim=0).clamp(min=1e-6)
-        return s / c
+        return _masked_mean_pool(last_hidden_states, attention_mask)
+    seq_len = attention_mask.shape[1]
     if p == "cls":
-        return lhs_row[0] if lhs_row.shape[0] > 0 else lhs_row[-1]
-    # default: last
-    seq_len = int(attn_row.sum().item()) - 1
-    seq_len = max(0, min(seq_len, lhs_row.shape[0] - 1))
-    return lhs_row[seq_len]
+        # first non-padding position
+        pos = attention_mask.argmax(dim=1)
+    else:
+        # last non-padding position
+        pos = seq_len - 1 - attention_mask.flip(1).argmax(dim=1)
+    rows = torch.arange(last_hidden_states.shape[0], device=last_hidden_states.device)
+    return last_hidden_states[rows, pos.to(last_hidden_states.device)]
 
 def _postprocess(embs: Tensor, normalize: bool = True, dim: Optional[int] = None) -> Tensor:
     if dim is not None and dim > 0 and dim < embs.shape[1]:
@@ -235,75 +353,407 @@ if QUANT_MODE in ("bnb8", "bnb4") and not _HAS_BNB:
     QUANT_MODE = "none"
 
 # -------------------------------
-# Load tokenizer/model once
+# Load tokenizer/model once (called from the startup thread)
 # -------------------------------
-print("[BOOT] Loading tokenizer...")
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, padding_side="left", trust_remote_code=True)
+tokenizer = None
+model = None
+load_kwargs: Dict[str, Any] = {}
+MODEL_USES_DEVICE_MAP = QUANT_MODE in ("bnb8", "bnb4")
 
 torch_dtype = _pick_dtype_from_env()
 print(f"[BOOT] Attn impl: {REQUESTED_ATTN} (flash_available={FLASH_AVAILABLE})")
 print(f"[BOOT] Quant mode: {QUANT_MODE}")
 print(f"[BOOT] Target dtype: {torch_dtype} (CUDA={CUDA_AVAILABLE}, bf16_supported={torch.cuda.is_bf16_supported() if CUDA_AVAILABLE else False})")
 
-load_kwargs: Dict[str, Any] = {
-    "torch_dtype": torch_dtype,
-    "attn_implementation": REQUESTED_ATTN,  # flash_attention_2 | sdpa | eager
-    "trust_remote_code": True,
-}
-
-MODEL_USES_DEVICE_MAP = False
-if QUANT_MODE in ("bnb8", "bnb4"):
-    # Build BitsAndBytes quantization config
-    compute_dtype = torch.bfloat16 if torch_dtype == torch.bfloat16 else torch.float16
-    if QUANT_MODE == "bnb8":
-        bnb_cfg = BitsAndBytesConfig(load_in_8bit=True)
+def _load_tokenizer():
+    global tokenizer, PAD_TOKEN_ID, SPECIAL_PREFIX, SPECIAL_SUFFIX
+    from modelscope import AutoTokenizer
+    print("[BOOT] Loading tokenizer...")
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, padding_side="left", trust_remote_code=True)
+    PAD_TOKEN_ID = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    SPECIAL_PREFIX, SPECIAL_SUFFIX = _special_wrapping()
+
+def _load_model():
+    global model, load_kwargs
+    from modelscope import AutoModel
+    load_kwargs = {
+        "torch_dtype": torch_dtype,
+        "attn_implementation": REQUESTED_ATTN,  # flash_attention_2 | sdpa | eager
+        "trust_remote_code": True,
+    }
+    if QUANT_MODE in ("bnb8", "bnb4"):
+        # Build BitsAndBytes quantization config
+        from transformers import BitsAndBytesConfig
+        compute_dtype = torch.bfloat16 if torch_dtype == torch.bfloat16 else torch.float16
+        if QUANT_MODE == "bnb8":
+            bnb_cfg = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            bnb_cfg = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=compute_dtype,
+            )
+        load_kwargs["quantization_config"] = bnb_cfg
+        load_kwargs["device_map"] = "auto"  # Let HF dispatch across available GPUs/CPU
+    elif _HAS_ACCELERATE:
+        # Skip random init and copy memory-mapped safetensors shards straight to the target
+        # device, instead of materializing a CPU copy first and then moving it
+        load_kwargs["low_cpu_mem_usage"] = True
+        load_kwargs["device_map"] = {"": MODEL_MAIN_DEVICE}
     else:
-        bnb_cfg = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=compute_dtype,
-        )
-    load_kwargs["quantization_config"] = bnb_cfg
-    load_kwargs["device_map"] = "auto"  # Let HF dispatch across available GPUs/CPU
-    MODEL_USES_DEVICE_MAP = True
+        print("[WARN] accelerate not installed; loading weights via a full CPU copy.", file=sys.stderr)
 
-print(f"[BOOT] Loading model with attn_impl={REQUESTED_ATTN} ...")
-try:
+    print(f"[BOOT] Loading model with attn_impl={REQUESTED_ATTN} ...")
     model = AutoModel.from_pretrained(MODEL_NAME, **load_kwargs)
     if not MODEL_USES_DEVICE_MAP:
         model = model.to(MODEL_MAIN_DEVICE)
     model = model.eval()
-except Exception as e:
-    print(f"[FATAL] Failed to load model: {repr(e)}", file=sys.stderr)
-    sys.exit(1)
 
-print("[BOOT] Model ready.")
+# -------------------------------
+# CPU profile: ONNX Runtime or dynamic int8
+# -------------------------------
+_ort_session = None
+_ort_inputs: List[str] = []
+
+def _default_onnx_path() -> str:
+    cache_dir = os.getenv("ONNX_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_cache"))
+    return os.path.join(cache_dir, MODEL_NAME.replace("/", "__") + ".onnx")
+
+def _export_onnx(path: str):
+    """Export the fp32 encoder (input_ids, attention_mask) -> last_hidden_state with dynamic batch/seq axes."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with _tokenizer_lock:
+        sample = tokenizer(["onnx export sample", "second"], padding=True, return_tensors="pt")
+    torch.onnx.export(
+        model.float(),
+        (sample["input_ids"], sample["attention_mask"]),
+        path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["last_hidden_state"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "seq"},
+            "attention_mask": {0: "batch", 1: "seq"},
+            "last_hidden_state": {0: "batch", 1: "seq"},
+        },
+        opset_version=17,
+    )
+
+def _onnx_planned() -> bool:
+    """CPU-only node asking for ONNX Runtime: the PyTorch weights are only needed to export."""
+    return not CUDA_AVAILABLE and QUANT_MODE == "none" and RUNTIME == "onnx"
+
+def _load_onnx_session():
+    import onnxruntime as ort
+    path = ONNX_MODEL_PATH or _default_onnx_path()
+    qpath = None
+    if CPU_QUANT == "int8":
+        qpath = path[:-5] + ".int8.onnx" if path.endswith(".onnx") else path + ".int8"
+    if not os.path.exists(qpath or path):
+        if not os.path.exists(path):
+            if model is None:
+                _load_model()  # released again once the session is up
+            print(f"[BOOT] Exporting ONNX model to {path} ...")
+            _export_onnx(path)
+        if qpath:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            print(f"[BOOT] Quantizing ONNX model (dynamic int8) to {qpath} ...")
+            quantize_dynamic(path, qpath, weight_type=QuantType.QInt8, use_external_data_format=True)
+    path = qpath or path
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    if CPU_THREADS > 0:
+        opts.intra_op_num_threads = CPU_THREADS
+    opts.inter_op_num_threads = max(1, CPU_INTEROP_THREADS)
+    sess = ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+    return sess, [i.name for i in sess.get_inputs()]
+
+def _apply_cpu_profile():
+    global model, torch_dtype, RUNTIME, CPU_QUANT, _ort_session, _ort_inputs
+    if not CUDA_AVAILABLE and QUANT_MODE == "none":
+        if RUNTIME == "onnx":
+            try:
+                _ort_session, _ort_inputs = _load_onnx_session()
+                print(f"[BOOT] ONNX Runtime session ready (inputs={_ort_inputs}, cpu_quant={CPU_QUANT}).")
+            except Exception as e:
+                print(f"[WARN] ONNX Runtime unavailable ({e!r}); falling back to PyTorch.", file=sys.stderr)
+                RUNTIME = "torch"
+        if RUNTIME == "onnx":
+            # Don't keep the fp32 PyTorch copy (loaded only if we had to export) next to the session
+            model = None
+            gc.collect()
+        elif model is None:
+            _load_model()
+        if RUNTIME != "onnx" and CPU_QUANT == "int8":
+            # Dynamic quantization needs fp32 weights; activations are quantized per batch at runtime
+            model = torch.ao.quantization.quantize_dynamic(model.float(), {torch.nn.Linear}, dtype=torch.qint8)
+            torch_dtype = torch.float32
+            print("[BOOT] Applied dynamic int8 quantization to Linear layers.")
+    elif RUNTIME == "onnx" or CPU_QUANT != "none":
+        print("[WARN] RUNTIME / CPU_QUANT only apply to CPU-only nodes without QUANT; ignoring.", file=sys.stderr)
+        RUNTIME, CPU_QUANT = "torch", "none"
+
+# -------------------------------
+# Model replicas
+# -------------------------------
+def _parse_core_sets(spec: str) -> List[List[int]]:
+    sets = []
+    for part in spec.split(";"):
+        cores = []
+        for rng in part.split(","):
+            rng = rng.strip()
+            if not rng:
+                continue
+            lo, _, hi = rng.partition("-")
+            cores.extend(range(int(lo), int(hi or lo) + 1))
+        if cores:
+            sets.append(cores)
+    return sets
+
+def _default_core_sets(n: int) -> List[List[int]]:
+    if n <= 1 or not hasattr(os, "sched_getaffinity"):
+        return []
+    cores = sorted(os.sched_getaffinity(0))
+    size = len(cores) // n
+    return [cores[i * size:(i + 1) * size] for i in range(n)] if size else []
+
+class _Replica:
+    """One model instance with its own batch worker, pinned to a device and optionally a CPU core set."""
+
+    def __init__(self, idx: int, device: torch.device, module, cores: Optional[List[int]] = None):
+        self.idx = idx
+        self.device = device
+        self.model = module
+        self.cores = cores or []
+        self._lock = threading.Lock()
+        self.busy = False
+        self.batches = 0
+        self.items = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.last_error: Optional[str] = None
+        self.busy_s = 0.0
+        self.started = time.perf_counter()
+
+    def pin(self):
+        """
+        Pin the calling (worker) thread; torch's intra-op threads spawned from it inherit the mask.
+        Only the affinity is per replica: the intra-op thread count is process-wide and is
+        sized once for all CPU replicas by _build_replicas().
+        """
+        if not self.cores or not hasattr(os, "sched_setaffinity"):
+            return
+        try:
+            os.sched_setaffinity(0, self.cores)
+        except OSError as e:
+            print(f"[WARN] replica {self.idx}: could not pin to cores {self.cores}: {e}", file=sys.stderr)
+
+    def begin(self):
+        with self._lock:
+            self.busy = True
+
+    def end(self, n_items: int, seconds: float, error: Optional[str] = None):
+        with self._lock:
+            self.busy = False
+            self.batches += 1
+            self.busy_s += seconds
+            if error:
+                self.errors += 1
+                self.consecutive_errors += 1
+                self.last_error = error
+            else:
+                self.items += n_items
+                self.consecutive_errors = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.consecutive_errors < 3
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            uptime = time.perf_counter() - self.started
+            return {
+                "id": self.idx,
+                "device": str(self.device),
+                "cores": self.cores,
+                "healthy": self.healthy,
+                "busy": self.busy,
+                "batches": self.batches,
+                "items": self.items,
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "busy_ratio": round(self.busy_s / uptime, 4) if uptime > 0 else 0.0,
+            }
+
+def _build_replicas() -> List["_Replica"]:
+    global REPLICAS
+    if MODEL_USES_DEVICE_MAP and REPLICAS > 1:
+        print("[WARN] REPLICAS>1 is not supported with QUANT device_map; using one replica.", file=sys.stderr)
+        REPLICAS = 1
+    if REPLICA_DEVICES:
+        devices = [torch.device(REPLICA_DEVICES[i % len(REPLICA_DEVICES)]) for i in range(REPLICAS)]
+    elif CUDA_AVAILABLE:
+        devices = [torch.device(f"cuda:{i % torch.cuda.device_count()}") for i in range(REPLICAS)]
+    else:
+        devices = [torch.device("cpu")] * REPLICAS
+    core_sets = _parse_core_sets(REPLICA_CPU_CORES) if REPLICA_CPU_CORES else _default_core_sets(
+        sum(d.type == "cpu" for d in devices))
+
+    try:
+        main_device = str(next(model.parameters()).device)
+    except (StopIteration, AttributeError):  # AttributeError: ONNX Runtime, no PyTorch model
+        main_device = str(MODEL_MAIN_DEVICE)
+    # Replicas on the same device share one set of weights (inference is read-only);
+    # every other device gets its own copy. ONNX Runtime sessions are shared the same way.
+    modules = {main_device: model}
+    replicas, cpu_idx = [], 0
+    for i, dev in enumerate(devices):
+        key = str(dev)
+        if dev.type == "cuda" and dev.index is None:
+            key = f"cuda:{torch.cuda.current_device()}"
+        if key not in modules and _ort_session is None:
+            from modelscope import AutoModel
+            print(f"[BOOT] Loading replica {i} on {key} ...")
+            kwargs = dict(load_kwargs, device_map={"": dev}) if "low_cpu_mem_usage" in load_kwargs else load_kwargs
+            modules[key] = AutoModel.from_pretrained(MODEL_NAME, **kwargs).to(dev).eval()
+        cores = None
+        if dev.type == "cpu" and core_sets:
+            cores = core_sets[cpu_idx % len(core_sets)]
+            cpu_idx += 1
+        replicas.append(_Replica(i, dev, modules.get(key, model), cores))
+
+    # torch.set_num_threads() is process-wide (the last caller would win), so pinned CPU
+    # replicas share one setting: CPU_THREADS split between them, or the smallest core set.
+    pinned = [r for r in replicas if r.device.type == "cpu" and r.cores]
+    if pinned:
+        threads = CPU_THREADS // len(pinned) if CPU_THREADS > 0 else min(len(r.cores) for r in pinned)
+        try:
+            torch.set_num_threads(max(1, threads))
+        except RuntimeError as e:
+            print(f"[WARN] Could not set CPU thread count for replicas: {e}", file=sys.stderr)
+    return replicas
+
+_replicas: List["_Replica"] = []  # filled by the startup thread
 
 # -------------------------------
 # Embedding core
 # -------------------------------
+PAD_TOKEN_ID = 0  # set from the tokenizer by _load_tokenizer()
+
+# A fast tokenizer applies truncation/padding per call by reconfiguring its shared Rust
+# backend, so concurrent calls with different settings race ("Already borrowed", or one
+# request running with the other's truncation). Every tokenizer call holds this lock.
+_tokenizer_lock = threading.Lock()
+
+def _tokenize(processed_texts: List[str]) -> List[List[int]]:
+    """Truncated token ids without padding; called on request threads, not the batch thread."""
+    with _tokenizer_lock:
+        enc = tokenizer(processed_texts, padding=False, truncation=True, max_length=MAX_LENGTH)
+    return [list(ids) or [PAD_TOKEN_ID] for ids in enc["input_ids"]]
+
+def _special_wrapping():
+    """Special tokens the tokenizer puts around content (e.g. EOS), so each window can carry them too."""
+    try:
+        with _tokenizer_lock:
+            plain = list(tokenizer("a", add_special_tokens=False)["input_ids"])
+            full = list(tokenizer("a")["input_ids"])
+        for k in range(len(full) - len(plain) + 1):
+            if full[k:k + len(plain)] == plain:
+                return full[:k], full[k + len(plain):]
+    except Exception:
+        pass
+    return [], []
+
+SPECIAL_PREFIX: List[int] = []  # set by _load_tokenizer()
+SPECIAL_SUFFIX: List[int] = []
+
+def _tokenize_windows(texts: List[str], instruction: Optional[str] = None,
+                      prefix: Optional[str] = None) -> List[List[List[int]]]:
+    """
+    Split each text into overlapping windows of at most MAX_LENGTH tokens (special
+    tokens and instruction / prefix included), LONG_WINDOW_OVERLAP tokens shared between
+    neighbours and at most LONG_MAX_WINDOWS per text. The instruction / prefix is
+    tokenized once and repeated at the head of every window, so each window is embedded
+    under the same prompt. A text that fits gets one window identical to _tokenize().
+    """
+    head = _apply_instruction_prefix("", instruction, prefix)
+    texts = [str(t or "").strip() for t in texts]
+    room = max(1, MAX_LENGTH - len(SPECIAL_PREFIX) - len(SPECIAL_SUFFIX))
+    with _tokenizer_lock:
+        enc = tokenizer([head + t for t in texts], padding=False, truncation=False, add_special_tokens=False)
+    out: List[Optional[List[List[int]]]] = []
+    over = []
+    for i, content in enumerate(enc["input_ids"]):
+        if len(content) <= room:
+            out.append([(SPECIAL_PREFIX + list(content) + SPECIAL_SUFFIX) or [PAD_TOKEN_ID]])
+        else:
+            out.append(None)
+            over.append(i)
+    if not over:
+        return out
+
+    # Over-length texts: window the text alone and prepend the tokenized head to each window
+    with _tokenizer_lock:
+        enc = tokenizer([head] + [texts[i] for i in over], padding=False, truncation=False, add_special_tokens=False)
+    head_ids = list(enc["input_ids"][0])[:room - 1] if head else []
+    body = max(1, room - len(head_ids))
+    stride = max(1, body - max(0, min(LONG_WINDOW_OVERLAP, body - 1)))
+    for i, content in zip(over, enc["input_ids"][1:]):
+        content = list(content)
+        windows = []
+        start = 0
+        while True:
+            windows.append(SPECIAL_PREFIX + head_ids + content[start:start + body] + SPECIAL_SUFFIX)
+            if start + body >= len(content) or len(windows) >= LONG_MAX_WINDOWS:
+                break
+            start += stride
+        out[i] = windows
+    return out
+
+def _collate(token_ids: List[List[int]]):
+    """Left-pad pre-tokenized rows into (input_ids, attention_mask) CPU tensors."""
+    width = max(len(ids) for ids in token_ids)
+    input_ids = torch.full((len(token_ids), width), PAD_TOKEN_ID, dtype=torch.long)
+    attention_mask = torch.zeros((len(token_ids), width), dtype=torch.long)
+    for i, ids in enumerate(token_ids):
+        input_ids[i, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[i, width - len(ids):] = 1
+    if CUDA_AVAILABLE and not MODEL_USES_DEVICE_MAP:
+        input_ids, attention_mask = input_ids.pin_memory(), attention_mask.pin_memory()
+    return input_ids, attention_mask
+
+def _ort_forward(input_ids: Tensor, attention_mask: Tensor):
+    feeds = {"input_ids": input_ids.numpy(), "attention_mask": attention_mask.numpy()}
+    if "position_ids" in _ort_inputs:
+        feeds["position_ids"] = (attention_mask.cumsum(dim=1) - 1).clamp(min=0).numpy()
+    last_hidden = torch.from_numpy(_ort_session.run(None, {k: v for k, v in feeds.items() if k in _ort_inputs})[0])
+    return last_hidden, attention_mask
+
 @torch.inference_mode()
-def _forward_last_hidden(processed_texts: List[str]):
-    enc = tokenizer(
-        processed_texts,
-        padding=True,
-        truncation=True,
-        max_length=MAX_LENGTH,
-        return_tensors="pt"
-    )
+def _forward_ids(input_ids: Tensor, attention_mask: Tensor, replica: Optional["_Replica"] = None):
+    if _ort_session is not None:
+        return _ort_forward(input_ids, attention_mask)
+    if replica is None:
+        if not _replicas:
+            raise RuntimeError("model not loaded yet (see wait_ready())")
+        replica = _replicas[0]
     # With device_map, keep inputs on CPU; HF will shard/dispatch
     if not MODEL_USES_DEVICE_MAP:
-        for k in enc:
-            enc[k] = enc[k].to(MODEL_MAIN_DEVICE, non_blocking=True)
+        input_ids = input_ids.to(replica.device, non_blocking=True)
+        attention_mask = attention_mask.to(replica.device, non_blocking=True)
 
-    out = model(input_ids=enc["input_ids"], attention_mask=enc["attention_mask"])
+    out = replica.model(input_ids=input_ids, attention_mask=attention_mask)
     last_hidden = out.last_hidden_state if hasattr(out, "last_hidden_state") else out[0]
     # Ensure attention mask device matches outputs
-    attn_mask = enc["attention_mask"].to(last_hidden.device)
+    attn_mask = attention_mask.to(last_hidden.device)
     return last_hidden, attn_mask
 
 @torch.inference_mode()
+def _forward_last_hidden(processed_texts: List[str]):
+    """Direct forward on replica 0, bypassing the scheduler; benchmarks / warmup only."""
+    return _forward_ids(*_collate(_tokenize(processed_texts)))
+
 def embed_texts(
     texts: List[str],
     pooling: str = DEFAULT_POOLING,
@@ -312,93 +762,1005 @@ def embed_texts(
     instruction: Optional[str] = None,
     prefix: Optional[str] = None,
 ) -> Tensor:
-    processed = [_apply_instruction_prefix(str(t or ""), instruction, prefix) for t in texts]
-    lhs, attn = _forward_last_hidden(processed)
-
-    p = (pooling or DEFAULT_POOLING).lower()
-    if p == "mean":
-        pooled = _masked_mean_pool(lhs, attn)
-    elif p == "cls":
-        pooled = _cls_pool(lhs, attn)
-    else:
-        pooled = _last_token_pool(lhs, attn)
-
-    embs = _postprocess(pooled, normalize=normalize, dim=out_dim)
-    return embs
+    """
+    Embed texts in-process (for scripts importing this module) through the same
+    scheduler, cache and replicas as HTTP requests; returns an (n, dim) tensor.
+    Raises RuntimeError until startup has finished (see wait_ready()).
+    """
+    if _startup["state"] != "ready":
+        raise RuntimeError(f"model not ready ({_startup['state']}); call wait_ready() first")
+    return torch.stack(submit_texts(texts, pooling, normalize, out_dim, instruction, prefix))
 
 @torch.inference_mode()
 def embed_texts_per_item(
-    texts: List[str],
+    token_ids: List[List[int]],
     poolings: List[str],
     normalizes: List[bool],
     out_dims: List[Optional[int]],
-    instructions: List[Optional[str]],
-    prefixes: List[Optional[str]],
-) -> List[List[float]]:
-    processed = [
-        _apply_instruction_prefix(str(t or ""), instr, pref)
-        for t, instr, pref in zip(texts, instructions, prefixes)
-    ]
-    lhs, attn = _forward_last_hidden(processed)
-
-    vecs: List[Tensor] = []
-    for i in range(len(texts)):
-        pooled_i = _pool_single(poolings[i], lhs[i], attn[i])
-        vec_i = pooled_i.unsqueeze(0)
-        vec_i = _postprocess(vec_i, normalize=normalizes[i], dim=out_dims[i])
-        vecs.append(vec_i.squeeze(0))
+    replica: Optional["_Replica"] = None,
+) -> List[Tensor]:
+    """
+    Embed pre-tokenized rows (instruction/prefix already applied) with per-row options.
+    Returns one float32 CPU tensor per row (views into a single host copy).
+    """
+    lhs, attn = _forward_ids(*_collate(token_ids), replica=replica)
+
+    # Rows sharing (pooling, normalize, dim) are pooled and post-processed together
+    groups: Dict[tuple, List[int]] = {}
+    for i in range(len(token_ids)):
+        key = ((poolings[i] or DEFAULT_POOLING).lower(), bool(normalizes[i]), out_dims[i])
+        groups.setdefault(key, []).append(i)
+
+    parts: List[Tensor] = []
+    spans: List[Optional[tuple]] = [None] * len(token_ids)
+    offset = 0
+    for (p, norm, dim), rows in groups.items():
+        idx = torch.tensor(rows, device=lhs.device)
+        embs = _postprocess(_pool_rows(p, lhs[idx], attn[idx]), normalize=norm, dim=dim).float()
+        width = embs.shape[1]
+        parts.append(embs.reshape(-1))
+        for j, i in enumerate(rows):
+            spans[i] = (offset + j * width, offset + (j + 1) * width)
+        offset += len(rows) * width
+
+    # One device-to-host transfer for the whole batch; rows are sliced from it
+    flat = torch.cat(parts).cpu()
+    return [flat[s:e] for s, e in spans]
 
-    return [v.detach().cpu().tolist() for v in vecs]
+# -------------------------------
+# Instrumentation (Prometheus text format, no client library needed)
+# -------------------------------
+_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+_TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+def _escape_label(value) -> str:
+    """Label value escaping of the Prometheus text format: backslash, double quote, newline."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f"{self.name}{_fmt_labels(self.labels, lv)} {v:g}" for lv, v in items]
+        return lines
+
+class _Histogram:
+    """Fixed-bucket histogram; observe() is a bisect plus three increments under a lock."""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series: Dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(label_values)
+            if s is None:
+                s = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def observe_many(self, values: List[float], *label_values):
+        for v in values:
+            self.observe(v, *label_values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((lv, list(s)) for lv, s in self._series.items())
+        for lv, s in series:
+            cum = 0
+            for bound, n in zip(self.buckets + (float("inf"),), s[:-2]):
+                cum += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, le)} {cum}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labels, lv)} {s[-2]:g}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labels, lv)} {s[-1]}")
+        return lines
+
+class _Metrics:
+    def __init__(self):
+        self.queue_wait = _Histogram("embed_queue_wait_seconds", "Time a work item waited in the batch queue.",
+                                     _LATENCY_BUCKETS, ("lane",))
+        self.tokenize = _Histogram("embed_tokenize_seconds", "Tokenization time per submission.", _LATENCY_BUCKETS)
+        self.forward = _Histogram("embed_forward_seconds", "Forward + pooling time per batch.", _LATENCY_BUCKETS, ("replica",))
+        self.serialize = _Histogram("embed_serialize_seconds", "Response serialization time.", _LATENCY_BUCKETS, ("format",))
+        self.request = _Histogram("embed_request_seconds", "End-to-end request latency.", _LATENCY_BUCKETS, ("endpoint",))
+        self.batch_size = _Histogram("embed_batch_size", "Items per forward batch.", _SIZE_BUCKETS)
+        self.batch_tokens = _Histogram("embed_batch_padded_tokens", "Padded tokens (rows x longest) per batch.", _TOKEN_BUCKETS)
+        self.item_tokens = _Histogram("embed_item_tokens", "Tokens per work item.", _TOKEN_BUCKETS)
+        self.requests = _Counter("embed_requests_total", "HTTP requests by endpoint and status.", ("endpoint", "status"))
+        self.items = _Counter("embed_items_total", "Work items embedded by the model, by lane.", ("lane",))
+        self.tokens = _Counter("embed_tokens_total", "Real (unpadded) tokens embedded.")
+        self.padded_tokens = _Counter("embed_padded_tokens_total", "Padded tokens processed by the model.")
+        self.batches = _Counter("embed_batches_total", "Forward batches by replica.", ("replica",))
+        self.errors = _Counter("embed_errors_total", "Errors by stage.", ("stage",))
+        self.rejected = _Counter("embed_rejected_total", "Requests refused at admission.", ("reason",))
+        self.aborted = _Counter("embed_aborted_total", "Admitted requests abandoned before finishing.", ("reason",))
+        self.dropped = _Counter("embed_dropped_items_total", "Queued work items dropped before the forward.", ("reason",))
+        self.all = [
+            self.queue_wait, self.tokenize, self.forward, self.serialize, self.request,
+            self.batch_size, self.batch_tokens, self.item_tokens,
+            self.requests, self.items, self.tokens, self.padded_tokens, self.batches, self.errors,
+            self.rejected, self.aborted, self.dropped,
+        ]
+
+_metrics = _Metrics()
+
+@app.before_request
+def _metrics_start():
+    g.t_request = time.perf_counter()
+
+@app.after_request
+def _metrics_finish(resp):
+    endpoint = request.endpoint or "unknown"
+    _metrics.requests.inc(1, endpoint, resp.status_code)
+    # The stream route is still running here; its generator records the latency when it ends
+    if getattr(g, "t_request", None) is not None and not getattr(g, "stream_latency", False):
+        _metrics.request.observe(time.perf_counter() - g.t_request, endpoint)
+    return resp
 
 # -------------------------------
 # Micro-batch queue
 # -------------------------------
-_request_queue = deque()
+_lanes: Dict[str, deque] = {lane: deque() for lane in PRIORITY_LANES}
+_lane_tokens: Dict[str, int] = {lane: 0 for lane in PRIORITY_LANES}
 _queue_lock = threading.Lock()
+_queue_cond = threading.Condition(_queue_lock)
+
+def _queue_len() -> int:
+    return sum(len(q) for q in _lanes.values())
+
+def _queued_tokens() -> int:
+    return sum(_lane_tokens.values())
+
+class _BatchStats:
+    """Rolling batcher metrics: queue wait per item and batch fill per forward."""
+
+    def __init__(self, window: int = 2048):
+        self._lock = threading.Lock()
+        self._waits_ms = deque(maxlen=window)
+        self._sizes = deque(maxlen=window)
+        self._padded = deque(maxlen=window)
+        self._real = deque(maxlen=window)
+        self._forwards = deque(maxlen=window)  # (start, end) of each batch on the model
+        self._tokenize_ms = deque(maxlen=window)
+        self.batches = 0
+        self.items = 0
+        self.idle_dispatches = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def record(self, batch: List[Dict[str, Any]], idle: bool):
+        now = time.perf_counter()
+        real = sum(item["n_tokens"] for item in batch)
+        padded = len(batch) * max(item["n_tokens"] for item in batch)
+        with self._lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.idle_dispatches += int(idle)
+            self.tokens += real
+            self.padded_tokens += padded
+            self._sizes.append(len(batch))
+            self._padded.append(padded)
+            self._real.append(real)
+            self._waits_ms.extend((now - item["t_enqueue"]) * 1000.0 for item in batch)
+        for item in batch:
+            _metrics.queue_wait.observe(now - item["t_enqueue"], item["lane"])
+            _metrics.items.inc(1, item["lane"])
+        _metrics.item_tokens.observe_many([item["n_tokens"] for item in batch])
+        _metrics.batch_size.observe(len(batch))
+        _metrics.batch_tokens.observe(padded)
+        _metrics.tokens.inc(real)
+        _metrics.padded_tokens.inc(padded)
+
+    def record_forward(self, t_start: float, t_end: float):
+        with self._lock:
+            self._forwards.append((t_start, t_end))
+
+    def record_tokenize(self, seconds: float):
+        with self._lock:
+            self._tokenize_ms.append(seconds * 1000.0)
+        _metrics.tokenize.observe(seconds)
+
+    def drain_seconds(self, tokens: int) -> float:
+        """Rough time for the replicas to work through `tokens` queued tokens, from recent throughput."""
+        with self._lock:
+            n = min(len(self._real), len(self._forwards))
+            real = sum(list(self._real)[-n:]) if n else 0
+            busy = sum(e - s for s, e in list(self._forwards)[-n:]) if n else 0.0
+        if real <= 0 or busy <= 0:
+            return 1.0
+        return tokens / (real / busy * max(1, REPLICAS))
+
+    @staticmethod
+    def _pct(sorted_vals: List[float], q: float) -> float:
+        if not sorted_vals:
+            return 0.0
+        return sorted_vals[min(len(sorted_vals) - 1, int(round(q * (len(sorted_vals) - 1))))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits_ms)
+            sizes = list(self._sizes)
+            padded = list(self._padded)
+            forwards = list(self._forwards)
+            tokenize_ms = list(self._tokenize_ms)
+            batches, items, idle = self.batches, self.items, self.idle_dispatches
+            tokens, padded_tokens = self.tokens, self.padded_tokens
+        avg_size = sum(sizes) / len(sizes) if sizes else 0.0
+        avg_padded = sum(padded) / len(padded) if padded else 0.0
+        # Share of wall time the replicas spent in forwards over the recent window
+        span = (forwards[-1][1] - forwards[0][0]) if forwards else 0.0
+        busy = sum(e - s for s, e in forwards)
+        return {
+            "batches": batches,
+            "items": items,
+            "idle_dispatches": idle,
+            "tokens": tokens,
+            "padded_tokens": padded_tokens,
+            "padding_ratio": round(1.0 - tokens / padded_tokens, 4) if padded_tokens else 0.0,
+            "avg_batch_size": round(avg_size, 3),
+            "batch_fill": round(avg_padded / BATCH_MAX_TOKENS, 4) if BATCH_MAX_TOKENS else 0.0,
+            "model_busy_ratio": round(busy / span / max(1, REPLICAS), 4) if span > 0 else 0.0,
+            "forward_ms_mean": round(busy * 1000.0 / len(forwards), 3) if forwards else 0.0,
+            "tokenize_ms_mean": round(sum(tokenize_ms) / len(tokenize_ms), 3) if tokenize_ms else 0.0,
+            "queue_wait_ms": {
+                "mean": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                "p50": round(self._pct(waits, 0.50), 3),
+                "p95": round(self._pct(waits, 0.95), 3),
+                "max": round(waits[-1], 3) if waits else 0.0,
+            },
+        }
+
+_batch_stats = _BatchStats()
+
+class _QueueFull(RuntimeError):
+    def __init__(self, retry_after: int):
+        super().__init__("embedding queue is full")
+        self.retry_after = retry_after
+
+class _DeadlineExceeded(RuntimeError):
+    pass
+
+class _ClientGone(RuntimeError):
+    pass
+
+class _Job:
+    """One caller's request: N texts whose vectors come back in submission order."""
+
+    def __init__(self, n: int, deadline: Optional[float] = None):
+        self._lock = threading.Lock()
+        self._evt = threading.Event()
+        self._pending = n
+        self.vecs: List[Optional[Tensor]] = [None] * n
+        self.error: Optional[str] = None
+        self.error_type = RuntimeError
+        self.deadline = deadline  # time.perf_counter() value, or None
+        self.cancelled = False
+        if n == 0:
+            self._evt.set()
+
+    def expired(self, now: float) -> bool:
+        return self.deadline is not None and now >= self.deadline
+
+    def ready(self) -> bool:
+        return self._evt.is_set()
+
+    def done(self, index: int, vec: Tensor):
+        with self._lock:
+            self.vecs[index] = vec
+            self._pending -= 1
+            finished = self._pending <= 0
+        if finished:
+            self._evt.set()
+
+    def fail(self, error: str, error_type=RuntimeError):
+        with self._lock:
+            if not self.error:
+                self.error, self.error_type = error, error_type
+        self._evt.set()
+
+    def wait(self, client_gone=None) -> List[Tensor]:
+        """
+        Block until every vector is back, the deadline passes, or client_gone() reports
+        a hung-up caller. In the last two cases the job is cancelled, so items still
+        queued are dropped instead of reaching the model.
+        """
+        while True:
+            timeout = None
+            if self.deadline is not None:
+                timeout = max(0.0, self.deadline - time.perf_counter())
+            if client_gone is not None:
+                timeout = min(timeout, DISCONNECT_POLL_MS / 1000.0) if timeout is not None else DISCONNECT_POLL_MS / 1000.0
+            if self._evt.wait(timeout):
+                break
+            if self.expired(time.perf_counter()):
+                _cancel_job(self, "deadline")
+                raise _DeadlineExceeded("deadline exceeded")
+            if client_gone is not None and client_gone():
+                _cancel_job(self, "disconnected")
+                raise _ClientGone("client disconnected")
+        if self.error:
+            raise self.error_type(self.error)
+        return self.vecs
+
+class _EmbeddingCache:
+    """
+    Bounded LRU of finished vectors, keyed by (processed text digest, pooling, normalize, dim).
+    Vectors are stored as fp16 CPU tensors; the budget counts their bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[tuple, Tensor]" = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(processed_text: str, pooling: str, normalize: bool, dim: Optional[int]) -> tuple:
+        digest = hashlib.blake2b(processed_text.encode("utf-8"), digest_size=16).digest()
+        return (digest, pooling, bool(normalize), dim)
+
+    def get_many(self, keys: List[tuple]) -> List[Optional[Tensor]]:
+        if self.max_bytes <= 0:
+            return [None] * len(keys)
+        out: List[Optional[Tensor]] = []
+        with self._lock:
+            for k in keys:
+                v = self._data.get(k)
+                if v is not None:
+                    self._data.move_to_end(k)
+                out.append(v)
+            hits = sum(v is not None for v in out)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return [v.float() if v is not None else None for v in out]
+
+    def put(self, key: tuple, vec: Tensor):
+        if self.max_bytes <= 0:
+            return
+        v = vec.detach().to("cpu", torch.float16).clone()
+        size = v.numel() * v.element_size()
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old.numel() * old.element_size()
+            self._data[key] = v
+            self.bytes += size
+            while self.bytes > self.max_bytes and self._data:
+                _, ev = self._data.popitem(last=False)
+                self.bytes -= ev.numel() * ev.element_size()
+                self.evictions += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.max_bytes > 0,
+                "entries": len(self._data),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+_embedding_cache = _EmbeddingCache(EMB_CACHE_MAX_BYTES)
+_candidate_cache = _EmbeddingCache(CANDIDATE_CACHE_MAX_BYTES)
+
+def _enqueue(items: List[Dict[str, Any]]):
+    """
+    Append one job's work items to their lane, or raise _QueueFull when they would push
+    that lane past QUEUE_MAX_ITEMS / QUEUE_MAX_TOKENS (a bulk backlog never turns
+    interactive requests away). A request bigger than the bounds is still admitted
+    into an empty lane, otherwise it could never run.
+    """
+    if not items:
+        return
+    now = time.perf_counter()
+    lane = items[0]["lane"]
+    queue = _lanes[lane]
+    n_tokens = sum(item["n_tokens"] for item in items)
+    with _queue_cond:
+        over = (QUEUE_MAX_ITEMS > 0 and len(queue) + len(items) > QUEUE_MAX_ITEMS) or \
+               (QUEUE_MAX_TOKENS > 0 and _lane_tokens[lane] + n_tokens > QUEUE_MAX_TOKENS)
+        if over and queue:
+            retry_after = max(1, math.ceil(_batch_stats.drain_seconds(_queued_tokens())))
+            _metrics.rejected.inc(1, "queue_full")
+            raise _QueueFull(retry_after)
+        for item in items:
+            item["t_enqueue"] = now
+            queue.append(item)
+        _lane_tokens[lane] += n_tokens
+        _queue_cond.notify()
+
+def _cancel_job(job: "_Job", reason: str):
+    """Mark a job abandoned and pull its items that are still waiting out of the queue."""
+    job.cancelled = True
+    _metrics.aborted.inc(1, reason)
+    dropped = 0
+    with _queue_cond:
+        for lane, queue in _lanes.items():
+            mine = [item for item in queue if item["job"] is job]
+            if not mine:
+                continue
+            keep = [item for item in queue if item["job"] is not job]
+            queue.clear()
+            queue.extend(keep)
+            _lane_tokens[lane] -= sum(item["n_tokens"] for item in mine)
+            dropped += len(mine)
+    if dropped:
+        _metrics.dropped.inc(dropped, "cancelled")
+
+def _select_batch(pending: List[Dict[str, Any]], max_items: int, max_tokens: int,
+                  taken: int = 0, longest: int = 0) -> List[int]:
+    """
+    Pick the indices of `pending` (oldest first) for one forward.
+    The oldest item is always taken; the rest are added nearest-length first,
+    as long as rows * longest row stays within max_tokens and rows <= max_items.
+    Similar lengths end up together, so little of the budget goes to padding.
+    With taken / longest, top up a batch that already holds `taken` rows padded to
+    `longest`: nothing is forced in and lengths near `longest` are preferred.
+    """
+    if not pending or max_items <= 0:
+        return []
+    anchor = longest if taken else pending[0]["n_tokens"]
+    order = sorted(range(len(pending)), key=lambda i: (abs(pending[i]["n_tokens"] - anchor), i))
+    chosen: List[int] = []
+    for i in order:
+        n = pending[i]["n_tokens"]
+        if (taken or chosen) and (taken + len(chosen) + 1) * max(longest, n) > max_tokens:
+            continue
+        chosen.append(i)
+        longest = max(longest, n)
+        if len(chosen) >= max_items:
+            break
+    return chosen
+
+def _plan_lanes(windows: Dict[str, List[Dict[str, Any]]], now: float) -> Dict[str, List[int]]:
+    """
+    Split one batch between the lanes' scan windows. Interactive items go first, capped
+    at INTERACTIVE_SHARE of the rows / token budget while bulk work is waiting; bulk
+    items then fill the remaining room. If the oldest bulk item has waited
+    BULK_MAX_WAIT_MS, bulk is planned first (oldest item forced in, the rest within the
+    non-interactive share) and interactive fills the remaining room, so ingest keeps
+    moving even when long bulk items never fit beside interactive ones.
+    """
+    interactive, bulk = windows["interactive"], windows["bulk"]
+    if interactive and bulk and (now - bulk[0]["t_enqueue"]) * 1000.0 >= BULK_MAX_WAIT_MS:
+        order = [
+            ("bulk", max(1, int(BATCH_MAX_SIZE * (1.0 - INTERACTIVE_SHARE))), int(BATCH_MAX_TOKENS * (1.0 - INTERACTIVE_SHARE))),
+            ("interactive", BATCH_MAX_SIZE, BATCH_MAX_TOKENS),
+        ]
+    elif bulk:
+        order = [
+            ("interactive", max(1, int(BATCH_MAX_SIZE * INTERACTIVE_SHARE)), int(BATCH_MAX_TOKENS * INTERACTIVE_SHARE)),
+            ("bulk", BATCH_MAX_SIZE, BATCH_MAX_TOKENS),
+        ]
+    else:
+        order = [("interactive", BATCH_MAX_SIZE, BATCH_MAX_TOKENS)]
+    chosen: Dict[str, List[int]] = {lane: [] for lane in windows}
+    taken, longest = 0, 0
+    for lane, max_items, max_tokens in order:
+        window = windows[lane]
+        picked = _select_batch(window, min(max_items, BATCH_MAX_SIZE - taken), max_tokens, taken, longest)
+        chosen[lane] = picked
+        taken += len(picked)
+        longest = max([longest] + [window[i]["n_tokens"] for i in picked])
+    return chosen
+
+def submit_texts(
+    texts: List[str],
+    pooling: str = DEFAULT_POOLING,
+    normalize: bool = DEFAULT_NORMALIZE,
+    out_dim: Optional[int] = DEFAULT_DIM,
+    instruction: Optional[str] = None,
+    prefix: Optional[str] = None,
+    deadline: Optional[float] = None,
+    priority: str = DEFAULT_PRIORITY,
+) -> List[Tensor]:
+    """
+    Embed texts through the shared batcher and block until all are done.
+    The embedding cache is consulted first; only distinct misses are queued.
+    Texts are tokenized here, on the caller's thread, so tokenization overlaps
+    with whatever batch is on the model. Each text becomes its own work item,
+    so a large request is spread over several forwards and small requests
+    share a forward with other callers. `deadline` is a time.perf_counter() value;
+    `priority` names the lane (see PRIORITY_LANES).
+    """
+    pending = _begin_texts(texts, pooling, normalize, out_dim, instruction, prefix, deadline, priority)
+    return _finish_texts(pending, _disconnect_probe())
+
+def _begin_texts(
+    texts: List[str],
+    pooling: str,
+    normalize: bool,
+    out_dim: Optional[int],
+    instruction: Optional[str],
+    prefix: Optional[str],
+    deadline: Optional[float] = None,
+    priority: str = DEFAULT_PRIORITY,
+):
+    """First half of submit_texts(): cache lookup, tokenize and enqueue the misses without waiting."""
+    processed = [_apply_instruction_prefix(str(t or ""), instruction, prefix) for t in texts]
+    pool_key = (pooling or DEFAULT_POOLING).lower()
+    keys = [_EmbeddingCache.key(p, pool_key, normalize, out_dim) for p in processed]
+    out = _embedding_cache.get_many(keys)
+    missing = _group_misses(keys, out)
+    if not missing:
+        return out, missing, None
+
+    t0 = time.perf_counter()
+    token_ids = _tokenize([processed[missing[k][0]] for k in missing])
+    _batch_stats.record_tokenize(time.perf_counter() - t0)
+    job = _submit_items([_work_item(ids, pooling, normalize, out_dim) for ids in token_ids], deadline, priority)
+    return out, missing, job
+
+def _finish_texts(pending, client_gone=None) -> List[Tensor]:
+    """Second half of submit_texts(): wait for the queued misses and fill them in (and the cache)."""
+    out, missing, job = pending
+    if job is not None:
+        _fill_misses(missing, job.wait(client_gone), out)
+    return out
+
+def submit_long_texts(
+    texts: List[str],
+    pooling: str = DEFAULT_POOLING,
+    normalize: bool = DEFAULT_NORMALIZE,
+    out_dim: Optional[int] = DEFAULT_DIM,
+    instruction: Optional[str] = None,
+    prefix: Optional[str] = None,
+    combine: str = LONG_WINDOW_COMBINE,
+    deadline: Optional[float] = None,
+    priority: str = DEFAULT_PRIORITY,
+):
+    """
+    Like submit_texts(), but over-length texts are embedded as overlapping windows.
+    The cache is consulted first and only the misses are tokenized and windowed.
+    All windows of all texts go through the batcher together as ordinary items;
+    each text's window vectors are then combined (mean, or mean weighted by
+    window token count) and post-processed. Returns (vectors, windows per text);
+    the window count of a cache hit is the one recorded when it was computed.
+    """
+    combine = "weighted" if str(combine or "").lower() == "weighted" else "mean"
+    processed = [_apply_instruction_prefix(str(t or ""), instruction, prefix) for t in texts]
+    pool_key = (pooling or DEFAULT_POOLING).lower()
+    keys = [_EmbeddingCache.key(p, f"{pool_key}+window-{combine}", normalize, out_dim) for p in processed]
+    out = _embedding_cache.get_many(keys)
+    # The window count rides along as a one-element entry next to the vector
+    counts: List[Optional[int]] = [None] * len(texts)
+    hits = [i for i, v in enumerate(out) if v is not None]
+    for i, c in zip(hits, _embedding_cache.get_many([keys[i] + ("windows",) for i in hits])):
+        counts[i] = int(c[0]) if c is not None else None
+    missing = _group_misses(keys, out)
+    if not missing:
+        return out, counts
+
+    t0 = time.perf_counter()
+    windows = _tokenize_windows([texts[missing[k][0]] for k in missing], instruction, prefix)
+    _batch_stats.record_tokenize(time.perf_counter() - t0)
+
+    # Windows are pooled (and normalized) individually, combined, then truncated / re-normalized
+    items, spans = [], []
+    for k, wins in zip(missing, windows):
+        for i in missing[k]:
+            counts[i] = len(wins)
+        if len(wins) == 1:
+            items.append(_work_item(wins[0], pooling, normalize, out_dim))
+        else:
+            items.extend(_work_item(ids, pooling, normalize, None) for ids in wins)
+        spans.append((len(items) - len(wins), len(items), wins))
+    vecs = _run_items(items, deadline, priority)
+
+    combined = []
+    for s, e, wins in spans:
+        if e - s == 1:
+            combined.append(vecs[s])
+            continue
+        stacked = torch.stack(vecs[s:e])
+        weights = torch.tensor(
+            [float(len(w)) if combine == "weighted" else 1.0 for w in wins], dtype=stacked.dtype
+        ).unsqueeze(1)
+        mixed = (stacked * weights).sum(dim=0, keepdim=True) / weights.sum()
+        combined.append(_postprocess(mixed, normalize=normalize, dim=out_dim)[0])
+    _fill_misses(missing, combined, out)
+    for k, (s, e, _) in zip(missing, spans):
+        _embedding_cache.put(k + ("windows",), torch.tensor([float(e - s)]))
+        if e - s == 1:  # identical to submit_texts(); share its cache entry
+            _embedding_cache.put(_EmbeddingCache.key(processed[missing[k][0]], pool_key, normalize, out_dim), vecs[s])
+    return out, counts
+
+def _work_item(ids: List[int], pooling: str, normalize: bool, out_dim: Optional[int]) -> Dict[str, Any]:
+    return {"input_ids": ids, "n_tokens": len(ids), "pooling": pooling, "normalize": normalize, "out_dim": out_dim}
+
+def _run_items(items: List[Dict[str, Any]], deadline: Optional[float] = None,
+               priority: str = DEFAULT_PRIORITY) -> List[Tensor]:
+    """Queue pre-tokenized work items as one job and wait for their vectors, in order."""
+    return _submit_items(items, deadline, priority).wait(_disconnect_probe())
+
+def _submit_items(items: List[Dict[str, Any]], deadline: Optional[float] = None,
+                  priority: str = DEFAULT_PRIORITY) -> "_Job":
+    """Queue pre-tokenized work items as one job and return it without waiting."""
+    job = _Job(len(items), deadline)
+    lane = priority if priority in _lanes else DEFAULT_PRIORITY
+    for i, item in enumerate(items):
+        item["job"], item["index"], item["lane"] = job, i, lane
+    _enqueue(items)
+    return job
+
+def _disconnect_probe():
+    """
+    For calls made inside an HTTP request, return a callable telling whether the client
+    has closed its connection (the socket polls readable but has no data). None when
+    the server does not expose the socket (e.g. outside werkzeug / gunicorn).
+    """
+    if not has_request_context():
+        return None
+    sock = request.environ.get("werkzeug.socket") or request.environ.get("gunicorn.socket")
+    if sock is None:
+        return None
 
-def _batch_worker():
+    def client_gone() -> bool:
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+        except ValueError:  # TLS sockets refuse MSG_PEEK; treat as still connected
+            return False
+        except OSError:
+            return True
+    return client_gone
+
+def _group_misses(keys: List[tuple], found: List[Optional[Tensor]]) -> Dict[tuple, List[int]]:
+    """Distinct cache misses, each mapped to every position that needs it."""
+    missing: Dict[tuple, List[int]] = {}
+    for i, (k, v) in enumerate(zip(keys, found)):
+        if v is None:
+            missing.setdefault(k, []).append(i)
+    return missing
+
+def _fill_misses(missing: Dict[tuple, List[int]], vecs: List[Tensor], out: List[Optional[Tensor]]):
+    for k, vec in zip(missing, vecs):
+        _embedding_cache.put(k, vec)
+        for i in missing[k]:
+            out[i] = vec
+
+def _next_batch() -> List[Dict[str, Any]]:
+    """
+    Block until work is available and return the next batch.
+    If the queue was empty (model idle), dispatch whatever is there right away.
+    Otherwise requests piled up during the previous forward: keep gathering until
+    the queue holds a full token budget or the oldest request has waited
+    BATCH_TIMEOUT_MS. The batch itself is then chosen by _select_batch().
+    """
+    with _queue_cond:
+        idle = _queue_len() == 0
+        while True:
+            while _queue_len() == 0:
+                _queue_cond.wait()
+            if not idle:
+                oldest = min(q[0]["t_enqueue"] for q in _lanes.values() if q)
+                deadline = oldest + BATCH_TIMEOUT_MS / 1000.0
+                while _queued_tokens() < BATCH_MAX_TOKENS and _queue_len() < BATCH_MAX_SIZE:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    _queue_cond.wait(remaining)
+            # Items whose caller's deadline has passed (or who gave up) never reach the model
+            now = time.perf_counter()
+            windows: Dict[str, List[Dict[str, Any]]] = {}
+            for lane, queue in _lanes.items():
+                window = [queue.popleft() for _ in range(min(len(queue), BATCH_SCAN_SIZE))]
+                live = [item for item in window if not item["job"].cancelled and not item["job"].expired(now)]
+                if len(live) < len(window):
+                    _drop_stale([item for item in window if item["job"].cancelled or item["job"].expired(now)])
+                windows[lane] = live
+            if any(windows.values()):
+                break
+        chosen = _plan_lanes(windows, now)
+        batch: List[Dict[str, Any]] = []
+        for lane, window in windows.items():
+            picked = set(chosen[lane])
+            batch.extend(item for i, item in enumerate(window) if i in picked)
+            _lanes[lane].extendleft(reversed([item for i, item in enumerate(window) if i not in picked]))
+            _lane_tokens[lane] -= sum(window[i]["n_tokens"] for i in picked)
+    _batch_stats.record(batch, idle)
+    return batch
+
+def _drop_stale(items: List[Dict[str, Any]]):
+    """Account for popped items that will not run; the caller holds _queue_cond."""
+    for item in items:
+        _lane_tokens[item["lane"]] -= item["n_tokens"]
+    expired = [item for item in items if not item["job"].cancelled]
+    for item in expired:
+        item["job"].fail("deadline exceeded", _DeadlineExceeded)
+    if expired:
+        _metrics.dropped.inc(len(expired), "expired")
+    if len(items) > len(expired):
+        _metrics.dropped.inc(len(items) - len(expired), "cancelled")
+
+def _batch_worker(replica: "_Replica", warmed: Optional[threading.Event] = None):
+    """
+    One worker per replica. A replica asks the shared queue for work only when its
+    previous forward has finished, so each batch goes to a replica with nothing in
+    flight; with several idle replicas the first to wake takes it.
+    The replica is warmed up on this thread (CUDA handles are per thread), then `warmed` is set.
+    """
+    replica.pin()
+    try:
+        _warmup(replica)
+    except Exception as e:
+        print(f"[WARN] replica {replica.idx}: warmup failed: {e!r}", file=sys.stderr)
+    if warmed is not None:
+        warmed.set()
     while True:
-        time.sleep(BATCH_TIMEOUT_MS / 1000.0)
-        with _queue_lock:
-            if not _request_queue:
-                continue
-            batch = []
-            while _request_queue and len(batch) < BATCH_MAX_SIZE:
-                batch.append(_request_queue.popleft())
+        batch = _next_batch()
 
-        texts        = [item["text"] for item in batch]
-        poolings     = [item["pooling"] for item in batch]
-        normalizes   = [item["normalize"] for item in batch]
-        out_dims     = [item["out_dim"] for item in batch]
-        instructions = [item["instruction"] for item in batch]
-        prefixes     = [item["prefix"] for item in batch]
+        token_ids  = [item["input_ids"] for item in batch]
+        poolings   = [item["pooling"] for item in batch]
+        normalizes = [item["normalize"] for item in batch]
+        out_dims   = [item["out_dim"] for item in batch]
 
+        replica.begin()
+        t0 = time.perf_counter()
         try:
-            vecs = embed_texts_per_item(texts, poolings, normalizes, out_dims, instructions, prefixes)
-            for v, item in zip(vecs, batch):
-                item["vec"] = v
-                item["evt"].set()
+            vecs = embed_texts_per_item(token_ids, poolings, normalizes, out_dims, replica=replica)
         except Exception as e:
+            replica.end(len(batch), time.perf_counter() - t0, error=str(e))
+            _metrics.errors.inc(1, "forward")
             for item in batch:
-                item["error"] = str(e)
-                item["evt"].set()
+                item["job"].fail(str(e))
+            continue
+        finally:
+            _batch_stats.record_forward(t0, time.perf_counter())
+            _metrics.forward.observe(time.perf_counter() - t0, replica.idx)
+            _metrics.batches.inc(1, replica.idx)
+        replica.end(len(batch), time.perf_counter() - t0)
+        for v, item in zip(vecs, batch):
+            item["job"].done(item["index"], v)
+
+# -------------------------------
+# Startup: background load, warmup, readiness
+# -------------------------------
+_startup: Dict[str, Any] = {"state": "starting", "phases_ms": {}, "error": None}
+_startup_done = threading.Event()
+_T_START = time.perf_counter()
+
+def _warmup_shapes() -> List[tuple]:
+    """(batch size, sequence length) pairs the scheduler can actually produce."""
+    sizes = sorted({min(b, BATCH_MAX_SIZE) for b in WARMUP_BATCH_SIZES if b > 0})
+    lens = sorted({min(s, MAX_LENGTH) for s in WARMUP_SEQ_LENS if s > 0})
+    return [(b, s) for b in sizes for s in lens if b == 1 or b * s <= BATCH_MAX_TOKENS]
+
+def _warmup(replica: "_Replica"):
+    """One forward + pooling per warmup shape, so kernel selection / allocator growth happen before traffic."""
+    if not WARMUP:
+        return
+    token = (_tokenize(["warmup"])[0] or [PAD_TOKEN_ID])[0]
+    for b, s in _warmup_shapes():
+        embed_texts_per_item([[token] * s] * b, [DEFAULT_POOLING] * b, [DEFAULT_NORMALIZE] * b,
+                             [DEFAULT_DIM] * b, replica=replica)
+    if replica.device.type == "cuda":
+        torch.cuda.synchronize(replica.device)
+
+def _timed_phase(name: str, fn):
+    t0 = time.perf_counter()
+    fn()
+    _startup["phases_ms"][name] = round((time.perf_counter() - t0) * 1000, 1)
+
+def _start_workers():
+    events = []
+    for r in _replicas:
+        warmed = threading.Event()
+        events.append(warmed)
+        threading.Thread(target=_batch_worker, args=(r, warmed), daemon=True, name=f"embed-replica-{r.idx}").start()
+    for warmed in events:
+        warmed.wait()
+
+def _startup_main():
+    try:
+        _startup["state"] = "loading"
+        _timed_phase("tokenizer", _load_tokenizer)
+        if not _onnx_planned():
+            _timed_phase("model", _load_model)
+        _timed_phase("cpu_profile", _apply_cpu_profile)
+        _timed_phase("replicas", lambda: _replicas.extend(_build_replicas()))
+        print(f"[BOOT] Replicas: {[(r.idx, str(r.device), len(r.cores) or None) for r in _replicas]}")
+        _startup["state"] = "warming"
+        _timed_phase("warmup", _start_workers)
+        _startup["phases_ms"]["total"] = round((time.perf_counter() - _T_START) * 1000, 1)
+        _startup["state"] = "ready"
+        print(f"[BOOT] Model ready. Startup phases (ms): {_startup['phases_ms']}")
+    except Exception as e:
+        _startup["state"] = "failed"
+        _startup["error"] = repr(e)
+        print(f"[FATAL] Failed to load model: {repr(e)}", file=sys.stderr)
+    finally:
+        _startup_done.set()
+
+def wait_ready(timeout: Optional[float] = None) -> bool:
+    """Block until startup has finished (for scripts importing this module); True if serving."""
+    _startup_done.wait(timeout)
+    return _startup["state"] == "ready"
+
+def _startup_snapshot() -> Dict[str, Any]:
+    return {
+        "state": _startup["state"],
+        "phases_ms": dict(_startup["phases_ms"]),
+        "error": _startup["error"],
+        "uptime_s": round(time.perf_counter() - _T_START, 1),
+        "warmup_shapes": _warmup_shapes() if WARMUP else [],
+    }
 
-threading.Thread(target=_batch_worker, daemon=True).start()
+# Endpoints that answer while the model is still loading
+_READY_EXEMPT = {"root", "health", "ready", "config", "metrics", "static"}
+
+@app.before_request
+def _require_ready():
+    if _startup["state"] == "ready" or request.endpoint in _READY_EXEMPT:
+        return None
+    resp = jsonify({"error": f"model not ready ({_startup['state']})", "startup": _startup_snapshot()})
+    resp.status_code = 503
+    if _startup["state"] != "failed":
+        resp.headers["Retry-After"] = "5"
+    return resp
+
+threading.Thread(target=_startup_main, daemon=True, name="embed-startup").start()
+
+# -------------------------------
+# Vector response formats
+# -------------------------------
+# json   : {"vectors": [[...], ...]}                      (default)
+# base64 : {"vectors_b64": "...", "dtype", "shape"}       little-endian matrix bytes
+# raw    : application/octet-stream, 16-byte header + little-endian matrix bytes
+#          header = struct "<4sBxxxII": magic b"EMB1", dtype code (1=float32, 2=float16), rows, dim
+# npy    : application/x-npy, a standard .npy file
+VECTOR_FORMATS = ("json", "base64", "raw", "npy")
+_FORMAT_MIMETYPES = {
+    "application/json": "json",
+    "application/octet-stream": "raw",
+    "application/x-npy": "npy",
+}
+RAW_MAGIC = b"EMB1"
+RAW_HEADER = struct.Struct("<4sBxxxII")
+_RAW_DTYPES = {"float32": (1, "<f4"), "float16": (2, "<f2")}
+
+def _negotiate_format(explicit: Optional[str], dtype: Optional[str]):
+    """Pick (format, dtype) from an explicit ?format= / body field, else the Accept header."""
+    if explicit:
+        fmt = str(explicit).strip().lower()
+    else:
+        best = request.accept_mimetypes.best_match(list(_FORMAT_MIMETYPES), default="application/json")
+        fmt = _FORMAT_MIMETYPES.get(best, "json")
+    if fmt not in VECTOR_FORMATS:
+        raise ValueError(f"format must be one of {list(VECTOR_FORMATS)}")
+    dtype = str(dtype or "float32").strip().lower()
+    if dtype not in _RAW_DTYPES:
+        raise ValueError(f"dtype must be one of {list(_RAW_DTYPES)}")
+    return fmt, dtype
+
+def _vectors_response(vecs: List[Tensor], fmt: str, dtype: str, meta: Dict[str, Any], single: bool = False):
+    t0 = time.perf_counter()
+    resp = _encode_vectors(vecs, fmt, dtype, meta, single)
+    _metrics.serialize.observe(time.perf_counter() - t0, fmt)
+    return resp
+
+def _json_response(body: Dict[str, Any], t0: Optional[float] = None):
+    """jsonify() timed as the serialize stage; t0 when tensor -> list conversion started, if earlier."""
+    t0 = time.perf_counter() if t0 is None else t0
+    resp = jsonify(body)
+    _metrics.serialize.observe(time.perf_counter() - t0, "json")
+    return resp
+
+def _encode_vectors(vecs: List[Tensor], fmt: str, dtype: str, meta: Dict[str, Any], single: bool = False):
+    """Serialize row vectors in the negotiated format; meta goes to the JSON body or X-Embedding-* headers."""
+    if fmt == "json":
+        body = dict(meta)
+        body["vector" if single else "vectors"] = vecs[0].tolist() if single else torch.stack(vecs).tolist()
+        return jsonify(body)
+
+    code, np_dtype = _RAW_DTYPES[dtype]
+    arr = torch.stack(vecs).numpy().astype(np_dtype, copy=False)
+    if fmt == "base64":
+        body = dict(meta)
+        body.update({
+            "encoding": "base64",
+            "dtype": dtype,
+            "shape": list(arr.shape),
+            "vectors_b64": base64.b64encode(arr.tobytes()).decode("ascii"),
+        })
+        return jsonify(body)
+
+    headers = {
+        f"X-Embedding-{k.replace('_', '-').title()}": str(v)
+        for k, v in meta.items() if k in ("model", "count", "dim", "pooling", "normalized", "elapsed_ms")
+    }
+    if "windows" in meta:
+        windows = meta["windows"]
+        headers["X-Embedding-Windows"] = ",".join(map(str, windows)) if isinstance(windows, list) else str(windows)
+    headers["X-Embedding-Dtype"] = dtype
+    if fmt == "npy":
+        buf = io.BytesIO()
+        np.save(buf, arr, allow_pickle=False)
+        return Response(buf.getvalue(), mimetype="application/x-npy", headers=headers)
+    header = RAW_HEADER.pack(RAW_MAGIC, code, arr.shape[0], arr.shape[1])
+    return Response(header + arr.tobytes(), mimetype="application/octet-stream", headers=headers)
 
 # -------------------------------
 # Routes
 # -------------------------------
+def _request_deadline(value) -> Optional[float]:
+    """
+    Absolute deadline (time.perf_counter()) from the caller's budget in ms: the
+    deadline_ms parameter, else the X-Request-Deadline-Ms header, else REQUEST_TIMEOUT_MS.
+    """
+    budget_ms = _ensure_int(value, None)
+    if budget_ms is None:
+        budget_ms = _ensure_int(request.headers.get("X-Request-Deadline-Ms"), REQUEST_TIMEOUT_MS)
+    return time.perf_counter() + budget_ms / 1000.0 if budget_ms and budget_ms > 0 else None
+
+def _request_priority(value) -> str:
+    """Lane from the priority parameter, else the X-Priority header, else DEFAULT_PRIORITY."""
+    lane = str(value or request.headers.get("X-Priority") or DEFAULT_PRIORITY).strip().lower()
+    return lane if lane in PRIORITY_LANES else DEFAULT_PRIORITY
+
+def _queue_error_response(e: RuntimeError):
+    """429 + Retry-After when the queue is full, 504 past the deadline, 499 for a hung-up client."""
+    if isinstance(e, _QueueFull):
+        resp = jsonify({"error": str(e), "retry_after_s": e.retry_after})
+        resp.status_code = 429
+        resp.headers["Retry-After"] = str(e.retry_after)
+        return resp
+    if isinstance(e, _DeadlineExceeded):
+        return jsonify({"error": str(e)}), 504
+    if isinstance(e, _ClientGone):
+        return jsonify({"error": str(e)}), 499
+    return jsonify({"error": str(e)}), 500
+
 @app.route("/", methods=["GET"])
 def root():
     return jsonify({"ok": True, "model": MODEL_NAME})
 
 @app.route("/health", methods=["GET"])
 def health():
+    # Liveness: 200 while loading / warming (503 only if startup failed); readiness is /ready
+    if _startup["state"] != "ready":
+        body = {"status": _startup["state"], "startup": _startup_snapshot(), "queue_len": _queue_len()}
+        return jsonify(body), 503 if _startup["state"] == "failed" else 200
+
     # For device_map models, pick one param device for display only
     try:
         dev = next(model.parameters()).device
         dtype = str(next(model.parameters()).dtype)
-    except StopIteration:
+    except (StopIteration, AttributeError):  # AttributeError: model not loaded yet
         dev = MODEL_MAIN_DEVICE
         dtype = str(torch_dtype)
 
@@ -411,9 +1773,12 @@ def health():
             # Best effort in multi-device setups
             mem_free, mem_total = torch.cuda.mem_get_info()
 
+    replicas = [r.snapshot() for r in _replicas]
     return jsonify({
-        "status": "ok",
-        "queue_len": len(_request_queue),
+        "status": "ok" if all(r["healthy"] for r in replicas) else "degraded",
+        "startup": _startup_snapshot(),
+        "replicas": replicas,
+        "queue_len": _queue_len(),
         "device": str(dev),
         "dtype": dtype,
         "attn_impl": REQUESTED_ATTN,
@@ -426,13 +1791,43 @@ def health():
         "cuda_mem_free": mem_free
     })
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness probe: 200 once the model is loaded and warmed up, 503 before (or on failure)."""
+    ok = _startup["state"] == "ready"
+    return jsonify({"ready": ok, "startup": _startup_snapshot()}), 200 if ok else 503
+
 @app.route("/config", methods=["GET"])
 def config():
     return jsonify({
         "model": MODEL_NAME,
         "max_length": MAX_LENGTH,
         "batch_max_size": BATCH_MAX_SIZE,
+        "batch_max_tokens": BATCH_MAX_TOKENS,
         "batch_timeout_ms": BATCH_TIMEOUT_MS,
+        "batch_scan_size": BATCH_SCAN_SIZE,
+        "cache_max_bytes": EMB_CACHE_MAX_BYTES,
+        "candidate_cache_max_bytes": CANDIDATE_CACHE_MAX_BYTES,
+        "queue_max_items": QUEUE_MAX_ITEMS,
+        "queue_max_tokens": QUEUE_MAX_TOKENS,
+        "request_timeout_ms": REQUEST_TIMEOUT_MS,
+        "priority": {
+            "lanes": list(PRIORITY_LANES),
+            "default": DEFAULT_PRIORITY,
+            "interactive_share": INTERACTIVE_SHARE,
+            "bulk_max_wait_ms": BULK_MAX_WAIT_MS,
+        },
+        "stream": {
+            "chunk_items": STREAM_CHUNK_ITEMS,
+            "max_inflight": STREAM_MAX_INFLIGHT,
+            "max_line_bytes": STREAM_MAX_LINE_BYTES,
+        },
+        "long_text": {
+            "mode": LONG_TEXT_MODE,
+            "window_overlap": LONG_WINDOW_OVERLAP,
+            "max_windows": LONG_MAX_WINDOWS,
+            "combine": LONG_WINDOW_COMBINE,
+        },
         "defaults": {
             "pooling": DEFAULT_POOLING,
             "normalize": DEFAULT_NORMALIZE,
@@ -443,15 +1838,61 @@ def config():
         "flash_attention_available": FLASH_AVAILABLE,
         "require_flash_attention": REQUIRE_FLASH_ATTN,
         "quant_mode": QUANT_MODE,
-        "dtype": str(torch_dtype)
+        "dtype": str(torch_dtype),
+        "runtime": RUNTIME,
+        "cpu_quant": CPU_QUANT,
+        "cpu_threads": torch.get_num_threads(),
+        "cpu_interop_threads": torch.get_num_interop_threads(),
+        "replicas": [{"id": r.idx, "device": str(r.device), "cores": r.cores} for r in _replicas],
+        "warmup": {"enabled": WARMUP, "batch_sizes": WARMUP_BATCH_SIZES, "seq_lens": WARMUP_SEQ_LENS},
     })
 
+def _prometheus_text() -> str:
+    lines: List[str] = []
+    for m in _metrics.all:
+        lines += m.render()
+    cache = _embedding_cache.snapshot()
+    gauges = [
+        ("embed_cache_bytes", "Bytes of vectors held by the embedding cache.", cache["bytes"]),
+        ("embed_cache_entries", "Entries in the embedding cache.", cache["entries"]),
+        ("embed_cache_hits_total", "Embedding cache hits.", cache["hits"]),
+        ("embed_cache_misses_total", "Embedding cache misses.", cache["misses"]),
+    ]
+    for name, help_text, value in gauges:
+        kind = "counter" if name.endswith("_total") else "gauge"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    lines += ["# HELP embed_ready 1 once the model is loaded and warmed up.", "# TYPE embed_ready gauge",
+              f"embed_ready {int(_startup['state'] == 'ready')}"]
+    lines += ["# HELP embed_startup_phase_seconds Duration of each startup phase.", "# TYPE embed_startup_phase_seconds gauge"]
+    lines += [f'embed_startup_phase_seconds{{phase="{k}"}} {v / 1000.0:g}' for k, v in _startup["phases_ms"].items()]
+    lines += ["# HELP embed_queue_length Work items waiting in the batch queue.", "# TYPE embed_queue_length gauge"]
+    lines += [f'embed_queue_length{{lane="{lane}"}} {len(q)}' for lane, q in _lanes.items()]
+    lines += ["# HELP embed_queued_tokens Tokens waiting in the batch queue.", "# TYPE embed_queued_tokens gauge"]
+    lines += [f'embed_queued_tokens{{lane="{lane}"}} {n}' for lane, n in _lane_tokens.items()]
+    lines += ["# HELP embed_replica_busy Whether a replica is running a forward.", "# TYPE embed_replica_busy gauge"]
+    lines += [f'embed_replica_busy{{replica="{r.idx}",device="{r.device}"}} {int(r.busy)}' for r in _replicas]
+    lines += ["# HELP embed_replica_healthy Replica health (0 after repeated forward errors).",
+              "# TYPE embed_replica_healthy gauge"]
+    lines += [f'embed_replica_healthy{{replica="{r.idx}",device="{r.device}"}} {int(r.healthy)}' for r in _replicas]
+    return "\n".join(lines) + "\n"
+
 @app.route("/metrics", methods=["GET"])
 def metrics():
+    """JSON summary by default; Prometheus text with ?format=prometheus or a scraper's Accept header."""
+    fmt = (request.args.get("format") or "").lower()
+    if not fmt:
+        # Prometheus scrapers send "application/openmetrics-text;...,text/plain;version=0.0.4;q=0.5,*/*;q=0.1"
+        q_text = max((q for v, q in request.accept_mimetypes
+                      if v.split(";")[0] in ("text/plain", "application/openmetrics-text")), default=0)
+        q_json = max((q for v, q in request.accept_mimetypes if v.split(";")[0] == "application/json"), default=0)
+        fmt = "prometheus" if q_text > q_json else "json"
+    if fmt == "prometheus":
+        return Response(_prometheus_text(), mimetype="text/plain; version=0.0.4")
+
     try:
         dev = next(model.parameters()).device
         dtype = str(next(model.parameters()).dtype)
-    except StopIteration:
+    except (StopIteration, AttributeError):  # AttributeError: model not loaded yet
         dev = MODEL_MAIN_DEVICE
         dtype = str(torch_dtype)
 
@@ -462,7 +1903,24 @@ def metrics():
         except Exception:
             mem_free, mem_total = torch.cuda.mem_get_info()
     return jsonify({
-        "queue_len": len(_request_queue),
+        "queue_len": _queue_len(),
+        "startup": _startup_snapshot(),
+        "lanes": {
+            lane: {"queue_len": len(q), "queued_tokens": _lane_tokens[lane], "items": int(_metrics.items.value(lane))}
+            for lane, q in _lanes.items()
+        },
+        "admission": {
+            "queued_tokens": _queued_tokens(),
+            "rejected": int(_metrics.rejected.value("queue_full")),
+            "aborted_deadline": int(_metrics.aborted.value("deadline")),
+            "aborted_disconnected": int(_metrics.aborted.value("disconnected")),
+            "dropped_expired_items": int(_metrics.dropped.value("expired")),
+            "dropped_cancelled_items": int(_metrics.dropped.value("cancelled")),
+        },
+        "batcher": _batch_stats.snapshot(),
+        "cache": _embedding_cache.snapshot(),
+        "candidate_cache": _candidate_cache.snapshot(),
+        "replicas": [r.snapshot() for r in _replicas],
         "device": str(dev),
         "dtype": dtype,
         "attn_impl": REQUESTED_ATTN,
@@ -484,41 +1942,44 @@ def embed_get(text):
     out_dim = _ensure_int(request.args.get("dim"), DEFAULT_DIM)
     instruction = request.args.get("instruction", None)
     prefix = request.args.get("prefix", None)
+    try:
+        fmt, dtype = _negotiate_format(request.args.get("format"), request.args.get("dtype"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    evt = threading.Event()
-    req = {
-        "text": raw_text,
-        "evt": evt,
-        "vec": None,
-        "error": None,
-        "pooling": pooling,
-        "normalize": normalize,
-        "out_dim": out_dim,
-        "instruction": instruction,
-        "prefix": prefix,
-    }
-    t0 = time.time()
-    with _queue_lock:
-        _request_queue.append(req)
-    evt.wait()
+    long_text = (request.args.get("long_text") or LONG_TEXT_MODE).lower()
+    deadline = _request_deadline(request.args.get("deadline_ms"))
+    priority = _request_priority(request.args.get("priority"))
 
-    if req.get("error"):
-        return jsonify({"error": req["error"]}), 500
+    t0 = time.time()
+    windows = None
+    try:
+        if long_text == "window":
+            vecs, windows = submit_long_texts([raw_text], pooling, normalize, out_dim, instruction, prefix,
+                                              combine=request.args.get("window_combine") or LONG_WINDOW_COMBINE,
+                                              deadline=deadline, priority=priority)
+        else:
+            vecs = submit_texts([raw_text], pooling, normalize, out_dim, instruction, prefix,
+                                deadline=deadline, priority=priority)
+    except RuntimeError as e:
+        return _queue_error_response(e)
 
-    vec = req["vec"]
     elapsed_ms = math.floor((time.time() - t0) * 1000)
-    return jsonify({
+    meta = {
         "model": MODEL_NAME,
         "text": raw_text,
-        "dim": len(vec),
+        "count": 1,
+        "dim": len(vecs[0]),
         "pooling": pooling,
         "normalized": normalize,
         "elapsed_ms": elapsed_ms,
-        "vector": vec,
         "note": "dim is post-truncation if provided (engineering down-projection)."
-    })
+    }
+    if windows is not None:
+        meta["windows"] = windows[0]
+    return _vectors_response(vecs, fmt, dtype, meta, single=True)
 
-# ---- POST batch embeddings (single forward) ----
+# ---- POST batch embeddings (via the shared batcher) ----
 @app.route("/Qwen3-Embedding-4B", methods=["POST"])
 def embed_post():
     data = request.get_json(silent=True) or {}
@@ -531,27 +1992,307 @@ def embed_post():
     out_dim = _ensure_int(data.get("dim"), DEFAULT_DIM)
     instruction = data.get("instruction", None)
     prefix = data.get("prefix", None)
+    try:
+        fmt, dtype = _negotiate_format(data.get("format") or request.args.get("format"),
+                                       data.get("dtype") or request.args.get("dtype"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    long_text = str(data.get("long_text") or LONG_TEXT_MODE).lower()
+    deadline = _request_deadline(data.get("deadline_ms"))
+    priority = _request_priority(data.get("priority"))
 
     t0 = time.time()
-    vecs = embed_texts(
-        [str(t or "").strip() for t in texts],
-        pooling=pooling,
-        normalize=normalize,
-        out_dim=out_dim,
-        instruction=instruction,
-        prefix=prefix
-    ).detach().cpu().tolist()
+    windows = None
+    try:
+        if long_text == "window":
+            vecs, windows = submit_long_texts(
+                [str(t or "").strip() for t in texts],
+                pooling=pooling,
+                normalize=normalize,
+                out_dim=out_dim,
+                instruction=instruction,
+                prefix=prefix,
+                combine=data.get("window_combine") or LONG_WINDOW_COMBINE,
+                deadline=deadline,
+                priority=priority,
+            )
+        else:
+            vecs = submit_texts(
+                [str(t or "").strip() for t in texts],
+                pooling=pooling,
+                normalize=normalize,
+                out_dim=out_dim,
+                instruction=instruction,
+                prefix=prefix,
+                deadline=deadline,
+                priority=priority,
+            )
+    except RuntimeError as e:
+        return _queue_error_response(e)
     elapsed_ms = math.floor((time.time() - t0) * 1000)
-    return jsonify({
+    meta = {
         "model": MODEL_NAME,
         "count": len(texts),
         "dim": len(vecs[0]),
         "pooling": pooling,
         "normalized": normalize,
         "elapsed_ms": elapsed_ms,
-        "vectors": vecs,
         "note": "dim is post-truncation if provided (engineering down-projection)."
-    })
+    }
+    if windows is not None:
+        meta["windows"] = windows
+    return _vectors_response(vecs, fmt, dtype, meta)
+
+# ---- Streaming bulk embeddings (NDJSON in / NDJSON out) ----
+_STREAM_EOF = object()
+
+def _read_stream_lines(stream, as_json: bool, out: "queue.Queue", stop: threading.Event):
+    """
+    Reader thread: parse input lines into (text, id) and put them on the bounded queue
+    `out` (blocking when the stream falls behind, which also stops reading the socket).
+    Ends with _STREAM_EOF, or an Exception for malformed input; gives up once `stop` is set.
+    """
+    def _put(entry) -> bool:
+        while not stop.is_set():
+            try:
+                out.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        while not stop.is_set():
+            line = stream.readline(STREAM_MAX_LINE_BYTES + 1)
+            if not line:
+                break
+            if len(line) > STREAM_MAX_LINE_BYTES:
+                raise ValueError(f"input line longer than {STREAM_MAX_LINE_BYTES} bytes")
+            line = line.decode("utf-8").rstrip("\r\n")
+            if not line.strip():
+                continue
+            if not as_json:
+                entry = (line, None)
+            else:
+                obj = json.loads(line)
+                if isinstance(obj, str):
+                    entry = (obj, None)
+                elif isinstance(obj, dict) and isinstance(obj.get("text"), str):
+                    entry = (obj["text"], obj.get("id"))
+                else:
+                    raise ValueError('each NDJSON line must be a string or {"text": ..., "id": ...}')
+            if not _put(entry):
+                return
+    except Exception as e:
+        _put(e)
+        return
+    _put(_STREAM_EOF)
+
+@app.route("/Qwen3-Embedding-4B/stream", methods=["POST"])
+def embed_stream():
+    """
+    Body: NDJSON (one JSON string or {"text", "id"} per line) or, for text/plain, one text
+    per line; chunked transfer is fine. Options (pooling, normalize, dim, instruction,
+    prefix, priority [default bulk], deadline_ms per chunk) come from the query string.
+    Response: NDJSON, one {"index", "id"?, "embedding"} per input line in input order,
+    then {"done": true, "count", "elapsed_ms"}, or if the stream failed {"error", "status"
+    (400 / 499 / 504 / 500 as for the other endpoints), "count" (rows written)}.
+
+    Texts are submitted to the batcher in chunks of up to STREAM_CHUNK_ITEMS as they
+    arrive; at most STREAM_MAX_INFLIGHT chunks are outstanding and vectors are written
+    as soon as the oldest chunk finishes, so memory stays flat for any input size.
+    A full queue slows the stream down instead of failing it.
+    """
+    pooling = request.args.get("pooling", DEFAULT_POOLING)
+    normalize = _ensure_bool(request.args.get("normalize"), DEFAULT_NORMALIZE)
+    out_dim = _ensure_int(request.args.get("dim"), DEFAULT_DIM)
+    instruction = request.args.get("instruction", None)
+    prefix = request.args.get("prefix", None)
+    priority = _request_priority(request.args.get("priority") or request.headers.get("X-Priority") or "bulk")
+    deadline_ms = request.args.get("deadline_ms")
+    as_json = "text/plain" not in (request.content_type or "")
+
+    lines: "queue.Queue" = queue.Queue(maxsize=STREAM_CHUNK_ITEMS * STREAM_MAX_INFLIGHT)
+    stop = threading.Event()
+    threading.Thread(target=_read_stream_lines, args=(request.stream, as_json, lines, stop),
+                     daemon=True, name="embed-stream-reader").start()
+
+    t_request = getattr(g, "t_request", None)
+    g.stream_latency = True
+
+    def generate():
+        t0 = time.time()
+        client_gone = _disconnect_probe()
+        inflight: deque = deque()  # (first index, ids, pending) in input order
+        count, written, eof, failed = 0, 0, False, None
+        abort_reason = "disconnected"  # GeneratorExit: the client stopped reading
+
+        def _emit(chunk) -> str:
+            nonlocal written
+            base, ids, pending = chunk
+            vecs = _finish_texts(pending, client_gone)
+            t_ser = time.perf_counter()
+            rows = []
+            for j, v in enumerate(vecs):
+                row = {"index": base + j, "embedding": v.tolist()}
+                if ids[j] is not None:
+                    row["id"] = ids[j]
+                rows.append(json.dumps(row))
+            written += len(rows)
+            out = "\n".join(rows) + "\n"
+            _metrics.serialize.observe(time.perf_counter() - t_ser, "ndjson")
+            return out
+
+        try:
+            while not eof or inflight:
+                # Write every finished chunk at the head; block on the head when nothing else can proceed
+                while inflight and (inflight[0][2][2] is None or inflight[0][2][2].ready()):
+                    yield _emit(inflight.popleft())
+                if inflight and (eof or len(inflight) >= STREAM_MAX_INFLIGHT):
+                    yield _emit(inflight.popleft())
+                    continue
+                if eof:
+                    continue
+
+                # Gather what has arrived (wait briefly while chunks are in flight, so they get written)
+                batch = []
+                try:
+                    batch.append(lines.get(timeout=0.005 if inflight else None))
+                    while len(batch) < STREAM_CHUNK_ITEMS and not isinstance(batch[-1], Exception) \
+                            and batch[-1] is not _STREAM_EOF:
+                        batch.append(lines.get_nowait())
+                except queue.Empty:
+                    pass
+                if batch and (batch[-1] is _STREAM_EOF or isinstance(batch[-1], Exception)):
+                    last = batch.pop()
+                    if isinstance(last, Exception) and not isinstance(last, ValueError):
+                        raise _ClientGone(f"request body: {last}")
+                    # Bad input: still answer the lines before it, then report the error
+                    failed = last if isinstance(last, Exception) else None
+                    eof = True
+                if not batch:
+                    continue
+
+                texts = [str(t).strip() for t, _ in batch]
+                deadline = _request_deadline(deadline_ms)
+                while True:
+                    try:
+                        pending = _begin_texts(texts, pooling, normalize, out_dim, instruction, prefix,
+                                               deadline, priority)
+                        break
+                    except _QueueFull as e:
+                        # Back-pressure: finish our own oldest chunk, or wait for the queue to drain
+                        if inflight:
+                            yield _emit(inflight.popleft())
+                            continue
+                        if client_gone is not None and client_gone():
+                            raise _ClientGone("client disconnected")
+                        if deadline is not None and time.perf_counter() >= deadline:
+                            raise _DeadlineExceeded("deadline exceeded while the queue was full")
+                        wait = min(e.retry_after, 1)
+                        if deadline is not None:
+                            wait = min(wait, max(0.0, deadline - time.perf_counter()))
+                        time.sleep(wait)
+                inflight.append((count, [i for _, i in batch], pending))
+                count += len(batch)
+            if failed is not None:
+                raise failed
+            yield json.dumps({"done": True, "count": count, "elapsed_ms": math.floor((time.time() - t0) * 1000)}) + "\n"
+        except (ValueError, RuntimeError) as e:
+            if isinstance(e, _DeadlineExceeded):
+                status, abort_reason = 504, "deadline"
+            elif isinstance(e, _ClientGone):
+                status, abort_reason = 499, "disconnected"
+            elif isinstance(e, ValueError):
+                status, abort_reason = 400, "invalid_input"
+            else:
+                status, abort_reason = 500, "error"
+            yield json.dumps({"error": str(e), "status": status, "count": written}) + "\n"
+        finally:
+            # Stream ended early: stop reading and drop whatever is still queued
+            stop.set()
+            for _, _, (_, _, job) in inflight:
+                if job is not None and not job.ready():
+                    _cancel_job(job, abort_reason)
+            if t_request is not None:
+                _metrics.request.observe(time.perf_counter() - t_request, "embed_stream")
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no"})
+
+# ---- Similarity operands ----
+def _embed_operands(
+    operands: List[Any],
+    pooling: str,
+    normalize: bool,
+    out_dim: Optional[int],
+    instruction: Optional[str],
+    prefix: Optional[str],
+    deadline: Optional[float] = None,
+    priority: str = DEFAULT_PRIORITY,
+) -> List[Tensor]:
+    """
+    Resolve similarity / rerank operands to vectors. An operand is a text, a vector
+    (list of floats), or {"id": ..., "text": ...}. Vectors of id operands are kept in the
+    candidate cache so repeated candidates skip tokenization and the model:
+    {"id", "text"} is looked up by its processed text (a changed text is re-embedded),
+    {"id"} alone by the id, and resolves to the last text sent under that id. Both keys
+    include pooling / normalize / dim and the instruction / prefix. Every text still
+    needing the model goes through the batcher in one submission.
+    Raises ValueError for malformed operands or unknown ids.
+    """
+    pool_key = (pooling or DEFAULT_POOLING).lower()
+
+    def _id_key(op_id) -> tuple:
+        scope = json.dumps([str(op_id), instruction, prefix], ensure_ascii=False)
+        return ("id",) + _EmbeddingCache.key(scope, pool_key, normalize, out_dim)
+
+    out: List[Optional[Tensor]] = [None] * len(operands)
+    id_keys: Dict[int, tuple] = {}
+    lookup: Dict[int, tuple] = {}
+    for i, op in enumerate(operands):
+        if isinstance(op, dict) and op.get("id") is not None:
+            id_keys[i] = _id_key(op["id"])
+            if isinstance(op.get("text"), str):
+                lookup[i] = _EmbeddingCache.key(_apply_instruction_prefix(op["text"], instruction, prefix),
+                                                pool_key, normalize, out_dim)
+            else:
+                lookup[i] = id_keys[i]
+    for i, vec in zip(lookup, _candidate_cache.get_many(list(lookup.values()))):
+        out[i] = vec
+        if vec is not None and lookup[i] is not id_keys[i]:
+            _candidate_cache.put(id_keys[i], vec)  # the id now stands for this text
+
+    texts, text_pos, unknown = [], [], []
+    for i, op in enumerate(operands):
+        if out[i] is not None:
+            continue
+        if isinstance(op, dict):
+            if not isinstance(op.get("text"), str):
+                unknown.append(op.get("id"))
+                continue
+            op = op["text"]
+        if isinstance(op, str):
+            texts.append(op)
+            text_pos.append(i)
+        elif isinstance(op, list) and op:
+            out[i] = torch.tensor(op, dtype=torch.float32)
+        else:
+            raise ValueError("operands must be text, list[float], or {\"id\", \"text\"} objects")
+    if unknown:
+        raise ValueError(f"unknown candidate ids (resend with text): {unknown[:20]}")
+
+    if texts:
+        for i, vec in zip(text_pos, submit_texts(texts, pooling, normalize, out_dim, instruction, prefix,
+                                                 deadline, priority)):
+            out[i] = vec
+            if i in id_keys:
+                _candidate_cache.put(lookup[i], vec)
+                _candidate_cache.put(id_keys[i], vec)
+    if len({v.shape[-1] for v in out}) > 1:
+        raise ValueError("operand vectors have different dimensions")
+    return out
 
 # ---- Cosine similarity ----
 @app.route("/similarity", methods=["POST"])
@@ -568,28 +2309,75 @@ def similarity():
     instruction = data.get("instruction", None)
     prefix = data.get("prefix", None)
 
+    if not all(isinstance(x, (str, list)) for x in (a, b)):
+        return jsonify({"error": "a/b must be string (text) or list[float] (vector)."}), 400
+
+    # Texts are embedded together in one submission; provided vectors are used as-is
+    texts = [x for x in (a, b) if isinstance(x, str)]
+    try:
+        deadline = _request_deadline(data.get("deadline_ms"))
+        embedded = iter(submit_texts(texts, pooling, normalize, out_dim, instruction, prefix, deadline,
+                                     _request_priority(data.get("priority")))) if texts else iter(())
+    except RuntimeError as e:
+        return _queue_error_response(e)
+
     def _to_tensor(x):
-        if isinstance(x, str):
-            return embed_texts([x], pooling, normalize, out_dim, instruction, prefix)
-        if isinstance(x, list):
-            t = torch.tensor([x], dtype=torch.float32, device=MODEL_MAIN_DEVICE)
-            # Always normalize for cosine; ignore out_dim for provided vectors
-            return _postprocess(t, normalize=True, dim=None)
-        return None
+        vec = next(embedded) if isinstance(x, str) else torch.tensor(x, dtype=torch.float32)
+        # Always normalize for cosine; ignore out_dim for provided vectors
+        return _postprocess(vec.unsqueeze(0), normalize=True, dim=None)
 
     va = _to_tensor(a)
     vb = _to_tensor(b)
-    if va is None or vb is None:
-        return jsonify({"error": "a/b must be string (text) or list[float] (vector)."}), 400
 
     score = float(_cosine_similarity(va, vb)[0, 0].detach().cpu().item())
-    return jsonify({
+    return _json_response({
         "model": MODEL_NAME,
         "similarity": score,
         "pooling": pooling,
         "normalized": True
     })
 
+# ---- N x M similarity matrix ----
+@app.route("/similarity/matrix", methods=["POST"])
+def similarity_matrix():
+    """
+    {"queries": [...], "candidates": [...], "top_k": optional}; operands as in _embed_operands.
+    Returns the full N x M cosine matrix, or with top_k each query's best candidates
+    (indices + scores, selected with torch.topk on the model device).
+    """
+    data = request.get_json(silent=True) or {}
+    queries = data.get("queries")
+    cands = data.get("candidates")
+    if not isinstance(queries, list) or not queries or not isinstance(cands, list) or not cands:
+        return jsonify({"error": "JSON must include non-empty 'queries' and 'candidates' arrays."}), 400
+
+    pooling = data.get("pooling", DEFAULT_POOLING)
+    normalize = _ensure_bool(data.get("normalize"), DEFAULT_NORMALIZE)
+    out_dim = _ensure_int(data.get("dim"), DEFAULT_DIM)
+    top_k = _ensure_int(data.get("top_k"), None)
+
+    # Queries and candidates are embedded together (one submission, shared batches)
+    try:
+        vecs = _embed_operands(queries + cands, pooling, normalize, out_dim, data.get("instruction"),
+                               data.get("prefix"), _request_deadline(data.get("deadline_ms")),
+                               _request_priority(data.get("priority")))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return _queue_error_response(e)
+
+    with torch.inference_mode():
+        sims = _cosine_similarity(torch.stack(vecs[:len(queries)]), torch.stack(vecs[len(queries):]))
+        if top_k:
+            scores, idx = torch.topk(sims, min(top_k, len(cands)), dim=1)
+    t0 = time.perf_counter()
+    out = {"model": MODEL_NAME, "shape": [len(queries), len(cands)], "pooling": pooling, "normalized": True}
+    if top_k:
+        out["results"] = [{"indices": i, "scores": s} for i, s in zip(idx.cpu().tolist(), scores.cpu().tolist())]
+    else:
+        out["scores"] = sims.cpu().tolist()
+    return _json_response(out, t0)
+
 # ---- Rerank ----
 @app.route("/rerank", methods=["POST"])
 def rerank():
@@ -604,15 +2392,32 @@ def rerank():
     out_dim = _ensure_int(data.get("dim"), DEFAULT_DIM)
     instruction = data.get("instruction", None)
     prefix = data.get("prefix", None)
+    top_k = _ensure_int(data.get("top_k"), None) or len(cands)
 
+    # Query and candidates go through the batcher as one submission; candidates may be
+    # {"id", "text"} objects served from the id cache
+    operands = [str(query)] + [x if isinstance(x, dict) else str(x) for x in cands]
+    try:
+        vecs = _embed_operands(operands, pooling, normalize, out_dim, instruction, prefix,
+                               _request_deadline(data.get("deadline_ms")), _request_priority(data.get("priority")))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return _queue_error_response(e)
     with torch.inference_mode():
-        qv = embed_texts([query], pooling, normalize, out_dim, instruction, prefix)
-        dv = embed_texts([str(x) for x in cands], pooling, normalize, out_dim, instruction, prefix)
-        sims = _cosine_similarity(qv, dv)[0].detach().cpu().tolist()
-
-    paired = [{"index": i, "text": c, "score": float(s)} for i, (c, s) in enumerate(zip(cands, sims))]
-    paired.sort(key=lambda x: x["score"], reverse=True)
-    return jsonify({"model": MODEL_NAME, "results": paired})
+        sims = _cosine_similarity(vecs[0].unsqueeze(0), torch.stack(vecs[1:]))[0]
+        scores, idx = torch.topk(sims, min(top_k, len(cands)))
+
+    t0 = time.perf_counter()
+    scores, idx = scores.cpu().tolist(), idx.cpu().tolist()
+    results = []
+    for i, s in zip(idx, scores):
+        c = cands[i]
+        item = {"index": i, "text": c.get("text") if isinstance(c, dict) else c, "score": float(s)}
+        if isinstance(c, dict):
+            item["id"] = c.get("id")
+        results.append(item)
+    return _json_response({"model": MODEL_NAME, "results": results}, t0)
 
 # -------------------------------
 # Entrypoint
@@ -620,4 +2425,5 @@ def rerank():
 if __name__ == "__main__":
     # For production consider:
     #   gunicorn -w 1 -k gthread -t 120 -b 0.0.0.0:7202 Qwen3-Embedding-4B_API_LAST:app
+    # (without --preload: the startup and batch threads must start in the worker process)
     app.run(host="0.0.0.0", port=7202, threaded=True)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures. The services load models / connect to databases at import time, so the
+tests import them with the heavy pieces replaced by in-process fakes:
+  - embedding_server : model/Qwen3-Embedding-4B_API.py with a fake `modelscope` whose
+                       loaders fail, so the startup thread never downloads a model.
+  - web_api          : flask_api/basic_API.py (connects lazily; tests patch the connections).
+"""
+
+import os
+import sys
+import types
+import importlib.util
+
+import pytest
+
+BACKEND_AI = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _load_module(name: str, path: str):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class _NoModel:
+    @staticmethod
+    def from_pretrained(*args, **kwargs):
+        raise RuntimeError("model loading is disabled in tests")
+
+
+@pytest.fixture(scope="session")
+def embedding_server():
+    fake = types.ModuleType("modelscope")
+    fake.AutoModel = fake.AutoTokenizer = _NoModel
+    saved = sys.modules.get("modelscope")
+    sys.modules["modelscope"] = fake
+    os.environ.setdefault("ATTN_IMPL", "sdpa")
+    try:
+        srv = _load_module("embedding_server", os.path.join(BACKEND_AI, "model", "Qwen3-Embedding-4B_API.py"))
+        srv.wait_ready(30)
+    finally:
+        if saved is None:
+            sys.modules.pop("modelscope", None)
+        else:
+            sys.modules["modelscope"] = saved
+    return srv
+
+
+@pytest.fixture(scope="session")
+def web_api():
+    return _load_module("basic_api", os.path.join(BACKEND_AI, "flask_api", "basic_API.py"))
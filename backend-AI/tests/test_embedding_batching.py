@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Batch selection, lane shares and admission control of the embedding server's scheduler."""
+from collections import deque
+
+import pytest
+
+
+def _items(lengths, t_enqueue=0.0):
+    return [{"n_tokens": n, "t_enqueue": t_enqueue} for n in lengths]
+
+
+def test_select_batch_groups_similar_lengths(embedding_server):
+    srv = embedding_server
+    pending = _items([10, 100, 12, 11, 95])
+    assert srv._select_batch(pending, max_items=3, max_tokens=10_000) == [0, 3, 2]
+    # rows * longest row stays within the token budget ...
+    assert srv._select_batch(pending, max_items=8, max_tokens=30) == [0, 3]
+    # ... but the oldest item is always taken, even alone over budget
+    assert srv._select_batch(_items([500, 10]), max_items=8, max_tokens=30) == [0]
+
+
+@pytest.fixture
+def lanes(embedding_server, monkeypatch):
+    srv = embedding_server
+    monkeypatch.setattr(srv, "BATCH_MAX_SIZE", 8)
+    monkeypatch.setattr(srv, "BATCH_MAX_TOKENS", 1000)
+    monkeypatch.setattr(srv, "INTERACTIVE_SHARE", 0.75)
+    monkeypatch.setattr(srv, "BULK_MAX_WAIT_MS", 1000)
+    return srv
+
+
+def test_interactive_share_leaves_room_for_bulk(lanes):
+    plan = lanes._plan_lanes({"interactive": _items([10] * 20), "bulk": _items([10] * 20)}, now=0.0)
+    assert (len(plan["interactive"]), len(plan["bulk"])) == (6, 2)
+    # Without bulk work waiting, interactive may use the whole batch
+    plan = lanes._plan_lanes({"interactive": _items([10] * 20), "bulk": []}, now=0.0)
+    assert (len(plan["interactive"]), len(plan["bulk"])) == (8, 0)
+
+
+def test_aged_bulk_item_is_planned_first(lanes):
+    windows = {"interactive": _items([10] * 20), "bulk": _items([200] * 5)}
+    # Long bulk items never fit beside the short interactive ones ...
+    plan = lanes._plan_lanes(windows, now=0.5)
+    assert (len(plan["interactive"]), len(plan["bulk"])) == (6, 0)
+    # ... until the oldest has waited BULK_MAX_WAIT_MS; interactive then fills the room left
+    plan = lanes._plan_lanes(windows, now=1.0)
+    assert plan["bulk"] == [0]
+    assert len(plan["interactive"]) == 4
+
+
+def test_full_queue_answers_429_with_retry_after(embedding_server, monkeypatch):
+    srv = embedding_server
+    monkeypatch.setitem(srv._startup, "state", "ready")
+    monkeypatch.setattr(srv, "tokenizer", lambda texts, **kw: {"input_ids": [[1, 2] for _ in texts]})
+    monkeypatch.setattr(srv, "_embedding_cache", srv._EmbeddingCache(0))
+    monkeypatch.setattr(srv, "QUEUE_MAX_ITEMS", 1)
+    monkeypatch.setitem(srv._lanes, "interactive", deque([{"n_tokens": 2, "job": None}]))
+    monkeypatch.setitem(srv._lane_tokens, "interactive", 2)
+
+    resp = srv.app.test_client().post("/Qwen3-Embedding-4B", json={"texts": ["hello"], "priority": "interactive"})
+    assert resp.status_code == 429
+    assert int(resp.headers["Retry-After"]) >= 1
+    assert resp.get_json()["retry_after_s"] == int(resp.headers["Retry-After"])
+    assert len(srv._lanes["interactive"]) == 1
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""The raw EMB1 response written by the embedding server decodes unchanged in the web API client."""
+import numpy as np
+import pytest
+import requests
+import torch
+
+
+@pytest.mark.parametrize("dtype, tol", [("float32", 0.0), ("float16", 1e-3)])
+def test_raw_format_round_trip(embedding_server, web_api, dtype, tol):
+    srv = embedding_server
+    vecs = [torch.randn(5) for _ in range(3)]
+    meta = {"model": srv.MODEL_NAME, "count": 3, "dim": 5, "pooling": "mean", "normalized": False}
+    with srv.app.test_request_context():
+        served = srv._encode_vectors(vecs, "raw", dtype, meta)
+
+    resp = requests.Response()
+    resp._content = served.get_data()
+    resp.headers.update(served.headers)
+    data = web_api._decode_embedding_response(resp)
+
+    assert served.headers["X-Embedding-Dtype"] == dtype
+    assert (data["count"], data["dim"], data["model"]) == (3, 5, srv.MODEL_NAME)
+    assert np.allclose(data["vectors"], torch.stack(vecs).numpy(), atol=tol, rtol=tol)
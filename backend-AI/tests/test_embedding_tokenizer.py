@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+import pytest
+
+
+class _BorrowCheckedTokenizer:
+    """
+    Mimics a HF fast tokenizer: each call first reconfigures shared truncation state,
+    then encodes with whatever state is current, and a re-entrant call fails the way
+    the Rust backend does ("Already borrowed").
+    """
+
+    pad_token_id = 0
+
+    def __init__(self):
+        self._busy = False
+        self._truncation = None
+
+    def __call__(self, texts, padding=False, truncation=False, max_length=None, add_special_tokens=True, **kwargs):
+        if self._busy:
+            raise RuntimeError("Already borrowed")
+        self._busy = True
+        try:
+            self._truncation = max_length if truncation else None
+            time.sleep(0.0005)
+            single = isinstance(texts, str)
+            rows = []
+            for text in ([texts] if single else texts):
+                ids = [1 + len(w) for w in text.split()]
+                if self._truncation is not None:
+                    ids = ids[:self._truncation]
+                rows.append(ids)
+            return {"input_ids": rows[0] if single else rows}
+        finally:
+            self._busy = False
+
+
+@pytest.fixture
+def fake_tokenizer(embedding_server, monkeypatch):
+    tok = _BorrowCheckedTokenizer()
+    monkeypatch.setattr(embedding_server, "tokenizer", tok)
+    monkeypatch.setattr(embedding_server, "SPECIAL_PREFIX", [])
+    monkeypatch.setattr(embedding_server, "SPECIAL_SUFFIX", [])
+    return tok
+
+
+def test_truncated_and_windowed_tokenize_do_not_interfere(embedding_server, fake_tokenizer):
+    srv = embedding_server
+    long_text = " ".join(["word"] * (srv.MAX_LENGTH * 3))
+    errors = []
+    start = threading.Barrier(8)
+
+    def run(fn, check):
+        start.wait()
+        try:
+            for _ in range(50):
+                check(fn([long_text, "short text"]))
+        except Exception as e:  # collected and asserted below
+            errors.append(e)
+
+    def check_truncated(rows):
+        assert [len(r) for r in rows] == [srv.MAX_LENGTH, 2]
+
+    def check_windowed(rows):
+        assert len(rows[0]) > 1, "long text was not windowed"
+        assert all(len(w) <= srv.MAX_LENGTH for w in rows[0])
+        assert sum(len(w) for w in rows[0]) >= srv.MAX_LENGTH * 3
+        assert rows[1] == [[6, 5]]
+
+    threads = [threading.Thread(target=run, args=(srv._tokenize, check_truncated)) for _ in range(4)]
+    threads += [threading.Thread(target=run, args=(srv._tokenize_windows, check_windowed)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors, errors[:3]
+
+
+def test_every_window_carries_the_instruction(embedding_server, fake_tokenizer):
+    srv = embedding_server
+    long_text = " ".join(["word"] * (srv.MAX_LENGTH * 3))
+    head = [len("Instruction:") + 1, len("find") + 1, len("Query:") + 1]
+    rows = srv._tokenize_windows([long_text, "short text"], instruction="find")
+    assert len(rows[0]) > 1
+    for window in rows[0]:
+        assert window[:len(head)] == head
+        assert len(window) <= srv.MAX_LENGTH
+    assert rows[1] == [head + [6, 5]]
+
+
+def test_long_text_cache_hit_skips_tokenizing(embedding_server, fake_tokenizer, monkeypatch):
+    srv = embedding_server
+    import torch
+    cache = srv._EmbeddingCache(1 << 20)
+    monkeypatch.setattr(srv, "_embedding_cache", cache)
+    key = srv._EmbeddingCache.key("some long text", "mean+window-mean", True, None)
+    cache.put(key, torch.ones(4))
+    cache.put(key + ("windows",), torch.tensor([3.0]))
+
+    def no_tokenizer(*args, **kwargs):
+        raise AssertionError("cache hit was tokenized")
+    monkeypatch.setattr(srv, "tokenizer", no_tokenizer)
+    vecs, counts = srv.submit_long_texts(["some long text"], pooling="mean", normalize=True,
+                                         out_dim=None, combine="mean")
+    assert counts == [3]
+    assert torch.equal(vecs[0], torch.ones(4))
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Re-ingesting a page keeps the pages row (lexical leg) and the Qdrant payload (vector leg) in sync."""
+import re
+from datetime import datetime
+
+import numpy as np
+import pytest
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import Distance, Filter, VectorParams
+
+DIM = 4
+
+
+class _FakePages:
+    """Just enough of PostgreSQL for upsert_page() / upsert_chunks_and_vectors(): the pages table."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def connect(self):
+        return _FakeConn(self)
+
+    def execute(self, sql, params):
+        sql = " ".join(sql.split())
+        if sql.startswith("SELECT id, checksum FROM pages WHERE url=%s"):
+            return [{"id": r["id"], "checksum": r["checksum"]} for r in self.rows.values() if r["url"] == params[0]]
+        if sql.startswith(("DELETE FROM chunks", "INSERT INTO chunks")):
+            return []
+        m = re.match(r"SELECT (.*) FROM pages WHERE id = ANY\(%s\)", sql)
+        if m:
+            cols = [c.strip() for c in m.group(1).split(",")]
+            return [{c: r.get(c) for c in cols} for r in self.rows.values() if r["id"] in params[0]]
+        returning = [c.strip() for c in sql.split("RETURNING", 1)[1].split(",")] if "RETURNING" in sql else []
+        m = re.match(r"UPDATE pages SET (.*) WHERE id=%s", sql)
+        if m:
+            cols = [a.split("=")[0].strip() for a in m.group(1).split(",")]
+            row = self.rows[params[-1]]
+            row.update(zip(cols, params[:-1]))
+        else:
+            m = re.match(r"INSERT INTO pages \((.*?)\) VALUES", sql)
+            assert m, sql
+            row = dict(zip([c.strip() for c in m.group(1).split(",")], params), id=len(self.rows) + 1)
+            self.rows[row["id"]] = row
+        return [{c: row.get(c) for c in returning}]
+
+
+class _FakeConn:
+    def __init__(self, db):
+        self.db = db
+        self._result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self, **kwargs):
+        return self
+
+    def execute(self, sql, params=()):
+        self._result = self.db.execute(sql, params)
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return self._result
+
+    def commit(self):
+        pass
+
+
+def _pg_matches(api, row, filters) -> bool:
+    """Evaluate the lexical leg's WHERE fragment (_pg_filter_clause) against a pages row, NULL never matching."""
+    where, params = api._pg_filter_clause(filters)
+    for clause, value in zip([c for c in where.split(" AND ") if c], params):
+        col, op = re.match(r"p\.(\w+) (=|>=|<=)", clause).groups()
+        have = row[col]
+        if have is None:
+            return False
+        if op == "=" and have not in value:
+            return False
+        if op == ">=" and have < value:
+            return False
+        if op == "<=" and have > value:
+            return False
+    return True
+
+
+@pytest.fixture
+def ingest(web_api, monkeypatch):
+    api = web_api
+    db = _FakePages()
+    qdrant = QdrantClient(location=":memory:")
+    clock = {"now": datetime(2024, 1, 1)}
+    page = {}
+
+    class _Clock(datetime):
+        @classmethod
+        def utcnow(cls):
+            return clock["now"]
+
+    def ensure_collection(dim):
+        if not qdrant.collection_exists(api.WEB_CONFIG["QDRANT_COLLECTION"]):
+            qdrant.create_collection(api.WEB_CONFIG["QDRANT_COLLECTION"],
+                                     vectors_config=VectorParams(size=dim, distance=Distance.COSINE))
+
+    monkeypatch.setattr(api, "datetime", _Clock)
+    monkeypatch.setattr(api, "get_pg_conn", db.connect)
+    monkeypatch.setattr(api, "get_qdrant", lambda: qdrant)
+    monkeypatch.setattr(api, "ensure_qdrant_collection", ensure_collection)
+    monkeypatch.setattr(api, "probe_embedding_dim", lambda: DIM)
+    monkeypatch.setattr(api, "embed_batch", lambda texts, **kw: {"vectors": np.ones((len(texts), DIM)), "dim": DIM})
+    monkeypatch.setattr(api, "fetch_html", lambda url: "<html></html>")
+    monkeypatch.setattr(api, "clean_extract", lambda url, html: dict(page))
+    monkeypatch.setitem(api.WEB_CONFIG, "VECTOR_INDEX_MODE", "full")
+
+    def run(when, **parsed):
+        clock["now"] = when
+        page.clear()
+        page.update({"title": "T", "published_at": None, "site": "a.example", "lang": "en"}, **parsed)
+        return api.ingest_url("https://a.example/p")
+
+    run.db, run.qdrant = db, qdrant
+    return run
+
+
+FILTERS = [
+    {"lang": ["en"]},
+    {"lang": ["zh"]},
+    {"site": ["a.example"]},
+    {"site": ["b.example"]},
+    {"fetched_after": datetime(2024, 3, 1)},
+    {"fetched_before": datetime(2024, 3, 1)},
+    {"fetched_after": datetime(2024, 8, 1)},
+    {"published_after": datetime(2023, 1, 1)},
+    {"lang": ["zh"], "fetched_after": datetime(2024, 3, 1)},
+]
+
+
+def _assert_legs_agree(api, ingest):
+    (row,) = ingest.db.rows.values()
+    collection = api.WEB_CONFIG["QDRANT_COLLECTION"]
+    for filters in FILTERS:
+        in_vector_leg = ingest.qdrant.count(collection, count_filter=api._qdrant_filter(filters), exact=True).count > 0
+        assert _pg_matches(api, row, filters) == in_vector_leg, filters
+
+
+def test_reingest_keeps_both_legs_filtering_alike(web_api, ingest):
+    ingest(datetime(2024, 1, 1), content="first version")
+    _assert_legs_agree(web_api, ingest)
+
+    # Same content, re-fetched later with a different lang attribute
+    ingest(datetime(2024, 6, 1), content="first version", lang="zh")
+    _assert_legs_agree(web_api, ingest)
+    (row,) = ingest.db.rows.values()
+    assert row["fetched_at"] == datetime(2024, 6, 1) and row["lang"] == "zh"
+
+    # Changed content with a publication date
+    ingest(datetime(2024, 9, 1), content="second version", published_at=datetime(2024, 8, 30))
+    _assert_legs_agree(web_api, ingest)
+
+
+def test_backfill_restores_filter_payload_of_old_points(web_api, ingest):
+    ingest(datetime(2024, 6, 1), content="first version", lang="zh")
+    collection = web_api.WEB_CONFIG["QDRANT_COLLECTION"]
+    # Points written before the filter fields existed carried only these keys
+    ingest.qdrant.overwrite_payload(collection, payload={"page_id": 1, "url": "https://a.example/p", "title": "T"},
+                                    points=Filter(must=[]))
+    assert web_api.backfill_qdrant_payloads() == 1
+    _assert_legs_agree(web_api, ingest)
+    assert web_api.backfill_qdrant_payloads() == 0
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""/web/search 的纯逻辑部分：融合、重排预算、游标。"""
+import time
+
+import pytest
+
+
+def test_rerank_budget_counts_from_the_stage_start(web_api, monkeypatch):
+    calls = []
+    monkeypatch.setattr(web_api.requests, "post", lambda *a, **kw: calls.append(kw))
+    fused = [{"chunk_id": 1}, {"chunk_id": 2}]
+    id2text = {1: "first chunk", 2: "second chunk"}
+    # 补全已经用完预算：不再发起重排请求，直接回退融合顺序
+    started = time.perf_counter() - 0.5
+    out, info = web_api._rerank_chunks("q", fused, 2, 100, id2text, started=started)
+    assert out == fused
+    assert info == {"applied": False, "reason": "budget_exceeded"}
+    assert not calls
+
+
+def test_alpha_zero_is_not_treated_as_missing(web_api):
+    assert web_api._parse_search_params({"q": "x", "alpha": 0})["alpha"] == 0.0
+    assert web_api._parse_search_params({"q": "x", "alpha": "0"})["alpha"] == 0.0
+    assert web_api._parse_search_params({"q": "x"})["alpha"] == 0.6
+
+
+def _hits(*chunk_ids, scores=None):
+    scores = scores or [1.0 - 0.1 * i for i in range(len(chunk_ids))]
+    return [{"chunk_id": c, "page_id": c // 10, "score": s} for c, s in zip(chunk_ids, scores)]
+
+
+def test_rrf_rewards_agreement_between_legs(web_api):
+    fused = web_api._fuse_chunks(_hits(1, 2, 3), _hits(3, 4), "rrf", 0.5, 60)
+    assert fused[0]["chunk_id"] == 3
+    by_id = {r["chunk_id"]: r for r in fused}
+    assert by_id[3]["score"] == pytest.approx(1 / 63 + 1 / 61)
+    assert by_id[1]["score"] == pytest.approx(1 / 61)
+    assert (by_id[4]["rank_vector"], by_id[4]["rank_lexical"]) == (None, 2)
+
+
+def test_alpha_fusion_weights_normalized_scores(web_api):
+    vec, lex = _hits(1, 2, scores=[0.9, 0.5]), _hits(2, 1, scores=[12.0, 2.0])
+    only_vector = web_api._fuse_chunks(vec, lex, "alpha", 1.0, 60)
+    only_lexical = web_api._fuse_chunks(vec, lex, "alpha", 0.0, 60)
+    assert [r["chunk_id"] for r in only_vector] == [1, 2]
+    assert [r["chunk_id"] for r in only_lexical] == [2, 1]
+    mixed = {r["chunk_id"]: r["score"] for r in web_api._fuse_chunks(vec, lex, "alpha", 0.25, 60)}
+    assert mixed == pytest.approx({1: 0.25, 2: 0.75})
+
+
+class _FakeCursors:
+    """search_cursors 表：_make_search_cursor() / _search_from_cursor() 用到的三条语句。"""
+
+    def __init__(self):
+        self.rows = {}
+        self._result = []
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self, **kwargs):
+        return self
+
+    def commit(self):
+        pass
+
+    def execute(self, sql, params=()):
+        sql = " ".join(sql.split())
+        self._result = []
+        if sql.startswith("INSERT INTO search_cursors"):
+            cid, scope, q, mode, results, expires_at = params
+            self.rows[cid] = {"scope": scope, "q": q, "mode": mode, "results": results.adapted,
+                              "expires_at": expires_at}
+        elif sql.startswith("SELECT scope, q, mode, results FROM search_cursors"):
+            row = self.rows.get(params[0])
+            self._result = [row] if row and row["expires_at"] >= params[1] else []
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+
+@pytest.fixture
+def cursors(web_api, monkeypatch):
+    db = _FakeCursors()
+    monkeypatch.setattr(web_api, "get_pg_conn", db)
+    monkeypatch.setattr(web_api, "_hydrate_candidates", lambda pages, **kw: {})
+    return db
+
+
+def test_cursor_is_bound_to_query_mode_and_filters(web_api, cursors):
+    params = web_api._parse_search_params({"q": "rust async", "top_k": 2, "lang": "en"})
+    rest = [{"page_id": i, "chunk_id": i * 10, "score": 1.0 / i, "score_vector": 0.5, "score_lexical": 0.5}
+            for i in range(1, 6)]
+    token = web_api._make_search_cursor(params, rest)
+
+    page = web_api._search_from_cursor(token, params)
+    assert [r["page_id"] for r in page["results"]] == [1, 2]
+    page = web_api._search_from_cursor(page["next_cursor"])
+    assert [r["page_id"] for r in page["results"]] == [3, 4]
+
+    for other in ({"q": "python async", "top_k": 2, "lang": "en"},
+                  {"q": "rust async", "top_k": 2, "lang": "en", "mode": "vector"},
+                  {"q": "rust async", "top_k": 2, "lang": "zh"}):
+        with pytest.raises(ValueError):
+            web_api._search_from_cursor(token, web_api._parse_search_params(other))
+
+    # A token signed for another scope does not unlock a stored cursor
+    (cursor_id,) = cursors.rows
+    forged = web_api._cursor_token(cursor_id, 0, 2, web_api._search_scope(web_api._parse_search_params({"q": "x"})))
+    with pytest.raises(ValueError):
+        web_api._search_from_cursor(forged)